@@ -0,0 +1,232 @@
+"""Circuit breaker with adaptive timeouts for upstream HTTP APIs.
+
+Each breaker keeps a rolling window of call outcomes. When the error rate in
+the window crosses the threshold the circuit opens and calls fail fast with
+CircuitOpenError instead of waiting for a timeout. After open_duration a
+limited number of probe calls are let through (half-open): a successful probe
+closes the circuit, a failed one opens it again.
+
+Timeouts follow the observed latency: p99 of recent successful calls times
+timeout_multiplier, clamped to [min_timeout, max_timeout]. Until enough
+samples are collected max_timeout is used.
+
+Blocking calls run in the breaker's executor; giving each upstream its own
+keeps a slow upstream from occupying the threads of the others.
+"""
+import asyncio
+import contextvars
+import time
+from collections import deque
+from concurrent.futures import Executor
+from functools import partial
+from typing import Any, Callable, Dict, List, Optional
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+STATE_CODES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling the upstream while the circuit is open"""
+
+    def __init__(self, name: str, retry_after: float):
+        super().__init__(f"Circuit {name} is open, retry in {retry_after:.1f}s")
+        self.name = name
+        self.retry_after = retry_after
+
+class UpstreamStatusError(Exception):
+    """Upstream answered with a status that counts as a failure"""
+
+    def __init__(self, status_code: int):
+        super().__init__(f"Upstream returned HTTP {status_code}")
+        self.status_code = status_code
+
+def is_failure_status(status_code: int) -> bool:
+    return status_code >= 500 or status_code == 429
+
+class CircuitBreaker:
+    def __init__(
+        self,
+        name: str,
+        max_timeout: float,
+        min_timeout: float = 1.0,
+        timeout_multiplier: float = 2.0,
+        window: float = 60.0,
+        min_calls: int = 10,
+        error_rate_threshold: float = 0.5,
+        open_duration: float = 30.0,
+        half_open_max_calls: int = 1,
+        latency_samples: int = 200,
+        min_latency_samples: int = 20,
+        failure_status: Callable[[int], bool] = is_failure_status,
+        executor: Optional[Executor] = None,
+    ):
+        self.name = name
+        self.max_timeout = max_timeout
+        self.min_timeout = min_timeout
+        self.timeout_multiplier = timeout_multiplier
+        self.window = window
+        self.min_calls = min_calls
+        self.error_rate_threshold = error_rate_threshold
+        self.open_duration = open_duration
+        self.half_open_max_calls = half_open_max_calls
+        self.min_latency_samples = min_latency_samples
+        self.failure_status = failure_status
+        self.executor = executor  # None - the default executor of the loop
+
+        self.state = CLOSED
+        self.opened_at = 0.0
+        self.half_open_calls = 0
+        self.outcomes: deque = deque()  # (monotonic time, ok)
+        self.failures_in_window = 0
+        self.latencies: deque = deque(maxlen=latency_samples)
+        # observer(name, outcome, started, duration, target) after every executed call,
+        # target is the URL passed as the first argument of func
+        self.observers: List[Callable[[str, str, float, float, str], None]] = []
+
+        self.counters = {
+            "calls": 0,
+            "successes": 0,
+            "failures": 0,
+            "rejected": 0,
+            "opened": 0,
+        }
+
+    def _prune(self, now: float):
+        cutoff = now - self.window
+        outcomes = self.outcomes
+        while outcomes and outcomes[0][0] < cutoff:
+            _, ok = outcomes.popleft()
+            if not ok:
+                self.failures_in_window -= 1
+
+    def _open(self, now: float):
+        self.state = OPEN
+        self.opened_at = now
+        self.half_open_calls = 0
+        self.counters["opened"] += 1
+
+    def _close(self):
+        self.state = CLOSED
+        self.half_open_calls = 0
+        self.outcomes.clear()
+        self.failures_in_window = 0
+
+    def error_rate(self) -> float:
+        self._prune(time.monotonic())
+        if not self.outcomes:
+            return 0.0
+        return self.failures_in_window / len(self.outcomes)
+
+    def latency_percentile(self, q: float) -> Optional[float]:
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def timeout(self) -> float:
+        """Adaptive timeout derived from recent p99 latency"""
+        if len(self.latencies) < self.min_latency_samples:
+            return self.max_timeout
+        p99 = self.latency_percentile(0.99)
+        return min(self.max_timeout, max(self.min_timeout, p99 * self.timeout_multiplier))
+
+    def before_call(self):
+        """Admit a call or raise CircuitOpenError"""
+        now = time.monotonic()
+        if self.state == OPEN:
+            retry_after = self.opened_at + self.open_duration - now
+            if retry_after > 0:
+                self.counters["rejected"] += 1
+                raise CircuitOpenError(self.name, retry_after)
+            self.state = HALF_OPEN
+            self.half_open_calls = 0
+        if self.state == HALF_OPEN:
+            if self.half_open_calls >= self.half_open_max_calls:
+                self.counters["rejected"] += 1
+                raise CircuitOpenError(self.name, self.open_duration)
+            self.half_open_calls += 1
+        self.counters["calls"] += 1
+
+    def record_success(self, latency: float):
+        self.counters["successes"] += 1
+        self.latencies.append(latency)
+        if self.state == HALF_OPEN:
+            self._close()
+            return
+        now = time.monotonic()
+        self.outcomes.append((now, True))
+        self._prune(now)
+
+    def record_failure(self):
+        self.counters["failures"] += 1
+        now = time.monotonic()
+        if self.state == HALF_OPEN:
+            self._open(now)
+            return
+        self.outcomes.append((now, False))
+        self.failures_in_window += 1
+        self._prune(now)
+        if (
+            self.state == CLOSED
+            and len(self.outcomes) >= self.min_calls
+            and self.failures_in_window / len(self.outcomes) >= self.error_rate_threshold
+        ):
+            self._open(now)
+
+    async def call(self, func: Callable, *args, timeout: Optional[float] = None, **kwargs) -> Any:
+        """Run blocking HTTP call func(*args, timeout=..., **kwargs) in the executor under the breaker
+
+        Exceptions and responses whose status matches failure_status (5xx and
+        429 by default) count as failures; such responses are raised as
+        UpstreamStatusError.
+        """
+        self.before_call()
+        if timeout is None:
+            timeout = self.timeout()
+        started = time.monotonic()
+        outcome = "error"
+        try:
+            context = contextvars.copy_context()
+            response = await asyncio.get_running_loop().run_in_executor(
+                self.executor, partial(context.run, func, *args, timeout=timeout, **kwargs)
+            )
+            status_code = getattr(response, "status_code", 200)
+            if self.failure_status(status_code):
+                self.record_failure()
+                outcome = "status_error"
+                raise UpstreamStatusError(status_code)
+            self.record_success(time.monotonic() - started)
+            outcome = "success"
+            return response
+        except asyncio.CancelledError:
+            # The caller gave up, this says nothing about the upstream
+            outcome = "cancelled"
+            if self.state == HALF_OPEN:
+                self.half_open_calls -= 1
+            raise
+        except UpstreamStatusError:
+            raise
+        except Exception:
+            self.record_failure()
+            raise
+        finally:
+            if self.observers:
+                duration = time.monotonic() - started
+                target = args[0] if args and isinstance(args[0], str) else ""
+                for observer in self.observers:
+                    observer(self.name, outcome, time.time() - duration, duration, target)
+
+    def stats(self) -> Dict[str, Any]:
+        p50 = self.latency_percentile(0.5)
+        p99 = self.latency_percentile(0.99)
+        return {
+            "state": self.state,
+            "error_rate": round(self.error_rate(), 4),
+            "window_calls": len(self.outcomes),
+            "timeout": round(self.timeout(), 3),
+            "latency_p50": round(p50, 4) if p50 is not None else None,
+            "latency_p99": round(p99, 4) if p99 is not None else None,
+            **self.counters,
+        }
@@ -0,0 +1,123 @@
+"""Motor database wrapper that reports every round-trip to observers.
+
+    db = InstrumentedDatabase(client[name], observers)
+
+behaves like the Motor database; each awaited collection operation (and the
+to_list or each batch fetched while iterating a find or aggregate cursor)
+calls every observer(collection, operation, started, duration, error) with
+wall-clock start time, duration in seconds and the exception or None.
+Database attributes that are not collections (command, list_collection_names...)
+are forwarded unobserved.
+"""
+import time
+from typing import Any, Callable, List, Optional
+
+Observer = Callable[[str, str, float, float, Optional[BaseException]], None]
+
+OPERATIONS = frozenset({
+    "find_one", "insert_one", "insert_many", "update_one", "update_many", "replace_one",
+    "delete_one", "delete_many", "count_documents", "estimated_document_count",
+    "find_one_and_update", "find_one_and_replace", "find_one_and_delete", "distinct",
+    "create_index", "bulk_write",
+})
+CURSOR_OPERATIONS = frozenset({"find", "aggregate"})
+
+async def observe(observers: List[Observer], collection: str, operation: str, awaitable):
+    started = time.time()
+    started_perf = time.perf_counter()
+    error = None
+    try:
+        return await awaitable
+    except StopAsyncIteration:
+        raise
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        duration = time.perf_counter() - started_perf
+        for observer in observers:
+            observer(collection, operation, started, duration, error)
+
+class InstrumentedCursor:
+    def __init__(self, cursor, observers: List[Observer], collection: str, operation: str):
+        self.cursor = cursor
+        self.observers = observers
+        self.collection = collection
+        self.operation = operation
+
+    def __getattr__(self, name: str) -> Any:
+        attr = getattr(self.cursor, name)
+        if not callable(attr):
+            return attr
+
+        def chained(*args, **kwargs):
+            result = attr(*args, **kwargs)
+            # sort()/limit()/skip() return the cursor itself
+            return self if result is self.cursor else result
+        return chained
+
+    async def to_list(self, length: Optional[int] = None):
+        return await observe(self.observers, self.collection, self.operation, self.cursor.to_list(length))
+
+    def __aiter__(self):
+        return self.iterate()
+
+    def fetches(self, first: bool) -> bool:
+        """Whether the next document needs a round-trip rather than the current batch"""
+        buffer_size = getattr(self.cursor, "_buffer_size", None)
+        if buffer_size is None:
+            # Курсор без пачек (mongomock) получает всё сразу
+            return first
+        return self.cursor.alive and not buffer_size()
+
+    async def iterate(self):
+        iterator = self.cursor.__aiter__()
+        first = True
+        while True:
+            try:
+                if self.fetches(first):
+                    document = await observe(self.observers, self.collection, self.operation, iterator.__anext__())
+                else:
+                    document = await iterator.__anext__()
+            except StopAsyncIteration:
+                return
+            first = False
+            yield document
+
+class InstrumentedCollection:
+    def __init__(self, collection, observers: List[Observer]):
+        self.collection = collection
+        self.observers = observers
+        self.name = collection.name
+
+    def __getattr__(self, name: str) -> Any:
+        attr = getattr(self.collection, name)
+        if name in OPERATIONS:
+            def operation(*args, **kwargs):
+                return observe(self.observers, self.name, name, attr(*args, **kwargs))
+            return operation
+        if name in CURSOR_OPERATIONS:
+            def cursor(*args, **kwargs):
+                return InstrumentedCursor(attr(*args, **kwargs), self.observers, self.name, name)
+            return cursor
+        return attr
+
+class InstrumentedDatabase:
+    def __init__(self, database, observers: List[Observer]):
+        self.database = database
+        self.observers = observers
+        self.collections = {}
+
+    def __getitem__(self, name: str) -> InstrumentedCollection:
+        collection = self.collections.get(name)
+        if collection is None:
+            collection = self.collections[name] = InstrumentedCollection(self.database[name], self.observers)
+        return collection
+
+    def __getattr__(self, name: str) -> Any:
+        if name.startswith("_"):
+            raise AttributeError(name)
+        # Методы базы (command, list_collection_names...) объявлены в классе, коллекции - нет
+        if hasattr(type(self.database), name):
+            return getattr(self.database, name)
+        return self[name]
@@ -0,0 +1,187 @@
+"""Cross-process cache invalidation.
+
+A process that changes cached data publishes (scope, key) and every other
+process drops that key from its cache for the scope; key None flushes the
+whole scope. Two transports:
+
+* MongoInvalidationBus - messages are inserted into the cache_invalidations
+  collection and received through a change stream (the driver resumes it
+  after transient errors). Requires a replica set.
+* SocketInvalidationBus - Unix datagram sockets in a shared directory, one
+  per process. A stand-in for tests and single-host setups without a
+  replica set.
+
+Cross-process buses report themselves disconnected until run() starts
+receiving, and again when delivery may have been interrupted (the stream
+failed and had to be reopened); on (re)connecting they flush every registered
+cache. Callers bypass caches while the bus is disconnected.
+"""
+import asyncio
+import json
+import logging
+import os
+import socket
+import uuid
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, Optional
+
+FLUSH_ALL = "*"
+
+class InvalidationBus:
+    """Local-only bus: invalidations apply to this process"""
+
+    def __init__(self):
+        self.process_id = uuid.uuid4().hex
+        self.handlers: Dict[str, Callable[[Any], None]] = {}
+        # Cross-process transports stay disconnected until run() receives
+        self.connected = True
+        self.stats = {
+            "published": 0,
+            "received": 0,
+            "flushes": 0,
+            "lag_last": 0.0,
+            "lag_max": 0.0,
+            "lag_total": 0.0,
+        }
+
+    def register(self, scope: str, handler: Callable[[Any], None]):
+        """handler(key) drops key from the cache of scope, handler(None) clears it"""
+        self.handlers[scope] = handler
+
+    def apply(self, scope: str, key: Any):
+        if scope == FLUSH_ALL:
+            self.flush_all()
+            return
+        handler = self.handlers.get(scope)
+        if handler:
+            handler(key)
+
+    def flush_all(self):
+        self.stats["flushes"] += 1
+        for handler in self.handlers.values():
+            handler(None)
+
+    def receive(self, message: Dict[str, Any]):
+        if message.get("origin") == self.process_id:
+            return
+        lag = max(0.0, (datetime.utcnow() - message["published_at"]).total_seconds())
+        self.stats["received"] += 1
+        self.stats["lag_last"] = lag
+        self.stats["lag_max"] = max(self.stats["lag_max"], lag)
+        self.stats["lag_total"] += lag
+        self.apply(message["scope"], message.get("key"))
+
+    def message(self, scope: str, key: Any) -> Dict[str, Any]:
+        return {"scope": scope, "key": key, "origin": self.process_id, "published_at": datetime.utcnow()}
+
+    async def publish(self, scope: str, key: Any = None):
+        """Invalidate key of scope here and in every other process"""
+        self.apply(scope, key)
+        self.stats["published"] += 1
+        await self._send(self.message(scope, key))
+
+    async def _send(self, message: Dict[str, Any]):
+        pass
+
+    async def run(self):
+        pass
+
+    def snapshot(self) -> Dict[str, Any]:
+        received = self.stats["received"]
+        return {
+            "transport": type(self).__name__,
+            "connected": self.connected,
+            **self.stats,
+            "lag_avg": self.stats["lag_total"] / received if received else 0.0,
+        }
+
+class MongoInvalidationBus(InvalidationBus):
+    def __init__(self, db, retention: float = 3600.0, retry_delay: float = 5.0):
+        super().__init__()
+        self.collection = db.cache_invalidations
+        self.retention = retention
+        self.retry_delay = retry_delay
+        self.connected = False
+
+    async def _send(self, message: Dict[str, Any]):
+        message["expires_at"] = message["published_at"] + timedelta(seconds=self.retention)
+        await self.collection.insert_one(message)
+
+    async def run(self):
+        try:
+            await self.collection.create_index("expires_at", expireAfterSeconds=0)
+        except Exception as e:
+            logging.error(f"Failed to create cache_invalidations index: {e}")
+
+        pipeline = [{"$match": {"operationType": "insert"}}]
+        while True:
+            try:
+                async with self.collection.watch(pipeline) as stream:
+                    if not self.connected:
+                        # Пока поток не работал, инвалидации могли потеряться
+                        self.flush_all()
+                        self.connected = True
+                    async for change in stream:
+                        self.receive(change["fullDocument"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"Cache invalidation stream failed: {e}")
+                self.connected = False
+                self.flush_all()
+                await asyncio.sleep(self.retry_delay)
+
+class SocketInvalidationBus(InvalidationBus):
+    def __init__(self, directory: str):
+        super().__init__()
+        self.directory = directory
+        self.path = os.path.join(directory, f"{self.process_id}.sock")
+        self.sock: Optional[socket.socket] = None
+        self.connected = False
+
+    def _bind(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(self.path)
+        self.sock.setblocking(False)
+
+    async def _send(self, message: Dict[str, Any]):
+        if self.sock is None:
+            self._bind()
+        payload = json.dumps({**message, "published_at": message["published_at"].isoformat()}).encode()
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if path == self.path or not name.endswith(".sock"):
+                continue
+            try:
+                self.sock.sendto(payload, path)
+            except (ConnectionRefusedError, FileNotFoundError):
+                # Процесс завершился, не удалив свой сокет
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+            except BlockingIOError:
+                logging.error(f"Invalidation receiver {name} is not keeping up, message dropped")
+
+    async def run(self):
+        if self.sock is None:
+            self._bind()
+        loop = asyncio.get_running_loop()
+        # Сообщения, отправленные до привязки сокета, потеряны
+        self.flush_all()
+        self.connected = True
+        try:
+            while True:
+                payload = await loop.sock_recv(self.sock, 65536)
+                message = json.loads(payload)
+                message["published_at"] = datetime.fromisoformat(message["published_at"])
+                self.receive(message)
+        finally:
+            self.connected = False
+            self.sock.close()
+            self.sock = None
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,221 @@
+"""User notifications derived from database changes.
+
+Handlers only write records (payments, referrals); this service watches those
+collections and turns new records into Telegram messages. Each source is read
+through a change stream whose resume token is stored in notification_cursors
+after every delivered event, so a restart continues where it stopped. On a
+standalone server without change streams the same sources are polled instead:
+inserts by _id, updates by their timestamp field, in both cases only up to
+poll_settle seconds ago, so a document written late with an earlier id or
+timestamp is not skipped.
+
+Every event has a stable id that is claimed in notification_log as "pending"
+before sending and marked "delivered" after it: several processes can watch
+the same streams and a replayed event is never sent twice. A failed send is
+retried; if it keeps failing the claim is deleted so a replay can send it,
+and a claim left pending by a crashed process is taken over after
+claim_timeout. Sending is paced by a global rate and a minimal interval per
+chat to stay within Telegram limits: each send reserves the earliest time
+that satisfies both, so a chat waiting out its interval does not delay
+notifications to other chats.
+"""
+import asyncio
+import bisect
+import logging
+import time
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Dict, List, NamedTuple, Optional
+
+from bson import ObjectId
+from pymongo.errors import DuplicateKeyError, OperationFailure
+
+# Code of "The $changeStream stage is only supported on replica sets"
+CHANGE_STREAMS_UNSUPPORTED = 40573
+
+class Notification(NamedTuple):
+    event_id: str
+    chat_id: int
+    text: str
+    reply_markup: Optional[dict] = None
+
+class NotificationSource(NamedTuple):
+    name: str
+    collection: str
+    operation: str  # "insert" or "update"
+    timestamp_field: str  # used when polling update sources
+    derive: Callable[[Dict[str, Any]], Optional[Notification]]
+    match: Dict[str, Any] = {}  # extra change stream / poll filter on the document
+
+class NotificationService:
+    def __init__(
+        self,
+        db,
+        send: Callable[..., Awaitable[bool]],
+        sources: List[NotificationSource],
+        rate: float = 20.0,
+        per_chat_interval: float = 1.0,
+        poll_interval: float = 2.0,
+        poll_settle: float = 5.0,
+        log_retention: int = 7 * 24 * 3600,
+        max_attempts: int = 3,
+        retry_delay: float = 1.0,
+        claim_timeout: float = 60.0,
+    ):
+        self.db = db
+        self.send = send
+        self.sources = sources
+        self.rate = rate
+        self.per_chat_interval = per_chat_interval
+        self.poll_interval = poll_interval
+        self.poll_settle = poll_settle
+        self.log_retention = log_retention
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.claim_timeout = claim_timeout
+        self.cursors = db.notification_cursors
+        self.log = db.notification_log
+
+        self.send_slots: List[float] = []  # reserved send times, sorted
+        self.chat_sent_at: Dict[int, float] = {}
+        self.stats = {"delivered": 0, "duplicates": 0, "failed": 0, "mode": "stream"}
+
+    async def run(self):
+        try:
+            await self.log.create_index("created_at", expireAfterSeconds=self.log_retention)
+        except Exception as e:
+            logging.error(f"Failed to create notification_log index: {e}")
+        await asyncio.gather(*(self.run_source(source) for source in self.sources))
+
+    async def run_source(self, source: NotificationSource):
+        while True:
+            try:
+                if self.stats["mode"] == "stream":
+                    await self.watch(source)
+                else:
+                    await self.poll(source)
+            except asyncio.CancelledError:
+                raise
+            except OperationFailure as e:
+                if e.code == CHANGE_STREAMS_UNSUPPORTED:
+                    logging.warning("Change streams are not supported, polling for notifications")
+                    self.stats["mode"] = "poll"
+                    continue
+                logging.error(f"Notification source {source.name} failed: {e}")
+                await asyncio.sleep(self.poll_interval)
+            except Exception as e:
+                logging.error(f"Notification source {source.name} failed: {e}")
+                await asyncio.sleep(self.poll_interval)
+
+    async def watch(self, source: NotificationSource):
+        cursor = await self.cursors.find_one({"_id": source.name}) or {}
+        pipeline = [{"$match": {
+            "operationType": source.operation,
+            **{f"fullDocument.{field}": value for field, value in source.match.items()}
+        }}]
+        collection = self.db[source.collection]
+        async with collection.watch(pipeline, full_document="updateLookup", resume_after=cursor.get("resume_token")) as stream:
+            async for change in stream:
+                document = change.get("fullDocument")
+                if document:
+                    await self.handle(source, document)
+                await self.cursors.update_one(
+                    {"_id": source.name},
+                    {"$set": {"resume_token": stream.resume_token, "updated_at": datetime.utcnow()}},
+                    upsert=True
+                )
+
+    async def poll(self, source: NotificationSource):
+        # _id растёт в порядке создания документов, время изменения есть только в поле документа
+        field = "_id" if source.operation == "insert" else source.timestamp_field
+        cursor = await self.cursors.find_one({"_id": source.name}) or {}
+        since = cursor.get("polled_until") or datetime.utcnow()
+        if field == "_id" and isinstance(since, datetime):
+            since = ObjectId.from_datetime(since)
+        while True:
+            # Документы моложе poll_settle могут быть ещё не записаны теми, кто создал их раньше
+            settled = datetime.utcnow() - timedelta(seconds=self.poll_settle)
+            until = ObjectId.from_datetime(settled) if field == "_id" else settled
+            documents = await self.db[source.collection].find(
+                {field: {"$gt": since, "$lt": until}, **source.match}
+            ).sort(field, 1).to_list(100)
+            for document in documents:
+                await self.handle(source, document)
+                since = document[field]
+                await self.cursors.update_one(
+                    {"_id": source.name},
+                    {"$set": {"polled_until": since, "updated_at": datetime.utcnow()}},
+                    upsert=True
+                )
+            if not documents:
+                await asyncio.sleep(self.poll_interval)
+
+    async def claim(self, notification: Notification) -> bool:
+        """Record the event as pending; False if it is delivered or being delivered elsewhere"""
+        now = datetime.utcnow()
+        try:
+            await self.log.insert_one({
+                "_id": notification.event_id,
+                "chat_id": notification.chat_id,
+                "status": "pending",
+                "claimed_at": now,
+                "created_at": now,
+            })
+            return True
+        except DuplicateKeyError:
+            # Отправку, начатую упавшим процессом, забираем после claim_timeout
+            result = await self.log.update_one(
+                {"_id": notification.event_id, "status": "pending", "claimed_at": {"$lt": now - timedelta(seconds=self.claim_timeout)}},
+                {"$set": {"claimed_at": now}}
+            )
+            return bool(result.modified_count)
+
+    async def handle(self, source: NotificationSource, document: Dict[str, Any]):
+        notification = source.derive(document)
+        if notification is None:
+            return
+        if not await self.claim(notification):
+            self.stats["duplicates"] += 1
+            return
+
+        for attempt in range(self.max_attempts):
+            if attempt:
+                await asyncio.sleep(self.retry_delay * 2 ** (attempt - 1))
+            if await self.deliver(notification):
+                self.stats["delivered"] += 1
+                await self.log.update_one(
+                    {"_id": notification.event_id},
+                    {"$set": {"status": "delivered", "delivered_at": datetime.utcnow()}}
+                )
+                return
+
+        self.stats["failed"] += 1
+        logging.error(f"Notification {notification.event_id} was not delivered after {self.max_attempts} attempts")
+        # Без записи в журнале событие будет отправлено при повторе потока или другим процессом
+        await self.log.delete_one({"_id": notification.event_id, "status": "pending"})
+
+    def reserve(self, now: float, ready_at: float) -> float:
+        """Earliest send time from ready_at at least 1/rate away from every reserved one"""
+        gap = 1.0 / self.rate
+        slots = self.send_slots
+        del slots[:bisect.bisect_left(slots, now - gap)]
+        send_at = ready_at
+        i = bisect.bisect_right(slots, send_at - gap)
+        while i < len(slots) and slots[i] < send_at + gap:
+            send_at = slots[i] + gap
+            i += 1
+        slots.insert(i, send_at)
+        return send_at
+
+    async def deliver(self, notification: Notification) -> bool:
+        # Резервирование без await не прерывается другими отправками, ждём уже вне его
+        now = time.monotonic()
+        ready_at = max(now, self.chat_sent_at.get(notification.chat_id, 0.0) + self.per_chat_interval)
+        send_at = self.reserve(now, ready_at)
+        self.chat_sent_at[notification.chat_id] = send_at
+        if len(self.chat_sent_at) > 10000:
+            cutoff = now - self.per_chat_interval
+            self.chat_sent_at = {chat: at for chat, at in self.chat_sent_at.items() if at > cutoff}
+        if send_at > now:
+            await asyncio.sleep(send_at - now)
+
+        return await self.send(notification.chat_id, notification.text, reply_markup=notification.reply_markup)
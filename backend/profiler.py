@@ -0,0 +1,108 @@
+"""Production profiling hooks.
+
+* sample_stacks() - sampling profiler: a helper thread snapshots the stacks of
+  all other threads every interval seconds for a bounded duration and folds
+  them into "frame;frame;frame count" lines (flamegraph.pl / speedscope
+  collapsed format). Nothing runs between profiles.
+* LoopLagMonitor - a coroutine wakes up every interval and measures how late
+  it was woken; a watchdog thread notices when the loop stopped ticking and
+  captures the loop thread's stack while it is still blocked, so the stall is
+  reported together with the code that caused it.
+"""
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import Counter, deque
+from typing import Any, Callable, Deque, Dict, List, Optional
+
+def frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+def fold_stack(frame, root: str) -> str:
+    labels = []
+    while frame is not None:
+        labels.append(frame_label(frame))
+        frame = frame.f_back
+    labels.append(root)
+    return ";".join(reversed(labels))
+
+def sample_stacks(duration: float, interval: float = 0.005) -> str:
+    """Blocking: sample every thread except the caller for duration seconds"""
+    own_id = threading.get_ident()
+    samples: Counter = Counter()
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id != own_id:
+                samples[fold_stack(frame, names.get(thread_id, str(thread_id)))] += 1
+        time.sleep(interval)
+    return "".join(f"{stack} {count}\n" for stack, count in samples.most_common())
+
+class LoopLagMonitor:
+    def __init__(self, interval: float = 0.1, threshold: float = 0.25, history: int = 50):
+        self.interval = interval
+        self.threshold = threshold
+        self.stalls: Deque[Dict[str, Any]] = deque(maxlen=history)
+        # observer(lag) after every tick
+        self.observers: List[Callable[[float], None]] = []
+        self.stats = {"ticks": 0, "stalls": 0, "lag_last": 0.0, "lag_max": 0.0}
+
+        self.loop_thread_id: Optional[int] = None
+        self.heartbeat = time.monotonic()
+        self.captured_heartbeat: Optional[float] = None
+        self.captured: Optional[Dict[str, Any]] = None
+        self.stopped = threading.Event()
+
+    def capture(self, loop: asyncio.AbstractEventLoop) -> Dict[str, Any]:
+        frame = sys._current_frames().get(self.loop_thread_id)
+        task = asyncio.current_task(loop)
+        return {
+            "task": task.get_name() if task else None,
+            "coroutine": repr(task.get_coro()) if task else None,
+            "stack": "".join(traceback.format_stack(frame)) if frame else "",
+        }
+
+    def watch(self, loop: asyncio.AbstractEventLoop):
+        """Watchdog thread: capture the loop thread's stack while it is blocked"""
+        while not self.stopped.wait(self.threshold / 2):
+            heartbeat = self.heartbeat
+            if heartbeat != self.captured_heartbeat and time.monotonic() - heartbeat > self.interval + self.threshold:
+                self.captured_heartbeat = heartbeat
+                self.captured = self.capture(loop)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        self.loop_thread_id = threading.get_ident()
+        watchdog = threading.Thread(target=self.watch, args=(loop,), name="loop-lag-watchdog", daemon=True)
+        watchdog.start()
+        try:
+            while True:
+                self.heartbeat = started = time.monotonic()
+                await asyncio.sleep(self.interval)
+                lag = max(0.0, time.monotonic() - started - self.interval)
+                self.record(lag)
+        finally:
+            self.stopped.set()
+
+    def record(self, lag: float):
+        self.stats["ticks"] += 1
+        self.stats["lag_last"] = lag
+        self.stats["lag_max"] = max(self.stats["lag_max"], lag)
+        for observer in self.observers:
+            observer(lag)
+        if lag < self.threshold:
+            return
+
+        captured, self.captured = self.captured, None
+        stall = {"at": time.time(), "lag": round(lag, 4), **(captured or {"task": None, "coroutine": None, "stack": ""})}
+        self.stats["stalls"] += 1
+        self.stalls.append(stall)
+        logging.warning(
+            f"Event loop blocked for {lag:.3f}s in task {stall['task']} {stall['coroutine']}\n{stall['stack']}".rstrip()
+        )
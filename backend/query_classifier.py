@@ -0,0 +1,148 @@
+"""Search query classifier.
+
+classify_query() makes one pass over the query to collect the character
+classes it contains, then runs only the matcher for that profile instead of
+trying every pattern in turn. Alongside the search type it returns the
+canonical form of the query: E.164 phone, lowercased email, uppercased car
+plate and so on.
+"""
+import re
+from typing import NamedTuple, Set
+
+PHONE = "📱 Телефон"
+EMAIL = "📧 Email"
+CAR = "🚗 Автомобиль"
+NICKNAME = "🆔 Никнейм"
+IP = "🌐 IP-адрес"
+ADDRESS = "🏠 Адрес"
+FIO = "👤 ФИО"
+GENERAL = "🔍 Общий поиск"
+
+class QueryClassification(NamedTuple):
+    search_type: str
+    normalized: str
+
+# Character classes
+DIGIT = 1
+LATIN = 2
+CYRILLIC = 4
+SPACE = 8
+AT = 16
+DOT = 32
+PLUS = 64
+PHONE_PUNCT = 128  # - ( )
+UNDERSCORE = 256
+OTHER = 512
+
+def _build_char_classes() -> dict:
+    classes = {}
+    for ch in "0123456789":
+        classes[ch] = DIGIT
+    for ch in "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ":
+        classes[ch] = LATIN
+    for code in range(ord("А"), ord("я") + 1):
+        classes[chr(code)] = CYRILLIC
+    classes["Ё"] = classes["ё"] = CYRILLIC
+    for ch in " \t\n\r\v\f":
+        classes[ch] = SPACE
+    classes["@"] = AT
+    classes["."] = DOT
+    classes["+"] = PLUS
+    for ch in "-()":
+        classes[ch] = PHONE_PUNCT
+    classes["_"] = UNDERSCORE
+    return classes
+
+CHAR_CLASSES = _build_char_classes()
+
+PHONE_PROFILE = DIGIT | SPACE | PLUS | PHONE_PUNCT
+IP_PROFILE = DIGIT | DOT
+NICKNAME_PROFILE = DIGIT | LATIN | UNDERSCORE
+PLATE_PROFILE = DIGIT | CYRILLIC | SPACE
+WORDS_PROFILE = LATIN | CYRILLIC | SPACE
+
+PHONE_RE = re.compile(r'\+?\d{10,15}')
+EMAIL_RE = re.compile(r'[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}')
+PLATE_RE = re.compile(r'[АВЕКМНОРСТУХ]\d{3}[АВЕКМНОРСТУХ]{2}\d{2,3}')
+IP_RE = re.compile(r'\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}')
+WORD_SPLIT_RE = re.compile(r'[^0-9a-zа-яё]+')
+
+PHONE_STRIP_TABLE = str.maketrans("", "", " -()")
+
+# Address keywords are matched as whole words: "д" or "ул" inside a surname is not an address
+ADDRESS_KEYWORDS: Set[str] = {
+    'улица', 'ул', 'проспект', 'пр', 'переулок', 'пер', 'дом', 'д', 'квартира', 'кв'
+}
+
+def char_profile(query: str) -> int:
+    """Bitmask of character classes present in query"""
+    profile = 0
+    classes = CHAR_CLASSES
+    for ch in query:
+        profile |= classes.get(ch, OTHER)
+    return profile
+
+def normalize_phone(query: str) -> str:
+    """Phone in E.164 form, Russian 8XXXXXXXXXX and 9XXXXXXXXX without "+" mapped to +7"""
+    digits = query.translate(PHONE_STRIP_TABLE)
+    if digits.startswith('+'):
+        # С "+" номер уже международный: +9613123456 - Ливан, а не +7 961...
+        return '+' + digits.lstrip('+')
+    if len(digits) == 11 and digits[0] == '8':
+        return '+7' + digits[1:]
+    if len(digits) == 10 and digits[0] == '9':
+        return '+7' + digits
+    return '+' + digits
+
+def normalize_ip(query: str) -> str:
+    return '.'.join(str(int(octet)) for octet in query.split('.'))
+
+def _classify_words(query: str, profile: int) -> QueryClassification:
+    """Classify free text: car plate, address, full name or general search"""
+    if not profile & ~PLATE_PROFILE and profile & DIGIT:
+        plate = query.upper().replace(' ', '')
+        if PLATE_RE.fullmatch(plate):
+            return QueryClassification(CAR, plate)
+
+    words = query.split()
+    normalized = ' '.join(words)
+    tokens = WORD_SPLIT_RE.split(query.lower())
+    if ADDRESS_KEYWORDS.intersection(tokens):
+        return QueryClassification(ADDRESS, normalized)
+
+    if 2 <= len(words) <= 3 and not profile & ~WORDS_PROFILE:
+        return QueryClassification(FIO, ' '.join(word.capitalize() for word in words))
+
+    return QueryClassification(GENERAL, normalized)
+
+def classify_query(query: str) -> QueryClassification:
+    """Detect search type of query and return it with the normalized query"""
+    query = query.strip()
+    if not query:
+        return QueryClassification(GENERAL, query)
+
+    profile = char_profile(query)
+
+    if profile & AT:
+        if query[0] == '@':
+            return QueryClassification(NICKNAME, query[1:].lower())
+        if EMAIL_RE.fullmatch(query):
+            return QueryClassification(EMAIL, query.lower())
+        return _classify_words(query, profile)
+
+    if not profile & ~PHONE_PROFILE:
+        if PHONE_RE.fullmatch(query.translate(PHONE_STRIP_TABLE)):
+            return QueryClassification(PHONE, normalize_phone(query))
+        if profile == DIGIT:
+            return QueryClassification(NICKNAME, query)
+        return QueryClassification(GENERAL, ' '.join(query.split()))
+
+    if not profile & ~NICKNAME_PROFILE:
+        return QueryClassification(NICKNAME, query.lower())
+
+    if not profile & ~IP_PROFILE:
+        if IP_RE.fullmatch(query):
+            return QueryClassification(IP, normalize_ip(query))
+        return QueryClassification(GENERAL, query)
+
+    return _classify_words(query, profile)
@@ -0,0 +1,49 @@
+"""In-memory sliding-window rate limiting.
+
+The window is approximated from two fixed windows: the count of the current
+window plus the count of the previous one weighted by how much of it still
+overlaps the sliding window. A check is O(1) in time and keeps three numbers
+per key; the least recently seen keys are evicted beyond max_keys.
+"""
+import time
+from collections import OrderedDict
+from typing import Hashable, Optional
+
+class SlidingWindowLimiter:
+    def __init__(self, limit: int, window: float, max_keys: int = 100000):
+        self.limit = limit
+        self.window = window
+        self.max_keys = max_keys
+        self.entries: "OrderedDict[Hashable, list]" = OrderedDict()  # key -> [window index, current, previous, notified window]
+
+    def _entry(self, key: Hashable, now: float) -> tuple:
+        index, offset = divmod(now, self.window)
+        entry = self.entries.get(key)
+        if entry is None:
+            entry = [index, 0, 0, -1]
+            self.entries[key] = entry
+            if len(self.entries) > self.max_keys:
+                self.entries.popitem(last=False)
+        else:
+            self.entries.move_to_end(key)
+            if entry[0] != index:
+                entry[2] = entry[1] if entry[0] == index - 1 else 0
+                entry[1] = 0
+                entry[0] = index
+        return entry, offset / self.window
+
+    def hit(self, key: Hashable, now: Optional[float] = None) -> bool:
+        """Count one event for key if it fits into the limit. Returns whether it is allowed"""
+        entry, elapsed = self._entry(key, time.monotonic() if now is None else now)
+        if entry[2] * (1.0 - elapsed) + entry[1] >= self.limit:
+            return False
+        entry[1] += 1
+        return True
+
+    def notify_once(self, key: Hashable) -> bool:
+        """True the first time it is called for key within the current window"""
+        entry = self.entries.get(key)
+        if entry is None or entry[3] == entry[0]:
+            return False
+        entry[3] = entry[0]
+        return True
@@ -0,0 +1,287 @@
+"""usersbox result formatting.
+
+Field names from usersbox items are mapped to display labels through the
+declarative FIELD_MAPPING table, compiled once into a dict. Items are
+rendered by per-source renderers (SOURCE_RENDERERS, falling back to the
+mapping-based default), and values are Markdown-escaped with a single
+str.translate pass. The same source iteration feeds the inline Telegram
+message and the streamed TXT/CSV/HTML result files.
+"""
+import csv
+import html
+import io
+import tempfile
+import zipfile
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Tuple
+
+# Inline message shows this many sources and items per source, the rest goes to a file
+INLINE_MAX_SOURCES = 5
+INLINE_MAX_ITEMS = 2
+SUMMARY_MAX_SOURCES = 10
+MAX_NESTING_DEPTH = 8
+
+RESULTS_FILE_SPOOL_SIZE = 1024 * 1024  # larger archives are spooled to disk
+
+DATABASE_NAMES = {
+    'yandex': '🟡 Яндекс',
+    'avito': '🟢 Авито',
+    'vk': '🔵 ВКонтакте',
+    'ok': '🟠 Одноклассники',
+    'delivery_club': '🍕 Delivery Club',
+    'cdek': '📦 СДЭК'
+}
+
+GENDER_MAP = {'1': 'Ж', '2': 'М', 'male': 'М', 'female': 'Ж'}
+
+# (label, value transform, field names) - field names are matched case-insensitively
+FIELD_MAPPING: List[Tuple[str, Callable[[str], str], Tuple[str, ...]]] = [
+    ("📞", str, ('phone', 'телефон', 'tel', 'mobile')),
+    ("📧", str, ('email', 'почта', 'mail', 'e_mail')),
+    ("👤", str, ('full_name', 'name', 'имя', 'фио', 'first_name', 'last_name')),
+    ("🎂", str, ('birth_date', 'birthday', 'дата_рождения', 'bdate')),
+    ("🏠", str, ('address', 'адрес', 'city', 'город')),
+    ("⚥", lambda value: GENDER_MAP.get(value, value), ('sex', 'gender', 'пол')),
+]
+
+def compile_field_mapping(mapping) -> Dict[str, Tuple[str, Callable[[str], str]]]:
+    """Build field name -> (label, transform) lookup"""
+    compiled = {}
+    for label, transform, names in mapping:
+        for name in names:
+            compiled[name.lower()] = (label, transform)
+    return compiled
+
+FIELD_LABELS = compile_field_mapping(FIELD_MAPPING)
+
+MARKDOWN_ESCAPE_TABLE = str.maketrans({ch: '\\' + ch for ch in '_*`['})
+CODE_ESCAPE_TABLE = str.maketrans({'`': "'"})
+
+def escape_markdown(text: Any) -> str:
+    """Escape Telegram Markdown entities in text"""
+    return str(text).translate(MARKDOWN_ESCAPE_TABLE)
+
+def escape_code(text: Any) -> str:
+    """Make text safe inside `code` entity, where escaping is not possible"""
+    return str(text).translate(CODE_ESCAPE_TABLE)
+
+def database_display_name(source: Dict[str, Any]) -> str:
+    database = source.get('database', '')
+    return DATABASE_NAMES.get(database, f"📊 {database or 'N/A'}")
+
+def iter_result_sources(results: Dict[str, Any]) -> Iterator[Tuple[int, Dict[str, Any], int, List[Dict[str, Any]]]]:
+    """Yield (index, source, hits count, items) for every source of usersbox response"""
+    items = results.get('data', {}).get('items')
+    if not isinstance(items, list):
+        return
+    for i, source_data in enumerate(items, 1):
+        if 'source' in source_data and 'hits' in source_data:
+            hits = source_data['hits']
+            yield i, source_data['source'], hits.get('hitsCount', hits.get('count', 0)), hits.get('items') or []
+
+def flatten_value(value: Any, depth: int = 0) -> Iterator[str]:
+    """Yield scalar leaves of nested value"""
+    if isinstance(value, dict):
+        if depth < MAX_NESTING_DEPTH:
+            for nested in value.values():
+                yield from flatten_value(nested, depth + 1)
+    elif isinstance(value, list):
+        if depth < MAX_NESTING_DEPTH:
+            for nested in value:
+                yield from flatten_value(nested, depth + 1)
+    elif value is not None and value != '':
+        yield str(value)
+
+def iter_item_fields(item: Dict[str, Any], prefix: str = '', depth: int = 0) -> Iterator[Tuple[str, str]]:
+    """Yield all (field path, value) pairs of a result item, nested fields as dotted paths"""
+    for key, value in item.items():
+        if key.startswith('_'):
+            continue
+        path = f"{prefix}{key}"
+        if isinstance(value, dict) and depth < MAX_NESTING_DEPTH:
+            yield from iter_item_fields(value, f"{path}.", depth + 1)
+        elif isinstance(value, list) and depth < MAX_NESTING_DEPTH and any(isinstance(v, dict) for v in value):
+            for index, nested in enumerate(value):
+                if isinstance(nested, dict):
+                    yield from iter_item_fields(nested, f"{path}.{index}.", depth + 1)
+                else:
+                    yield f"{path}.{index}", str(nested)
+        elif isinstance(value, list):
+            yield path, ", ".join(flatten_value(value, depth))
+        else:
+            yield path, str(value)
+
+def iter_labeled_fields(item: Dict[str, Any], depth: int = 0) -> Iterator[Tuple[str, str]]:
+    """Yield (label, value) for mapped fields of item, looking into nested objects of unmapped fields"""
+    for key, value in item.items():
+        if key.startswith('_'):
+            continue
+        mapped = FIELD_LABELS.get(key.lower())
+        if mapped:
+            label, transform = mapped
+            if isinstance(value, (dict, list)):
+                value = ", ".join(flatten_value(value, depth))
+                if not value:
+                    continue
+            yield label, transform(str(value))
+        elif isinstance(value, dict) and depth < MAX_NESTING_DEPTH:
+            yield from iter_labeled_fields(value, depth + 1)
+        elif isinstance(value, list) and depth < MAX_NESTING_DEPTH:
+            for nested in value:
+                if isinstance(nested, dict):
+                    yield from iter_labeled_fields(nested, depth + 1)
+
+def render_items_default(source: Dict[str, Any], items: List[Dict[str, Any]]) -> List[str]:
+    """Render items of a source as Markdown lines with labeled known fields"""
+    return [
+        f"{label} {escape_markdown(value)}\n"
+        for item in items
+        for label, value in iter_labeled_fields(item)
+    ]
+
+# database -> renderer(source, items) returning Markdown lines
+SOURCE_RENDERERS: Dict[str, Callable[[Dict[str, Any], List[Dict[str, Any]]], List[str]]] = {}
+
+def register_source_renderer(database: str):
+    """Register item renderer for usersbox database"""
+    def decorator(renderer):
+        SOURCE_RENDERERS[database] = renderer
+        return renderer
+    return decorator
+
+def format_search_results(results: Dict[str, Any], query: str, search_type: str) -> str:
+    """Format usersbox API results for Telegram"""
+    if results.get('status') == 'error':
+        return f"❌ *Ошибка:* {escape_markdown(results.get('error', {}).get('message', 'Неизвестная ошибка'))}"
+
+    data = results.get('data', {})
+    total_count = data.get('count', 0)
+    query = escape_code(query)
+
+    if total_count == 0:
+        return f"🔍 *Поиск:* `{query}`\n{search_type}\n\n❌ *Результатов не найдено*\n\n💡 *Попробуйте изменить формат запроса*"
+
+    parts = [
+        "🎯 *РЕЗУЛЬТАТЫ ПОИСКА*\n\n",
+        f"🔍 *Запрос:* `{query}`\n",
+        f"📂 *Тип:* {search_type}\n",
+        f"📊 *Найдено:* {total_count} записей\n\n"
+    ]
+
+    if isinstance(data.get('items'), list):
+        parts.append("📋 *ДАННЫЕ ИЗ БАЗ:*\n\n")
+
+        for i, source, hits_count, items in iter_result_sources(results):
+            if i > INLINE_MAX_SOURCES:
+                break
+            parts.append(f"*{i}. {escape_markdown(database_display_name(source))}*\n")
+            parts.append(f"📁 База: {escape_markdown(source.get('collection', 'N/A'))}\n")
+            parts.append(f"🔢 Записей: {hits_count}\n")
+
+            if items:
+                renderer = SOURCE_RENDERERS.get(source.get('database', ''), render_items_default)
+                parts.append("💾 *Данные:*\n")
+                parts.extend(renderer(source, items[:INLINE_MAX_ITEMS]))
+
+            parts.append("\n")
+
+    parts.append("━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\n")
+    parts.append("🔒 *Конфиденциальность:* Используйте данные ответственно")
+
+    return "".join(parts)
+
+def results_fit_inline(results: Dict[str, Any]) -> bool:
+    """Whether format_search_results shows the whole response"""
+    if results.get('status') != 'success':
+        return True
+    for i, source, hits_count, items in iter_result_sources(results):
+        if i > INLINE_MAX_SOURCES or len(items) > INLINE_MAX_ITEMS:
+            return False
+    return True
+
+def format_search_summary(results: Dict[str, Any], query: str, search_type: str) -> str:
+    """Short inline summary for results delivered as a file"""
+    data = results.get('data', {})
+    sources = list(iter_result_sources(results))
+
+    parts = [
+        "🎯 *РЕЗУЛЬТАТЫ ПОИСКА*\n\n",
+        f"🔍 *Запрос:* `{escape_code(query)}`\n",
+        f"📂 *Тип:* {search_type}\n",
+        f"📊 *Найдено:* {data.get('count', 0)} записей\n",
+        f"🗄️ *Источников:* {len(sources)}\n\n"
+    ]
+    for i, source, hits_count, items in sources[:SUMMARY_MAX_SOURCES]:
+        parts.append(f"• {escape_markdown(database_display_name(source))} — {hits_count}\n")
+    if len(sources) > SUMMARY_MAX_SOURCES:
+        parts.append(f"• ... и еще {len(sources) - SUMMARY_MAX_SOURCES}\n")
+
+    parts.append("\n📄 *Полные результаты — в файле*")
+    return "".join(parts)
+
+ResultEntries = Iterable[Tuple[str, str, Dict[str, Any]]]
+
+def iter_results_txt(entries: ResultEntries) -> Iterator[str]:
+    """Render (query, search type, results) entries as plain text"""
+    yield f"УЗРИ - РЕЗУЛЬТАТЫ ПОИСКА\n{datetime.utcnow().strftime('%d.%m.%Y %H:%M')} UTC\n"
+    for query, search_type, results in entries:
+        yield f"\n{'=' * 40}\nЗапрос: {query}\nТип: {search_type}\n"
+        if results.get('status') != 'success':
+            yield f"Ошибка: {results.get('error', {}).get('message', 'Неизвестная ошибка')}\n"
+            continue
+        yield f"Найдено: {results.get('data', {}).get('count', 0)} записей\n{'=' * 40}\n"
+        for i, source, hits_count, items in iter_result_sources(results):
+            yield f"\n{i}. {database_display_name(source)} / {source.get('collection', 'N/A')} ({hits_count})\n"
+            for item in items:
+                yield "".join(f"   {key}: {value}\n" for key, value in iter_item_fields(item)) + "   ---\n"
+
+def iter_results_csv(entries: ResultEntries) -> Iterator[str]:
+    """Render entries as CSV, one row per field of every item"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(["query", "search_type", "source", "database", "collection", "item", "field", "value"])
+    for query, search_type, results in entries:
+        for i, source, hits_count, items in iter_result_sources(results):
+            for item_index, item in enumerate(items, 1):
+                for key, value in iter_item_fields(item):
+                    writer.writerow([query, search_type, i, source.get('database', ''), source.get('collection', ''), item_index, key, value])
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate(0)
+    yield buffer.getvalue()
+
+def iter_results_html(entries: ResultEntries) -> Iterator[str]:
+    """Render entries as standalone HTML page"""
+    yield "<!DOCTYPE html><html><head><meta charset=\"utf-8\"><title>УЗРИ - результаты поиска</title>"
+    yield "<style>body{font-family:sans-serif}table{border-collapse:collapse;margin-bottom:12px}td{border:1px solid #ccc;padding:2px 6px}</style></head><body>"
+    for query, search_type, results in entries:
+        yield f"<h2>{html.escape(query)}</h2><p>{html.escape(search_type)}</p>"
+        if results.get('status') != 'success':
+            yield f"<p>Ошибка: {html.escape(str(results.get('error', {}).get('message', 'Неизвестная ошибка')))}</p>"
+            continue
+        for i, source, hits_count, items in iter_result_sources(results):
+            yield f"<h3>{i}. {html.escape(database_display_name(source))} / {html.escape(str(source.get('collection', 'N/A')))} ({hits_count})</h3>"
+            for item in items:
+                rows = "".join(f"<tr><td>{html.escape(key)}</td><td>{html.escape(value)}</td></tr>" for key, value in iter_item_fields(item))
+                yield f"<table>{rows}</table>"
+    yield "</body></html>"
+
+RESULT_FILE_RENDERERS = {
+    "txt": iter_results_txt,
+    "csv": iter_results_csv,
+    "html": iter_results_html
+}
+
+def build_results_archive(entries: ResultEntries, file_format: str = "txt") -> Tuple[str, Any]:
+    """Stream rendered results into a zip archive. Returns (file name, file object)"""
+    if file_format not in RESULT_FILE_RENDERERS:
+        file_format = "txt"
+    name = f"uzri_results_{datetime.utcnow().strftime('%Y%m%d_%H%M%S')}"
+
+    spool = tempfile.SpooledTemporaryFile(max_size=RESULTS_FILE_SPOOL_SIZE)
+    with zipfile.ZipFile(spool, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        with io.TextIOWrapper(archive.open(f"{name}.{file_format}", 'w'), encoding='utf-8', newline='') as output:
+            for chunk in RESULT_FILE_RENDERERS[file_format](entries):
+                output.write(chunk)
+    spool.seek(0)
+    return f"{name}.zip", spool
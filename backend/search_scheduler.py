@@ -0,0 +1,124 @@
+"""Fair scheduling of upstream searches.
+
+At most max_concurrency searches run at once and each user has at most
+per_user_limit of them in flight. Waiting searches are ordered by start-time
+fair queuing: every search gets a virtual start tag
+
+    start = max(virtual_time, finish tag of the user's previous search)
+    finish = start + 1 / weight(tier)
+
+and the waiter with the smallest start tag runs next. A user submitting many
+searches gets increasing tags and so cannot push ahead of others, while a
+tier with a higher weight advances its tags more slowly and gets a
+proportionally larger share of the slots.
+"""
+import asyncio
+import heapq
+import itertools
+import time
+from collections import defaultdict, deque
+from contextlib import asynccontextmanager
+from typing import Any, Dict, List
+
+def parse_tier_weights(spec: str) -> Dict[str, float]:
+    """Parse "tier:weight,tier:weight" into a dict"""
+    weights = {}
+    for item in spec.split(','):
+        if ':' in item:
+            tier, weight = item.split(':', 1)
+            weights[tier.strip()] = float(weight)
+    return weights
+
+class SearchScheduler:
+    def __init__(self, max_concurrency: int, per_user_limit: int, weights: Dict[str, float], wait_samples: int = 500):
+        self.max_concurrency = max_concurrency
+        self.per_user_limit = per_user_limit
+        self.weights = weights
+
+        self.virtual_time = 0.0
+        self.running = 0
+        self.queue: List[tuple] = []  # (start tag, seq, user_id, tier, future, enqueued_at)
+        self.blocked: Dict[int, List[tuple]] = defaultdict(list)  # waiters of users at their in-flight limit
+        self.in_flight: Dict[int, int] = defaultdict(int)
+        self.waiting: Dict[int, int] = defaultdict(int)
+        self.user_finish: Dict[int, float] = {}
+        self.sequence = itertools.count()
+
+        self.dispatched: Dict[str, int] = defaultdict(int)
+        self.waits: Dict[str, deque] = defaultdict(lambda: deque(maxlen=wait_samples))
+
+    def _enqueue(self, user_id: int, tier: str) -> asyncio.Future:
+        start = max(self.virtual_time, self.user_finish.get(user_id, 0.0))
+        self.user_finish[user_id] = start + 1.0 / self.weights.get(tier, 1.0)
+        future = asyncio.get_running_loop().create_future()
+        self.waiting[user_id] += 1
+        heapq.heappush(self.queue, (start, next(self.sequence), user_id, tier, future, time.monotonic()))
+        return future
+
+    def _dispatch(self):
+        while self.running < self.max_concurrency and self.queue:
+            entry = heapq.heappop(self.queue)
+            start, _, user_id, tier, future, enqueued_at = entry
+            if future.cancelled():
+                self.waiting[user_id] -= 1
+                self._forget_idle(user_id)
+                continue
+            if self.in_flight[user_id] >= self.per_user_limit:
+                self.blocked[user_id].append(entry)
+                continue
+            self.waiting[user_id] -= 1
+            self.virtual_time = max(self.virtual_time, start)
+            self.running += 1
+            self.in_flight[user_id] += 1
+            self.dispatched[tier] += 1
+            self.waits[tier].append(time.monotonic() - enqueued_at)
+            future.set_result(None)
+
+    def _release(self, user_id: int):
+        self.running -= 1
+        self.in_flight[user_id] -= 1
+        for entry in self.blocked.pop(user_id, ()):
+            heapq.heappush(self.queue, entry)
+        self._forget_idle(user_id)
+        self._dispatch()
+
+    def _forget_idle(self, user_id: int):
+        """Drop per-user state once the user has nothing queued or running"""
+        if not self.in_flight.get(user_id) and not self.waiting.get(user_id):
+            self.in_flight.pop(user_id, None)
+            self.waiting.pop(user_id, None)
+            self.user_finish.pop(user_id, None)
+
+    @asynccontextmanager
+    async def slot(self, user_id: int, tier: str):
+        """Wait for a search slot of user_id and hold it for the block"""
+        future = self._enqueue(user_id, tier)
+        self._dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self._release(user_id)
+            raise
+        try:
+            yield
+        finally:
+            self._release(user_id)
+
+    def stats(self) -> Dict[str, Any]:
+        tiers = {}
+        for tier, waits in self.waits.items():
+            ordered = sorted(waits)
+            tiers[tier] = {
+                "dispatched": self.dispatched[tier],
+                "wait_p50": round(ordered[len(ordered) // 2], 4) if ordered else None,
+                "wait_p95": round(ordered[min(len(ordered) - 1, int(0.95 * len(ordered)))], 4) if ordered else None,
+            }
+        return {
+            "running": self.running,
+            "queued": sum(1 for entry in self.queue if not entry[4].cancelled()) + sum(map(len, self.blocked.values())),
+            "max_concurrency": self.max_concurrency,
+            "per_user_limit": self.per_user_limit,
+            "users_in_flight": len(self.in_flight),
+            "tiers": tiers,
+        }
@@ -1,11 +1,15 @@
 from fastapi import FastAPI, APIRouter, HTTPException, Request, Query
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import PlainTextResponse
 from motor.motor_asyncio import AsyncIOMotorClient
 import os
+import asyncio
 import logging
 import requests
 import json
+import csv
+import io
 import hashlib
 import secrets
 from pathlib import Path
@@ -14,6 +18,25 @@ from typing import List, Optional, Dict, Any
 from datetime import datetime, timedelta
 import uuid
 import re
+import time
+from functools import partial, wraps
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from contextvars import ContextVar
+from requests.adapters import HTTPAdapter
+from query_classifier import classify_query, QueryClassification
+from result_formatter import format_search_results, format_search_summary, results_fit_inline, build_results_archive
+from circuit_breaker import STATE_CODES, CircuitBreaker, CircuitOpenError, UpstreamStatusError
+from search_scheduler import SearchScheduler, parse_tier_weights
+from rate_limiter import SlidingWindowLimiter
+from update_broker import UpdateBroker
+from invalidation_bus import FLUSH_ALL, InvalidationBus, MongoInvalidationBus, SocketInvalidationBus
+from notification_service import Notification, NotificationService, NotificationSource
+from instrumented_db import InstrumentedDatabase
+from metrics import MetricsRegistry, timed
+from tracing import OTLPJsonExporter, Tracer
+from profiler import LoopLagMonitor, sample_stacks
+from update_recorder import UpdateRecorder
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
@@ -21,7 +44,9 @@ load_dotenv(ROOT_DIR / '.env')
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
 client = AsyncIOMotorClient(mongo_url)
-db = client[os.environ['DB_NAME']]
+# Every round-trip is reported to db_observers (metrics)
+db_observers = []
+db = InstrumentedDatabase(client[os.environ['DB_NAME']], db_observers)
 
 # API Configuration
 TELEGRAM_TOKEN = os.environ['TELEGRAM_TOKEN']
@@ -34,6 +59,145 @@ ADMIN_USERNAME = os.environ['ADMIN_USERNAME']
 REQUIRED_CHANNEL = os.environ['REQUIRED_CHANNEL']
 BOT_USERNAME = os.environ.get('BOT_USERNAME', 'search1_test_bot')
 
+# Callback handlers slower than this are logged as slow (seconds)
+CALLBACK_SLOW_THRESHOLD = float(os.environ.get('CALLBACK_SLOW_THRESHOLD', '1.0'))
+
+# How long the callback acknowledgement waits for a handler toast (seconds)
+CALLBACK_TOAST_WINDOW = float(os.environ.get('CALLBACK_TOAST_WINDOW', '0.3'))
+
+# Number of menu messages whose content hash is remembered for edit deduplication
+MENU_HASH_CACHE_SIZE = int(os.environ.get('MENU_HASH_CACHE_SIZE', '10000'))
+
+# Per-call timeout for concurrently awaited DB reads and API calls (seconds)
+CONCURRENT_CALL_TIMEOUT = float(os.environ.get('CONCURRENT_CALL_TIMEOUT', '15'))
+
+# Search pricing
+SEARCH_COST = 25.0
+SUBSCRIPTION_DAILY_LIMIT = 12
+
+# Search reservations not renewed for this long are treated as abandoned and released by the sweeper (seconds).
+# Batch searches can run longer, so they renew their reservation every SEARCH_RESERVATION_HEARTBEAT seconds
+SEARCH_RESERVATION_TIMEOUT = float(os.environ.get('SEARCH_RESERVATION_TIMEOUT', '300'))
+SEARCH_RESERVATION_HEARTBEAT = float(os.environ.get('SEARCH_RESERVATION_HEARTBEAT', '60'))
+SEARCH_RESERVATION_SWEEP_INTERVAL = float(os.environ.get('SEARCH_RESERVATION_SWEEP_INTERVAL', '60'))
+
+# Upstream circuit breakers: circuit opens when the error rate over the window reaches the threshold
+UPSTREAM_BREAKER_WINDOW = float(os.environ.get('UPSTREAM_BREAKER_WINDOW', '60'))
+UPSTREAM_BREAKER_MIN_CALLS = int(os.environ.get('UPSTREAM_BREAKER_MIN_CALLS', '10'))
+UPSTREAM_BREAKER_ERROR_RATE = float(os.environ.get('UPSTREAM_BREAKER_ERROR_RATE', '0.5'))
+UPSTREAM_BREAKER_OPEN_DURATION = float(os.environ.get('UPSTREAM_BREAKER_OPEN_DURATION', '30'))
+
+# Hedged usersbox requests: a second identical request is sent when the first one is slower
+# than this percentile of recent latency. Each request earns USERSBOX_HEDGE_RATIO hedge tokens
+# (up to USERSBOX_HEDGE_BURST), each hedge spends one, so hedges stay within that share of traffic.
+# The losing request cannot be aborted and runs to completion; no new hedges are sent while
+# USERSBOX_HEDGE_BURST losers are still holding connections
+USERSBOX_HEDGING = os.environ.get('USERSBOX_HEDGING', 'false').lower() == 'true'
+USERSBOX_HEDGE_PERCENTILE = float(os.environ.get('USERSBOX_HEDGE_PERCENTILE', '0.95'))
+USERSBOX_HEDGE_MIN_DELAY = float(os.environ.get('USERSBOX_HEDGE_MIN_DELAY', '0.5'))
+USERSBOX_HEDGE_RATIO = float(os.environ.get('USERSBOX_HEDGE_RATIO', '0.05'))
+USERSBOX_HEDGE_BURST = float(os.environ.get('USERSBOX_HEDGE_BURST', '5'))
+
+# Upstream search scheduling: global concurrency cap, per-user in-flight limit and
+# weighted fair share of slots per tier (tier = payment method of the search)
+SEARCH_MAX_CONCURRENCY = int(os.environ.get('SEARCH_MAX_CONCURRENCY', '20'))
+SEARCH_PER_USER_IN_FLIGHT = int(os.environ.get('SEARCH_PER_USER_IN_FLIGHT', '2'))
+SEARCH_TIER_WEIGHTS = parse_tier_weights(os.environ.get('SEARCH_TIER_WEIGHTS', 'subscription:3,balance:2,admin:1'))
+
+# Inbound update throttling: events per RATE_LIMIT_WINDOW seconds per user and update type,
+# and for all users together. Payment updates are never throttled
+RATE_LIMIT_WINDOW = float(os.environ.get('RATE_LIMIT_WINDOW', '10'))
+RATE_LIMIT_MESSAGES = int(os.environ.get('RATE_LIMIT_MESSAGES', '8'))
+RATE_LIMIT_CALLBACKS = int(os.environ.get('RATE_LIMIT_CALLBACKS', '15'))
+RATE_LIMIT_GLOBAL = int(os.environ.get('RATE_LIMIT_GLOBAL', '1000'))
+
+# How updates are received: "webhook" (POST /api/webhook/{secret}) or "polling" (getUpdates)
+TELEGRAM_UPDATE_MODE = os.environ.get('TELEGRAM_UPDATE_MODE', 'webhook')
+POLLING_TIMEOUT = int(os.environ.get('POLLING_TIMEOUT', '25'))  # long polling wait, seconds
+POLLING_BATCH_SIZE = int(os.environ.get('POLLING_BATCH_SIZE', '100'))
+POLLING_MAX_IN_FLIGHT = int(os.environ.get('POLLING_MAX_IN_FLIGHT', '1000'))  # polled updates being handled at once
+POLLING_SEEN_UPDATES = int(os.environ.get('POLLING_SEEN_UPDATES', '10000'))  # update_ids remembered to skip redeliveries
+
+# "inline": updates are handled by the process that received them; "sharded": they are put into
+# the Mongo update queue and handled by worker.py processes, each owning a share of the partitions
+UPDATE_PROCESSING_MODE = os.environ.get('UPDATE_PROCESSING_MODE', 'inline')
+UPDATE_PARTITIONS = int(os.environ.get('UPDATE_PARTITIONS', '256'))
+
+# User documents and positive channel membership checks are cached per process.
+# Writes are broadcast to other processes: "local" (single process), "mongo" (change stream,
+# needs a replica set) or "socket" (Unix sockets in INVALIDATION_SOCKET_DIR, same host)
+USER_CACHE_TTL = float(os.environ.get('USER_CACHE_TTL', '60'))
+USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE', '10000'))
+USER_ACTIVITY_WRITE_INTERVAL = float(os.environ.get('USER_ACTIVITY_WRITE_INTERVAL', '60'))  # last_active precision, seconds
+MEMBERSHIP_CACHE_TTL = float(os.environ.get('MEMBERSHIP_CACHE_TTL', '300'))
+CACHE_INVALIDATION_TRANSPORT = os.environ.get('CACHE_INVALIDATION_TRANSPORT', 'local')
+INVALIDATION_SOCKET_DIR = os.environ.get('INVALIDATION_SOCKET_DIR', '/tmp/uzri-cache-invalidation')
+if UPDATE_PROCESSING_MODE == "sharded" and CACHE_INVALIDATION_TRANSPORT not in ("mongo", "socket"):
+    # Воркеры кэшируют пользователей: без шины они списывали бы поиски по устаревшему балансу
+    raise RuntimeError("UPDATE_PROCESSING_MODE=sharded requires CACHE_INVALIDATION_TRANSPORT=mongo or socket")
+
+# Notifications about payments and referrals: messages per second overall and per chat interval
+NOTIFICATION_RATE = float(os.environ.get('NOTIFICATION_RATE', '20'))
+NOTIFICATION_CHAT_INTERVAL = float(os.environ.get('NOTIFICATION_CHAT_INTERVAL', '1.0'))
+
+# Tracing: share of updates exported, span tree of updates slower than the threshold is logged (0 disables)
+TRACE_SAMPLE_RATE = float(os.environ.get('TRACE_SAMPLE_RATE', '0.01'))
+TRACE_SLOW_THRESHOLD = float(os.environ.get('TRACE_SLOW_THRESHOLD', '2.0'))
+TRACE_EXPORT_FILE = os.environ.get('TRACE_EXPORT_FILE', '')  # OTLP/JSON lines
+TRACE_EXPORT_ENDPOINT = os.environ.get('TRACE_EXPORT_ENDPOINT', '')  # e.g. http://localhost:4318/v1/traces
+TRACE_EXPORT_INTERVAL = float(os.environ.get('TRACE_EXPORT_INTERVAL', '5'))
+
+# Profiling: /api/admin/* endpoints require X-Admin-Token (disabled when empty)
+ADMIN_API_TOKEN = os.environ.get('ADMIN_API_TOKEN', '')
+PROFILE_MAX_DURATION = float(os.environ.get('PROFILE_MAX_DURATION', '60'))
+LOOP_LAG_INTERVAL = float(os.environ.get('LOOP_LAG_INTERVAL', '0.1'))
+LOOP_LAG_THRESHOLD = float(os.environ.get('LOOP_LAG_THRESHOLD', '0.25'))  # blocked longer than this is logged with the stack
+
+# Anonymized capture of webhook updates for replay (tests/replay_updates.py), disabled when path is empty
+UPDATE_RECORD_PATH = os.environ.get('UPDATE_RECORD_PATH', '')  # gzip JSON lines, appended
+UPDATE_RECORD_SAMPLE = float(os.environ.get('UPDATE_RECORD_SAMPLE', '1.0'))  # share of users recorded
+UPDATE_RECORD_KEY = os.environ.get('UPDATE_RECORD_KEY', '')  # pseudonym key, random per process if empty
+
+# usersbox result cache: repeated queries within the TTL are not sent upstream again
+SEARCH_CACHE_TTL = float(os.environ.get('SEARCH_CACHE_TTL', '600'))
+SEARCH_CACHE_SIZE = int(os.environ.get('SEARCH_CACHE_SIZE', '5000'))
+
+# Batch search: many queries in one message or .txt/.csv document
+BATCH_MAX_QUERIES = int(os.environ.get('BATCH_MAX_QUERIES', '50'))
+BATCH_CONCURRENCY = int(os.environ.get('BATCH_CONCURRENCY', '5'))
+BATCH_MAX_FILE_SIZE = int(os.environ.get('BATCH_MAX_FILE_SIZE', str(256 * 1024)))
+BATCH_FILE_EXTENSIONS = ('.txt', '.csv')
+
+# Results larger than the inline message limits are delivered as a compressed file
+RESULTS_FILE_FORMAT = os.environ.get('RESULTS_FILE_FORMAT', 'txt')  # "txt", "html", "csv"
+
+# User state expiry (seconds). Abandoned input states are removed by the TTL index
+USER_STATE_DEFAULT_TIMEOUT = int(os.environ.get('USER_STATE_TIMEOUT', '900'))
+USER_STATE_TIMEOUTS = {
+    "waiting_custom_amount_stars": int(os.environ.get('USER_STATE_TIMEOUT_CUSTOM_AMOUNT', '600')),
+    "waiting_custom_amount_crypto": int(os.environ.get('USER_STATE_TIMEOUT_CUSTOM_AMOUNT', '600')),
+}
+
+# Shared HTTP session: keeps connections to Telegram, usersbox and CryptoBot alive
+HTTP_POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', '50'))
+http_session = requests.Session()
+http_session.mount("https://", HTTPAdapter(
+    pool_connections=10,
+    pool_maxsize=HTTP_POOL_SIZE
+))
+
+# Blocking HTTP calls of each upstream run in its own thread pool, so slow searches or
+# the long poll cannot hold the threads that Telegram sends are waiting for.
+# usersbox calls are capped by the search scheduler, plus hedges and their draining losers
+TELEGRAM_HTTP_THREADS = int(os.environ.get('TELEGRAM_HTTP_THREADS', str(HTTP_POOL_SIZE)))
+USERSBOX_HTTP_THREADS = int(os.environ.get('USERSBOX_HTTP_THREADS', str(SEARCH_MAX_CONCURRENCY + 2 * int(USERSBOX_HEDGE_BURST))))
+CRYPTOBOT_HTTP_THREADS = int(os.environ.get('CRYPTOBOT_HTTP_THREADS', '10'))
+telegram_executor = ThreadPoolExecutor(TELEGRAM_HTTP_THREADS, thread_name_prefix="telegram-http")
+usersbox_executor = ThreadPoolExecutor(USERSBOX_HTTP_THREADS, thread_name_prefix="usersbox-http")
+cryptobot_executor = ThreadPoolExecutor(CRYPTOBOT_HTTP_THREADS, thread_name_prefix="cryptobot-http")
+polling_executor = ThreadPoolExecutor(1, thread_name_prefix="telegram-poll")
+upstream_executors = (telegram_executor, usersbox_executor, cryptobot_executor, polling_executor)
+
 # Create the main app
 app = FastAPI(title="УЗРИ - Telegram Bot API")
 
@@ -74,30 +238,254 @@ class Payment(BaseModel):
     payment_id: Optional[str] = None
     status: str = "pending"  # "pending", "completed", "failed"
     created_at: datetime = Field(default_factory=datetime.utcnow)
+    details: Optional[Dict[str, Any]] = None  # данные для уведомления: звезды, ID счета
 
 class Search(BaseModel):
     user_id: int
     query: str
+    normalized_query: Optional[str] = None
     search_type: str
     results: Dict[str, Any]
     timestamp: datetime = Field(default_factory=datetime.utcnow)
     cost: float = 25.0
     success: bool = True
     payment_method: str = "balance"  # "balance", "subscription"
+    batch_id: Optional[str] = None  # общий ID запросов пакетного поиска
+    reservation_id: Optional[str] = None
+    charge_status: str = "committed"  # "committed" - списано, "released" - возвращено
+
+class SearchReservation(BaseModel):
+    """Quota held in users.search_reservations until the search is committed or released"""
+    reservation_id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    payment_method: str  # "balance", "subscription", "admin"
+    units: int = 1  # число поисков
+    amount: float = 0.0  # зарезервированная сумма в рублях
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+    heartbeat_at: Optional[datetime] = None  # последнее продление; до первого считается created_at
 
 class UserState(BaseModel):
     user_id: int
     state: str  # "waiting_custom_amount_stars", "waiting_custom_amount_crypto"
     data: Optional[Dict[str, Any]] = None  # дополнительные данные
     created_at: datetime = Field(default_factory=datetime.utcnow)
+    expires_at: Optional[datetime] = None  # удаляется TTL-индексом после этого момента
 
 class Referral(BaseModel):
     referrer_id: int
     referred_id: int
     timestamp: datetime = Field(default_factory=datetime.utcnow)
     confirmed: bool = False  # Подтвержден ли реферал (подписался ли на канал)
+    confirmed_at: Optional[datetime] = None
+
+class TTLCache:
+    """In-process LRU cache with expiring entries"""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries: "OrderedDict[Any, tuple]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+
+    def get(self, key: Any) -> Optional[Any]:
+        entry = self.entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def get_stale(self, key: Any) -> Optional[Any]:
+        """Entry even if expired; expired entries stay until evicted by size"""
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        self.stale_hits += 1
+        return entry[1]
+
+    def set(self, key: Any, value: Any):
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def delete(self, key: Any):
+        self.entries.pop(key, None)
+
+    def clear(self):
+        self.entries.clear()
+
+search_result_cache = TTLCache(SEARCH_CACHE_SIZE, SEARCH_CACHE_TTL)
+user_cache = TTLCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+membership_cache = TTLCache(USER_CACHE_SIZE, MEMBERSHIP_CACHE_TTL)
+
+def create_invalidation_bus() -> InvalidationBus:
+    if CACHE_INVALIDATION_TRANSPORT == "mongo":
+        return MongoInvalidationBus(db)
+    if CACHE_INVALIDATION_TRANSPORT == "socket":
+        return SocketInvalidationBus(INVALIDATION_SOCKET_DIR)
+    return InvalidationBus()
+
+def cache_invalidator(cache: TTLCache):
+    return lambda key: cache.clear() if key is None else cache.delete(key)
+
+invalidation_bus = create_invalidation_bus()
+invalidation_bus.register("users", cache_invalidator(user_cache))
+invalidation_bus.register("membership", cache_invalidator(membership_cache))
+invalidation_bus.register("search", cache_invalidator(search_result_cache))
+
+def cached_value(cache: TTLCache, key: Any) -> Optional[Any]:
+    """Cache lookup that is bypassed while invalidations may be missed"""
+    if not invalidation_bus.connected:
+        return None
+    return cache.get(key)
+
+def create_upstream_breaker(name: str, max_timeout: float, min_timeout: float, **kwargs) -> CircuitBreaker:
+    return CircuitBreaker(
+        name,
+        max_timeout=max_timeout,
+        min_timeout=min_timeout,
+        window=UPSTREAM_BREAKER_WINDOW,
+        min_calls=UPSTREAM_BREAKER_MIN_CALLS,
+        error_rate_threshold=UPSTREAM_BREAKER_ERROR_RATE,
+        open_duration=UPSTREAM_BREAKER_OPEN_DURATION,
+        **kwargs
+    )
+
+usersbox_breaker = create_upstream_breaker("usersbox", max_timeout=30, min_timeout=3, executor=usersbox_executor)
+# 429 от Telegram - flood control отдельного чата, а не отказ API
+telegram_breaker = create_upstream_breaker(
+    "telegram", max_timeout=10, min_timeout=2, failure_status=lambda status: status >= 500, executor=telegram_executor
+)
+cryptobot_breaker = create_upstream_breaker("cryptobot", max_timeout=30, min_timeout=3, executor=cryptobot_executor)
+upstream_breakers = (usersbox_breaker, telegram_breaker, cryptobot_breaker)
+
+search_scheduler = SearchScheduler(SEARCH_MAX_CONCURRENCY, SEARCH_PER_USER_IN_FLIGHT, SEARCH_TIER_WEIGHTS)
+
+# Metrics (exposed by /api/metrics)
+metrics_registry = MetricsRegistry()
+handler_latency = metrics_registry.histogram(
+    "bot_handler_duration_seconds", "Duration of update handlers", ("handler",)
+)
+handler_errors = metrics_registry.counter(
+    "bot_handler_errors_total", "Exceptions raised by update handlers", ("handler",)
+)
+# Helpers called from inside handlers, kept apart so handler percentiles do not include their sub-calls
+helper_latency = metrics_registry.histogram(
+    "bot_helper_duration_seconds", "Duration of helpers called by update handlers", ("helper",)
+)
+helper_errors = metrics_registry.counter(
+    "bot_helper_errors_total", "Exceptions raised by helpers called by update handlers", ("helper",)
+)
+callback_route_latency = metrics_registry.histogram(
+    "bot_callback_route_duration_seconds", "Duration of callback route handlers", ("route",)
+)
+upstream_latency = metrics_registry.histogram(
+    "bot_upstream_request_duration_seconds", "Duration of upstream API calls", ("upstream", "outcome")
+)
+db_latency = metrics_registry.histogram(
+    "bot_db_operation_duration_seconds", "Duration of MongoDB round-trips",
+    ("collection", "operation"), buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+)
+db_errors = metrics_registry.counter(
+    "bot_db_operation_errors_total", "Failed MongoDB round-trips", ("collection", "operation")
+)
+db_roundtrips_per_update = metrics_registry.histogram(
+    "bot_update_db_roundtrips", "MongoDB round-trips made while handling one update",
+    ("update_type",), buckets=(0, 1, 2, 3, 5, 8, 13, 21, 34)
+)
+
+# Round-trips of the update being handled: [count] set by handle_telegram_update
+update_db_roundtrips: ContextVar[Optional[list]] = ContextVar("update_db_roundtrips", default=None)
+
+def observe_db_operation(collection: str, operation: str, started: float, duration: float, error: Optional[BaseException]):
+    db_latency.observe(duration, collection, operation)
+    if error is not None:
+        db_errors.inc(collection, operation)
+    roundtrips = update_db_roundtrips.get()
+    if roundtrips is not None:
+        roundtrips[0] += 1
+
+def observe_upstream_call(upstream: str, outcome: str, started: float, duration: float, target: str):
+    upstream_latency.observe(duration, upstream, outcome)
+
+db_observers.append(observe_db_operation)
+for breaker in upstream_breakers:
+    breaker.observers.append(observe_upstream_call)
+
+# Tracing: span per update with child spans for DB round-trips and upstream calls
+tracer = Tracer(
+    OTLPJsonExporter(
+        "uzri-bot",
+        path=TRACE_EXPORT_FILE,
+        endpoint=TRACE_EXPORT_ENDPOINT,
+        session=http_session,
+        flush_interval=TRACE_EXPORT_INTERVAL
+    ),
+    sample_rate=TRACE_SAMPLE_RATE,
+    slow_threshold=TRACE_SLOW_THRESHOLD
+)
+
+def upstream_route(url: str) -> str:
+    """Last path segment of an upstream URL (the bot token never gets into spans)"""
+    path = url.split("?", 1)[0]
+    if "/file/bot" in path:
+        return "file"
+    return path.rstrip("/").rsplit("/", 1)[-1]
+
+def trace_db_operation(collection: str, operation: str, started: float, duration: float, error: Optional[BaseException]):
+    tracer.record(
+        f"mongo {collection}.{operation}", started, duration, repr(error) if error else None,
+        **{"db.system": "mongodb", "db.collection.name": collection, "db.operation.name": operation}
+    )
+
+def trace_upstream_call(upstream: str, outcome: str, started: float, duration: float, target: str):
+    route = upstream_route(target)
+    tracer.record(
+        f"{upstream} {route}", started, duration, outcome if outcome != "success" else None,
+        **{"upstream": upstream, "http.route": route, "outcome": outcome}
+    )
+
+db_observers.append(trace_db_operation)
+for breaker in upstream_breakers:
+    breaker.observers.append(trace_upstream_call)
+
+update_recorder = UpdateRecorder(
+    UPDATE_RECORD_PATH,
+    UPDATE_RECORD_KEY.encode() or secrets.token_bytes(32),
+    sample_rate=UPDATE_RECORD_SAMPLE
+)
+
+loop_lag_monitor = LoopLagMonitor(LOOP_LAG_INTERVAL, LOOP_LAG_THRESHOLD)
+loop_lag = metrics_registry.histogram(
+    "bot_event_loop_lag_seconds", "Delay of event loop wake-ups",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+)
+loop_lag_monitor.observers.append(loop_lag.observe)
+
+def instrumented(name: str, helper: bool = False):
+    """Record handler (or helper) duration and errors in metrics and run it in a span of the current trace"""
+    histogram, errors = (helper_latency, helper_errors) if helper else (handler_latency, handler_errors)
+    def decorator(func):
+        func = timed(histogram, errors, name)(func)
+        
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            with tracer.span(name):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
 
 # Helper Functions
+async def update_user_document(filter: Dict[str, Any], update: Dict[str, Any]):
+    """update_one on users that invalidates the cached user in every process"""
+    result = await db.users.update_one(filter, update)
+    if result.modified_count:
+        await invalidation_bus.publish("users", filter["telegram_id"])
+    return result
+
 def generate_referral_code(telegram_id: int) -> str:
     """Generate unique referral code"""
     data = f"{telegram_id}_{secrets.token_hex(8)}"
@@ -105,39 +493,7 @@ def generate_referral_code(telegram_id: int) -> str:
 
 def detect_search_type(query: str) -> str:
     """Detect search type based on query pattern"""
-    query = query.strip()
-    
-    phone_patterns = [
-        r'^\+?[7-8]\d{10}$',
-        r'^\+?\d{10,15}$',
-        r'^[7-8]\(\d{3}\)\d{3}-?\d{2}-?\d{2}$'
-    ]
-    
-    for pattern in phone_patterns:
-        if re.match(pattern, query.replace(' ', '').replace('-', '').replace('(', '').replace(')', '')):
-            return "📱 Телефон"
-    
-    if re.match(r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$', query):
-        return "📧 Email"
-    
-    if re.match(r'^[АВЕКМНОРСТУХ]\d{3}[АВЕКМНОРСТУХ]{2}\d{2,3}$', query.upper().replace(' ', '')):
-        return "🚗 Автомобиль"
-    
-    if query.startswith('@') or re.match(r'^[a-zA-Z0-9_]+$', query):
-        return "🆔 Никнейм"
-    
-    if re.match(r'^\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}$', query):
-        return "🌐 IP-адрес"
-    
-    address_keywords = ['улица', 'ул', 'проспект', 'пр', 'переулок', 'пер', 'дом', 'д', 'квартира', 'кв']
-    if any(keyword in query.lower() for keyword in address_keywords):
-        return "🏠 Адрес"
-    
-    words = query.split()
-    if 2 <= len(words) <= 3 and all(re.match(r'^[а-яА-ЯёЁa-zA-Z]+$', word) for word in words):
-        return "👤 ФИО"
-    
-    return "🔍 Общий поиск"
+    return classify_query(query).search_type
 
 def create_main_menu():
     """Create main menu keyboard"""
@@ -235,11 +591,28 @@ def create_subscription_keyboard():
         ]
     }
 
+async def run_concurrently(*aws, timeout: float = None) -> List[Any]:
+    """Await independent operations concurrently and return results in order.
+
+    Every operation is limited by timeout. If one of them fails, the rest are
+    cancelled and the error is raised, so a screen costs the slowest call
+    instead of the sum of all calls.
+    """
+    timeout = CONCURRENT_CALL_TIMEOUT if timeout is None else timeout
+    tasks = [asyncio.ensure_future(asyncio.wait_for(aw, timeout)) for aw in aws]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
 async def check_daily_limit_reset(user: User) -> User:
     """Check if daily search limit should be reset"""
     now = datetime.utcnow()
     if now.date() > user.daily_searches_reset.date():
-        await db.users.update_one(
+        await update_user_document(
             {"telegram_id": user.telegram_id},
             {
                 "$set": {
@@ -277,142 +650,612 @@ async def can_search(user: User) -> tuple[bool, str]:
     
     return False, "недостаточно средств"
 
+async def reserve_searches(user: User, units: int = 1) -> tuple[Optional[SearchReservation], str]:
+    """Atomically hold quota for units searches. Returns (reservation, payment method or reason)
+
+    The debit and the reservation record are written by one conditional update,
+    so the quota is either held in full or not touched at all.
+    """
+    if user.is_admin:
+        return SearchReservation(payment_method="admin", units=units), "admin"
+    
+    if await has_active_subscription(user):
+        user = await check_daily_limit_reset(user)
+        reservation = SearchReservation(payment_method="subscription", units=units)
+        result = await update_user_document(
+            {"telegram_id": user.telegram_id, "daily_searches_used": {"$lte": SUBSCRIPTION_DAILY_LIMIT - units}},
+            {"$inc": {"daily_searches_used": units}, "$push": {"search_reservations": reservation.dict()}}
+        )
+        if result.modified_count:
+            return reservation, "subscription"
+        available = max(0, SUBSCRIPTION_DAILY_LIMIT - user.daily_searches_used)
+        return None, f"по подписке сегодня доступно поисков: {available}, нужно: {units}"
+    
+    reservation = SearchReservation(payment_method="balance", units=units, amount=SEARCH_COST * units)
+    result = await update_user_document(
+        {"telegram_id": user.telegram_id, "balance": {"$gte": reservation.amount}},
+        {"$inc": {"balance": -reservation.amount}, "$push": {"search_reservations": reservation.dict()}}
+    )
+    if result.modified_count:
+        return reservation, "balance"
+    return None, f"для {units} поисков нужно {reservation.amount:.0f} ₽, ваш баланс: {user.balance:.2f} ₽"
+
+async def settle_reservation(user_id: int, reservation: SearchReservation, used_units: Optional[int] = None,
+                             stale_before: Optional[datetime] = None) -> bool:
+    """Commit used_units of a reservation (all by default) and refund the rest
+
+    Idempotent: the update only matches while the reservation is still held,
+    so a reservation already settled or swept is never refunded twice.
+    With stale_before it also only matches if the reservation was not renewed since.
+    """
+    if reservation.payment_method == "admin":
+        return True
+    
+    used_units = reservation.units if used_units is None else max(0, min(used_units, reservation.units))
+    refund_units = reservation.units - used_units
+    
+    update: Dict[str, Any] = {"$pull": {"search_reservations": {"reservation_id": reservation.reservation_id}}}
+    if refund_units and reservation.payment_method == "balance":
+        update["$inc"] = {"balance": reservation.amount * refund_units / reservation.units}
+    elif refund_units and reservation.created_at.date() == datetime.utcnow().date():
+        # После смены дня счётчик уже сброшен, возвращать нечего
+        update["$inc"] = {"daily_searches_used": -refund_units}
+    
+    held: Dict[str, Any] = {"reservation_id": reservation.reservation_id}
+    if stale_before is not None:
+        held["$or"] = [{"heartbeat_at": None}, {"heartbeat_at": {"$lt": stale_before}}]
+    result = await update_user_document(
+        {"telegram_id": user_id, "search_reservations": {"$elemMatch": held}},
+        update
+    )
+    if not result.modified_count:
+        logging.warning(f"Reservation {reservation.reservation_id} of user {user_id} was already settled or renewed")
+        return False
+    return True
+
+async def release_reservation(user_id: int, reservation: SearchReservation, stale_before: Optional[datetime] = None) -> bool:
+    """Refund the whole reservation"""
+    return await settle_reservation(user_id, reservation, used_units=0, stale_before=stale_before)
+
+async def keep_reservation_alive(user_id: int, reservation: SearchReservation):
+    """Renew the reservation until cancelled, so the sweeper does not release a running search"""
+    while True:
+        await asyncio.sleep(SEARCH_RESERVATION_HEARTBEAT)
+        try:
+            # Мимо update_user_document: продление не меняет ничего, что лежит в кэше пользователей
+            await db.users.update_one(
+                {"telegram_id": user_id, "search_reservations.reservation_id": reservation.reservation_id},
+                {"$set": {"search_reservations.$.heartbeat_at": datetime.utcnow()}}
+            )
+        except Exception as e:
+            logging.error(f"Failed to renew reservation {reservation.reservation_id} of user {user_id}: {e}")
+
+async def sweep_search_reservations():
+    """Release reservations left behind by crashed or cancelled searches"""
+    cutoff = datetime.utcnow() - timedelta(seconds=SEARCH_RESERVATION_TIMEOUT)
+    released = 0
+    # Выборка по индексу created_at; продлённые резервы отсеиваются ниже
+    cursor = db.users.find(
+        {"search_reservations.created_at": {"$lt": cutoff}},
+        {"_id": 0, "telegram_id": 1, "search_reservations": 1}
+    )
+    async for doc in cursor:
+        for item in doc.get("search_reservations", []):
+            reservation = SearchReservation(**item)
+            renewed_at = reservation.heartbeat_at or reservation.created_at
+            if renewed_at < cutoff and await release_reservation(doc["telegram_id"], reservation, stale_before=cutoff):
+                logging.warning(
+                    f"Released stale reservation {reservation.reservation_id} of user {doc['telegram_id']}: "
+                    f"{reservation.units} x {reservation.payment_method}"
+                )
+                released += 1
+    return released
+
+async def run_reservation_sweeper():
+    """Periodically release stale search reservations"""
+    while True:
+        try:
+            await sweep_search_reservations()
+        except Exception as e:
+            logging.error(f"Reservation sweep failed: {e}")
+        await asyncio.sleep(SEARCH_RESERVATION_SWEEP_INTERVAL)
+
+class HedgeBudget:
+    """Token bucket limiting hedged requests to a share of all requests"""
+
+    def __init__(self, ratio: float, burst: float):
+        self.ratio = ratio
+        self.burst = burst
+        self.tokens = burst
+
+    def deposit(self):
+        self.tokens = min(self.burst, self.tokens + self.ratio)
+
+    def withdraw(self) -> bool:
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+usersbox_hedge_budget = HedgeBudget(USERSBOX_HEDGE_RATIO, USERSBOX_HEDGE_BURST)
+
+usersbox_hedge_stats = {
+    "requests": 0,
+    "hedged": 0,  # отправлен второй запрос
+    "hedge_won": 0,  # второй запрос ответил первым
+    "primary_won": 0,  # первый запрос ответил первым несмотря на хедж
+    "budget_exhausted": 0,  # хедж был нужен, но бюджет исчерпан
+    "losers": 0,  # запросы, ответ которых отброшен
+    "losers_in_flight": 0  # проигравшие запросы, ещё ждущие ответа usersbox
+}
+
+async def drain_hedge_loser(task: asyncio.Future):
+    """Wait for an abandoned request so its connection is released and the breaker records it"""
+    try:
+        response = await task
+        close = getattr(response, "close", None)
+        if close:
+            close()
+    except Exception:
+        pass
+    finally:
+        usersbox_hedge_stats["losers_in_flight"] -= 1
+
+def usersbox_hedge_delay() -> Optional[float]:
+    """Time to wait for the first response before hedging, None if hedging is off"""
+    if not USERSBOX_HEDGING or len(usersbox_breaker.latencies) < usersbox_breaker.min_latency_samples:
+        return None
+    return max(USERSBOX_HEDGE_MIN_DELAY, usersbox_breaker.latency_percentile(USERSBOX_HEDGE_PERCENTILE))
+
+async def hedged_usersbox_call(call, delay: Optional[float]):
+    """Await call(); if it has not finished after delay, race it against a second call()
+
+    The first successful response wins. If both fail, the error of the first
+    request is raised. The other request cannot be aborted (the HTTP call runs
+    in a thread): it keeps its connection and usersbox quota until it
+    finishes, so it is left to complete in the background, where the breaker
+    records its outcome, and counted in losers_in_flight.
+    """
+    usersbox_hedge_stats["requests"] += 1
+    usersbox_hedge_budget.deposit()
+    if delay is None:
+        return await call()
+    
+    primary = asyncio.ensure_future(call())
+    hedge = None
+    try:
+        done, _ = await asyncio.wait({primary}, timeout=delay)
+        if done:
+            return primary.result()
+        if usersbox_hedge_stats["losers_in_flight"] >= USERSBOX_HEDGE_BURST or not usersbox_hedge_budget.withdraw():
+            usersbox_hedge_stats["budget_exhausted"] += 1
+            return await primary
+        
+        usersbox_hedge_stats["hedged"] += 1
+        hedge = asyncio.ensure_future(call())
+        pending = {primary, hedge}
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    usersbox_hedge_stats["hedge_won" if task is hedge else "primary_won"] += 1
+                    return task.result()
+        return primary.result()
+    finally:
+        for task in (primary, hedge):
+            if task is not None and not task.done():
+                usersbox_hedge_stats["losers"] += 1
+                usersbox_hedge_stats["losers_in_flight"] += 1
+                spawn_background_task(drain_hedge_loser(task))
+
 async def usersbox_request(endpoint: str, params: Dict = None) -> Dict:
     """Make request to usersbox API"""
     headers = {"Authorization": USERSBOX_TOKEN}
     url = f"{USERSBOX_BASE_URL}{endpoint}"
     
     try:
-        response = requests.get(url, headers=headers, params=params or {}, timeout=30)
+        call = partial(usersbox_breaker.call, http_session.get, url, headers=headers, params=params or {})
+        response = await hedged_usersbox_call(call, usersbox_hedge_delay())
         return response.json()
+    except CircuitOpenError:
+        return {"status": "error", "error": {"message": "Сервис поиска временно недоступен", "code": "circuit_open"}}
     except Exception as e:
         logging.error(f"Usersbox API error: {e}")
         return {"status": "error", "error": {"message": str(e)}}
 
-def format_search_results(results: Dict[str, Any], query: str, search_type: str) -> str:
-    """Format usersbox API results for Telegram"""
-    if results.get('status') == 'error':
-        return f"❌ *Ошибка:* {results.get('error', {}).get('message', 'Неизвестная ошибка')}"
+def search_cache_key(classification: QueryClassification) -> str:
+    return f"{classification.search_type}:{classification.normalized}"
 
-    data = results.get('data', {})
-    total_count = data.get('count', 0)
-    
-    if total_count == 0:
-        return f"🔍 *Поиск:* `{query}`\n{search_type}\n\n❌ *Результатов не найдено*\n\n💡 *Попробуйте изменить формат запроса*"
-    
-    formatted_text = f"🎯 *РЕЗУЛЬТАТЫ ПОИСКА*\n\n"
-    formatted_text += f"🔍 *Запрос:* `{query}`\n"
-    formatted_text += f"📂 *Тип:* {search_type}\n"
-    formatted_text += f"📊 *Найдено:* {total_count} записей\n\n"
+async def search_usersbox(query: str, classification: QueryClassification, user_id: int = 0, tier: str = "balance") -> Dict[str, Any]:
+    """Search usersbox, serving repeated queries from the result cache
 
-    if 'items' in data and isinstance(data['items'], list):
-        formatted_text += "📋 *ДАННЫЕ ИЗ БАЗ:*\n\n"
-        
-        for i, source_data in enumerate(data['items'][:5], 1):
-            if 'source' in source_data and 'hits' in source_data:
-                source = source_data['source']
-                hits = source_data['hits']
-                hits_count = hits.get('hitsCount', hits.get('count', 0))
-                
-                db_names = {
-                    'yandex': '🟡 Яндекс',
-                    'avito': '🟢 Авито',
-                    'vk': '🔵 ВКонтакте',
-                    'ok': '🟠 Одноклассники',
-                    'delivery_club': '🍕 Delivery Club',
-                    'cdek': '📦 СДЭК'
-                }
-                
-                db_display = db_names.get(source.get('database', ''), f"📊 {source.get('database', 'N/A')}")
-                
-                formatted_text += f"*{i}. {db_display}*\n"
-                formatted_text += f"📁 База: {source.get('collection', 'N/A')}\n"
-                formatted_text += f"🔢 Записей: {hits_count}\n"
-
-                if 'items' in hits and hits['items']:
-                    formatted_text += "💾 *Данные:*\n"
-                    for item in hits['items'][:2]:
-                        for key, value in item.items():
-                            if key.startswith('_'):
-                                continue
-                            
-                            if key in ['phone', 'телефон', 'tel', 'mobile']:
-                                formatted_text += f"📞 {value}\n"
-                            elif key in ['email', 'почта', 'mail', 'e_mail']:
-                                formatted_text += f"📧 {value}\n"
-                            elif key in ['full_name', 'name', 'имя', 'фио', 'first_name', 'last_name']:
-                                formatted_text += f"👤 {value}\n"
-                            elif key in ['birth_date', 'birthday', 'дата_рождения', 'bdate']:
-                                formatted_text += f"🎂 {value}\n"
-                            elif key in ['address', 'адрес', 'city', 'город']:
-                                formatted_text += f"🏠 {value}\n"
-                            elif key in ['sex', 'gender', 'пол']:
-                                gender_map = {'1': 'Ж', '2': 'М', 'male': 'М', 'female': 'Ж'}
-                                formatted_text += f"⚥ {gender_map.get(str(value), value)}\n"
-                
-                formatted_text += "\n"
-
-    formatted_text += "━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\n"
-    formatted_text += "🔒 *Конфиденциальность:* Используйте данные ответственно"
+    Upstream requests wait for a slot of the search scheduler. While the
+    usersbox circuit is open an expired cached result is better than an
+    error, so the cache is consulted again without the TTL.
+    """
+    cache_key = search_cache_key(classification)
+    results = search_result_cache.get(cache_key)
+    if results is not None:
+        return results
     
-    return formatted_text
+    async with search_scheduler.slot(user_id, tier):
+        results = await usersbox_request("/search", {"q": query})
+    if results.get('status') == 'success':
+        search_result_cache.set(cache_key, results)
+    elif results.get('error', {}).get('code') == "circuit_open":
+        return search_result_cache.get_stale(cache_key) or results
+    return results
+
+async def send_results_archive(chat_id: int, entries: List[tuple[str, str, Dict[str, Any]]], caption: str, reply_markup: dict = None) -> bool:
+    """Render results into compressed file off the event loop and send it"""
+    file_name, archive = await asyncio.to_thread(build_results_archive, entries, RESULTS_FILE_FORMAT)
+    try:
+        return await send_telegram_document(chat_id, file_name, archive, caption=caption, reply_markup=reply_markup)
+    finally:
+        archive.close()
 
+@instrumented("check_subscription", helper=True)
 async def check_subscription(user_id: int) -> bool:
-    """Check if user is subscribed to required channel"""
+    """Check if user is subscribed to required channel (positive answers are cached)"""
+    if cached_value(membership_cache, user_id):
+        return True
+    
     try:
-        url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/getChatMember"
-        params = {
+        payload = {
             "chat_id": REQUIRED_CHANNEL,
             "user_id": user_id
         }
         
-        response = requests.get(url, params=params, timeout=10)
-        if response.status_code == 200:
-            data = response.json()
-            if data.get('ok'):
-                status = data.get('result', {}).get('status')
-                return status in ['member', 'administrator', 'creator']
+        data = await telegram_api_request("getChatMember", payload)
+        if data.get('ok'):
+            status = data.get('result', {}).get('status')
+            is_member = status in ['member', 'administrator', 'creator']
+            if is_member:
+                membership_cache.set(user_id, True)
+            return is_member
         
         return False
     except Exception as e:
         logging.error(f"Subscription check error: {e}")
         return False
 
-async def send_telegram_message(chat_id: int, text: str, parse_mode: str = "Markdown", reply_markup: dict = None) -> bool:
-    """Send message to Telegram user"""
-    url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage"
+async def telegram_api_request(method: str, payload: Dict[str, Any], timeout: Optional[float] = None) -> Dict[str, Any]:
+    """Call Telegram Bot API method on the shared session without blocking the event loop
+
+    Goes through the Telegram circuit breaker; while it is open or the API
+    answers with 5xx the result is an error response in Bot API format.
+    """
+    url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/{method}"
+    try:
+        response = await telegram_breaker.call(http_session.post, url, json=payload, timeout=timeout)
+    except CircuitOpenError as e:
+        return {"ok": False, "error_code": 503, "description": str(e)}
+    except UpstreamStatusError as e:
+        return {"ok": False, "error_code": e.status_code, "description": str(e)}
+    return response.json()
+
+# Fire-and-forget tasks are kept here so they are not garbage collected mid-flight
+background_tasks = set()
+
+def spawn_background_task(coro) -> asyncio.Task:
+    """Run coroutine in background without awaiting it"""
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+callback_ack_stats = {
+    "sent": 0,
+    "failed": 0,
+    "with_toast": 0,
+    "late_toasts": 0,
+    "total_time": 0.0
+}
+
+class CallbackAnswer:
+    """answerCallbackQuery sent in background while the callback handler runs.
+
+    The answer waits up to CALLBACK_TOAST_WINDOW for the handler; if the
+    handler finishes in time, the toast it set is attached to the answer.
+    """
+
+    def __init__(self, callback_query_id: str):
+        self.callback_query_id = callback_query_id
+        self.text: Optional[str] = None
+        self.show_alert = False
+        self.sent = False
+        self.handler_done = asyncio.Event()
+
+    def start(self):
+        spawn_background_task(self._send())
+
+    def set_toast(self, text: str, show_alert: bool = False):
+        if self.sent:
+            callback_ack_stats["late_toasts"] += 1
+            return
+        self.text = text
+        self.show_alert = show_alert
+
+    def finish(self):
+        self.handler_done.set()
+
+    async def _send(self):
+        try:
+            await asyncio.wait_for(self.handler_done.wait(), CALLBACK_TOAST_WINDOW)
+        except asyncio.TimeoutError:
+            pass
+
+        self.sent = True
+        payload = {"callback_query_id": self.callback_query_id}
+        if self.text:
+            payload["text"] = self.text
+            payload["show_alert"] = self.show_alert
+            callback_ack_stats["with_toast"] += 1
+
+        started = time.perf_counter()
+        try:
+            result = await telegram_api_request("answerCallbackQuery", payload, timeout=5)
+            if result.get('ok'):
+                callback_ack_stats["sent"] += 1
+            else:
+                callback_ack_stats["failed"] += 1
+                logging.warning(f"answerCallbackQuery rejected: {result.get('description')}")
+        except Exception as e:
+            callback_ack_stats["failed"] += 1
+            logging.error(f"Failed to answer callback query: {e}")
+        finally:
+            callback_ack_stats["total_time"] += time.perf_counter() - started
+
+current_callback_answer: ContextVar[Optional[CallbackAnswer]] = ContextVar("current_callback_answer", default=None)
+
+def set_callback_toast(text: str, show_alert: bool = False):
+    """Show toast for the callback query being handled, if it is not answered yet"""
+    answer = current_callback_answer.get()
+    if answer:
+        answer.set_toast(text, show_alert)
+
+TELEGRAM_MESSAGE_LIMIT = 4096
+MARKDOWN_STRIP_RE = re.compile(r'\\([_*`\[])|[_*`]')
+
+def telegram_length(text: str) -> int:
+    """Message length as Telegram counts it (UTF-16 code units)"""
+    return len(text.encode('utf-16-le')) // 2
+
+def markdown_state(text: str, open_entity: Optional[str] = None) -> tuple[bool, Optional[str]]:
+    """Scan legacy Markdown. Returns (valid, entity left open at the end: '*', '_', '`', '```' or None)"""
+    i = 0
+    length = len(text)
+    while i < length:
+        if open_entity in ('`', '```'):
+            end = text.find(open_entity, i)
+            if end == -1:
+                return True, open_entity
+            i = end + len(open_entity)
+            open_entity = None
+            continue
+        
+        ch = text[i]
+        if ch == '\\':
+            i += 2
+            continue
+        if ch == '`':
+            open_entity = '```' if text.startswith('```', i) else '`'
+            i += len(open_entity)
+            continue
+        if ch in '*_':
+            if open_entity is None:
+                open_entity = ch
+            elif open_entity == ch:
+                open_entity = None
+            else:
+                # Legacy Markdown does not support nested entities
+                return False, open_entity
+        i += 1
+    return True, open_entity
+
+def strip_markdown(text: str) -> str:
+    """Plain text version of Markdown message: markers removed, escapes resolved"""
+    return MARKDOWN_STRIP_RE.sub(lambda m: m.group(1) or '', text)
+
+def split_long_line(line: str, limit: int) -> List[str]:
+    """Split line longer than limit, preferring whitespace and never cutting an escape sequence"""
+    parts = []
+    while telegram_length(line) > limit:
+        cut = min(len(line), limit)
+        excess = telegram_length(line[:cut]) - limit
+        while excess > 0:
+            # Every character is one or two UTF-16 units
+            cut -= max(1, excess // 2)
+            excess = telegram_length(line[:cut]) - limit
+        space = line.rfind(' ', 0, cut)
+        if space > cut // 2:
+            cut = space + 1
+        elif line[cut - 1] == '\\':
+            cut -= 1
+        parts.append(line[:cut])
+        line = line[cut:]
+    parts.append(line)
+    return parts
+
+def split_message(text: str, limit: int = TELEGRAM_MESSAGE_LIMIT, markdown: bool = True) -> List[str]:
+    """Split text into messages within limit at line boundaries.
+
+    With Markdown, an entity open at the end of a chunk is closed there and
+    reopened at the start of the next one, so every chunk parses on its own.
+    """
+    if telegram_length(text) <= limit:
+        return [text]
+    
+    # Room for closing and reopening markers
+    body_limit = limit - 6 if markdown else limit
+    chunks = []
+    current = []
+    current_length = 0
+    for line in text.splitlines(keepends=True):
+        for part in split_long_line(line, body_limit):
+            part_length = telegram_length(part)
+            if current and current_length + part_length > body_limit:
+                chunks.append("".join(current))
+                current = []
+                current_length = 0
+            current.append(part)
+            current_length += part_length
+    if current:
+        chunks.append("".join(current))
+    
+    if not markdown:
+        return chunks
+    
+    balanced = []
+    carried = None
+    for chunk in chunks:
+        _, open_entity = markdown_state(chunk, carried)
+        balanced.append(f"{carried or ''}{chunk}{open_entity or ''}")
+        carried = open_entity
+    return balanced
+
+async def send_message_chunk(chat_id: int, text: str, parse_mode: Optional[str], reply_markup: dict = None) -> bool:
+    """Send one message, resending as plain text if Telegram cannot parse its Markdown"""
     payload = {
         "chat_id": chat_id,
-        "text": text,
-        "parse_mode": parse_mode
+        "text": text
     }
-    
+    if parse_mode:
+        payload["parse_mode"] = parse_mode
     if reply_markup:
         payload["reply_markup"] = reply_markup
     
     try:
-        response = requests.post(url, json=payload, timeout=10)
-        return response.status_code == 200
+        result = await telegram_api_request("sendMessage", payload)
+        if result.get('ok'):
+            return True
+        
+        if parse_mode and "can't parse entities" in result.get('description', ''):
+            logging.warning(f"Markdown rejected by Telegram, sending as plain text: {result.get('description')}")
+            payload.pop("parse_mode")
+            payload["text"] = strip_markdown(text)
+            result = await telegram_api_request("sendMessage", payload)
+            return bool(result.get('ok'))
+        
+        logging.error(f"Telegram rejected message: {result.get('description')}")
+        return False
     except Exception as e:
         logging.error(f"Failed to send Telegram message: {e}")
         return False
 
+@instrumented("send_message", helper=True)
+async def send_telegram_message(chat_id: int, text: str, parse_mode: str = "Markdown", reply_markup: dict = None) -> bool:
+    """Send message to Telegram user.
+
+    Text over the Telegram limit is sent as several messages in order, with
+    the keyboard attached to the last one. Markdown that would not parse is
+    detected locally and sent as plain text right away.
+    """
+    if parse_mode == "Markdown":
+        valid, open_entity = markdown_state(text)
+        if not valid or open_entity:
+            text = strip_markdown(text)
+            parse_mode = None
+    
+    chunks = split_message(text, markdown=parse_mode == "Markdown")
+    for i, chunk in enumerate(chunks):
+        is_last = i == len(chunks) - 1
+        if not await send_message_chunk(chat_id, chunk, parse_mode, reply_markup if is_last else None):
+            return False
+    return True
+
+class NavigationTarget:
+    """Message with the pressed inline button; menu screens replace its content"""
+    __slots__ = ("chat_id", "message_id")
+
+    def __init__(self, chat_id: int, message_id: int):
+        self.chat_id = chat_id
+        self.message_id = message_id
+
+current_navigation: ContextVar[Optional[NavigationTarget]] = ContextVar("current_navigation", default=None)
+
+# Content hash of menu messages last rendered by the bot, keyed by (chat_id, message_id)
+menu_message_hashes: "OrderedDict[tuple, str]" = OrderedDict()
+
+navigation_stats = {
+    "edited": 0,
+    "skipped": 0,
+    "fallback": 0
+}
+
+def menu_content_hash(text: str, reply_markup: Optional[dict]) -> str:
+    """Hash of menu text and keyboard"""
+    content = json.dumps([text, reply_markup], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha1(content.encode()).hexdigest()
+
+def remember_menu_hash(key: tuple, content_hash: str):
+    menu_message_hashes[key] = content_hash
+    menu_message_hashes.move_to_end(key)
+    if len(menu_message_hashes) > MENU_HASH_CACHE_SIZE:
+        menu_message_hashes.popitem(last=False)
+
+async def send_menu_screen(chat_id: int, text: str, parse_mode: str = "Markdown", reply_markup: dict = None) -> bool:
+    """Show menu screen.
+
+    Inside a callback query the message with the pressed button is edited in
+    place; nothing is sent if it already shows the same content. Outside a
+    callback, or when the message cannot be edited, a new message is sent.
+    """
+    target = current_navigation.get()
+    if target is None or target.chat_id != chat_id:
+        return await send_telegram_message(chat_id, text, parse_mode, reply_markup)
+
+    key = (chat_id, target.message_id)
+    content_hash = menu_content_hash(text, reply_markup)
+    if menu_message_hashes.get(key) == content_hash:
+        navigation_stats["skipped"] += 1
+        return True
+
+    payload = {
+        "chat_id": chat_id,
+        "message_id": target.message_id,
+        "text": text,
+        "parse_mode": parse_mode
+    }
+    if reply_markup:
+        payload["reply_markup"] = reply_markup
+
+    try:
+        result = await telegram_api_request("editMessageText", payload)
+    except Exception as e:
+        logging.error(f"Failed to edit Telegram message: {e}")
+        result = {}
+
+    if result.get('ok') or "message is not modified" in result.get('description', ''):
+        remember_menu_hash(key, content_hash)
+        navigation_stats["edited"] += 1
+        return True
+
+    navigation_stats["fallback"] += 1
+    return await send_telegram_message(chat_id, text, parse_mode, reply_markup)
+
+@instrumented("get_or_create_user", helper=True)
 async def get_or_create_user(telegram_id: int, username: str = None, first_name: str = None, last_name: str = None, referral_code: str = None) -> tuple[User, bool]:
     """Get existing user or create new one. Returns (user, is_new_user)"""
-    user_data = await db.users.find_one({"telegram_id": telegram_id})
+    user_data = cached_value(user_cache, telegram_id)
+    # Кэш заполняется только прочитанным из базы: попадание не продлевает TTL записи
+    cached = user_data is not None
+    if not cached:
+        user_data = await db.users.find_one({"telegram_id": telegram_id}, {"_id": 0})
     
     if user_data:
-        await db.users.update_one(
-            {"telegram_id": telegram_id},
-            {
-                "$set": {
-                    "last_active": datetime.utcnow(),
-                    "username": username,
-                    "first_name": first_name,
-                    "last_name": last_name
-                }
-            }
-        )
+        # Пишем только при смене профиля или раз в USER_ACTIVITY_WRITE_INTERVAL
+        profile = {"username": username, "first_name": first_name, "last_name": last_name}
+        now = datetime.utcnow()
+        last_active = user_data.get("last_active") or datetime.min
+        if any(user_data.get(field) != value for field, value in profile.items()) or (now - last_active).total_seconds() > USER_ACTIVITY_WRITE_INTERVAL:
+            await update_user_document(
+                {"telegram_id": telegram_id},
+                {"$set": {"last_active": now, **profile}}
+            )
+            user_data = {**user_data, **profile, "last_active": now}
+        if not cached:
+            user_cache.set(telegram_id, user_data)
         return User(**user_data), False
     else:
         referral_code_generated = generate_referral_code(telegram_id)
@@ -429,6 +1272,7 @@ async def get_or_create_user(telegram_id: int, username: str = None, first_name:
         )
         
         await db.users.insert_one(user.dict())
+        user_cache.set(telegram_id, user.dict())
         
         # Process referral for new user
         if referral_code:
@@ -447,24 +1291,41 @@ async def telegram_webhook(secret: str, request: Request):
     if secret != WEBHOOK_SECRET:
         raise HTTPException(status_code=403, detail="Invalid webhook secret")
     
+    received_at = time.time()
+    update_data = None
+    status = 200
     try:
         update_data = await request.json()
-        await handle_telegram_update(update_data)
+        if UPDATE_PROCESSING_MODE == "sharded":
+            await update_broker.publish([update_data], update_user_key)
+        else:
+            await handle_telegram_update(update_data)
         return {"status": "ok"}
     except Exception as e:
+        status = 500
         logging.error(f"Webhook processing failed: {e}")
         raise HTTPException(status_code=500, detail=f"Webhook processing failed: {str(e)}")
+    finally:
+        if update_recorder.enabled and isinstance(update_data, dict):
+            update_recorder.record("telegram", update_data, received_at, time.time() - received_at, status, update_user_key(update_data))
 
 @api_router.post("/cryptobot/webhook")
 async def cryptobot_webhook(request: Request):
     """Handle CryptoBot webhook for payment notifications"""
+    received_at = time.time()
+    webhook_data = None
+    status = 200
     try:
         webhook_data = await request.json()
         await handle_cryptobot_payment(webhook_data)
         return {"status": "ok"}
     except Exception as e:
+        status = 500
         logging.error(f"CryptoBot webhook processing failed: {e}")
         raise HTTPException(status_code=500, detail=f"CryptoBot webhook processing failed: {str(e)}")
+    finally:
+        if update_recorder.enabled and isinstance(webhook_data, dict):
+            update_recorder.record("cryptobot", webhook_data, received_at, time.time() - received_at, status)
 
 async def handle_cryptobot_payment(webhook_data: Dict[str, Any]):
     """Handle CryptoBot payment notification"""
@@ -494,7 +1355,7 @@ async def handle_cryptobot_payment(webhook_data: Dict[str, Any]):
             
             if status == 'paid':
                 # Update user balance
-                result = await db.users.update_one(
+                result = await update_user_document(
                     {"telegram_id": user_id},
                     {"$inc": {"balance": amount}}
                 )
@@ -508,22 +1369,9 @@ async def handle_cryptobot_payment(webhook_data: Dict[str, Any]):
                         payment_id=invoice_id,
                         status="completed"
                     )
+                    # Уведомление отправит notification_service
                     await db.payments.insert_one(payment.dict())
                     
-                    # Send notification to user
-                    notification_text = f"🎉 *ПОПОЛНЕНИЕ УСПЕШНО!*\n\n"
-                    notification_text += f"🤖 *Способ:* Криптовалюта\n"
-                    notification_text += f"💰 *Сумма:* {amount}₽\n"
-                    notification_text += f"📋 *ID платежа:* {invoice_id}\n\n"
-                    notification_text += f"✅ *Средства зачислены на баланс*\n"
-                    notification_text += f"🔍 *Теперь вы можете пользоваться сервисом!*"
-                    
-                    await send_telegram_message(
-                        user_id,
-                        notification_text,
-                        reply_markup=create_main_menu()
-                    )
-                    
                     logging.info(f"Crypto payment processed: {amount}₽ for user {user_id}")
                 else:
                     logging.error(f"Failed to update balance for user {user_id}")
@@ -533,6 +1381,167 @@ async def handle_cryptobot_payment(webhook_data: Dict[str, Any]):
     except Exception as e:
         logging.error(f"Error processing CryptoBot payment: {e}")
 
+CRYPTO_TYPES = ("btc", "eth", "usdt", "ltc")
+
+def parse_crypto_type(value: str) -> str:
+    """Validate crypto currency segment of callback data"""
+    if value not in CRYPTO_TYPES:
+        raise ValueError(f"Unknown crypto type: {value}")
+    return value
+
+class CallbackRoute:
+    """Callback route with its handler and usage statistics"""
+
+    def __init__(self, pattern: str, handler, admin_only: bool = False):
+        self.pattern = pattern
+        self.handler = handler
+        self.admin_only = admin_only
+        self.hits = 0
+        self.errors = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "route": self.pattern,
+            "hits": self.hits,
+            "errors": self.errors,
+            "avg_ms": round(self.total_time / self.hits * 1000, 2) if self.hits else 0.0,
+            "max_ms": round(self.max_time * 1000, 2),
+            "total_ms": round(self.total_time * 1000, 2)
+        }
+
+class CallbackRouteNode:
+    """Prefix trie node, one level per '_'-separated segment of callback data"""
+    __slots__ = ("children", "param_name", "param_converter", "param_child", "route")
+
+    def __init__(self):
+        self.children: Dict[str, "CallbackRouteNode"] = {}
+        self.param_name: Optional[str] = None
+        self.param_converter = None
+        self.param_child: Optional["CallbackRouteNode"] = None
+        self.route: Optional[CallbackRoute] = None
+
+class CallbackRouter:
+    """Dispatch callback data to handlers.
+
+    Static routes ("menu_profile") are looked up in a dict. Parameterized
+    routes ("crypto_{crypto_type:crypto}_{amount:int}") are stored in a prefix
+    trie; literal segments take precedence over parameters. Handlers are
+    called as handler(chat_id, user, **params).
+    """
+
+    PARAM_CONVERTERS = {
+        "str": str,
+        "int": int,
+        "crypto": parse_crypto_type
+    }
+    PARAM_PATTERN = re.compile(r'^\{(\w+)(?::(\w+))?\}$')
+    SEGMENT_PATTERN = re.compile(r'\{[^}]*\}|[^_]+')
+
+    def __init__(self):
+        self.exact_routes: Dict[str, CallbackRoute] = {}
+        self.trie = CallbackRouteNode()
+        self.routes: List[CallbackRoute] = []
+        self.unmatched = 0
+
+    def add(self, pattern: str, handler, admin_only: bool = False):
+        """Register handler for callback data pattern"""
+        route = CallbackRoute(pattern, handler, admin_only)
+        self.routes.append(route)
+
+        if "{" not in pattern:
+            self.exact_routes[pattern] = route
+            return
+
+        node = self.trie
+        for segment in self.SEGMENT_PATTERN.findall(pattern):
+            param = self.PARAM_PATTERN.match(segment)
+            if param:
+                name, converter_name = param.group(1), param.group(2) or "str"
+                if node.param_child is None:
+                    node.param_name = name
+                    node.param_converter = self.PARAM_CONVERTERS[converter_name]
+                    node.param_child = CallbackRouteNode()
+                elif node.param_name != name:
+                    raise ValueError(f"Conflicting parameter '{name}' in route {pattern}")
+                node = node.param_child
+            else:
+                node = node.children.setdefault(segment, CallbackRouteNode())
+
+        if node.route is not None:
+            raise ValueError(f"Duplicate callback route: {pattern}")
+        node.route = route
+
+    def resolve(self, data: str) -> tuple[Optional[CallbackRoute], Dict[str, Any]]:
+        """Find route and typed parameters for callback data"""
+        if not data:
+            return None, {}
+
+        route = self.exact_routes.get(data)
+        if route:
+            return route, {}
+
+        params: Dict[str, Any] = {}
+        route = self._match(self.trie, data.split("_"), 0, params)
+        return route, params
+
+    def _match(self, node: CallbackRouteNode, segments: List[str], index: int, params: Dict[str, Any]) -> Optional[CallbackRoute]:
+        if index == len(segments):
+            return node.route
+
+        segment = segments[index]
+        child = node.children.get(segment)
+        if child:
+            route = self._match(child, segments, index + 1, params)
+            if route:
+                return route
+
+        if node.param_child is not None:
+            try:
+                params[node.param_name] = node.param_converter(segment)
+            except ValueError:
+                return None
+            route = self._match(node.param_child, segments, index + 1, params)
+            if route:
+                return route
+            del params[node.param_name]
+
+        return None
+
+    async def dispatch(self, data: str, chat_id: int, user: "User") -> bool:
+        """Run handler for callback data. Returns False if no route matched"""
+        route, params = self.resolve(data)
+        if route is None or (route.admin_only and not user.is_admin):
+            self.unmatched += 1
+            return False
+
+        started = time.perf_counter()
+        try:
+            with tracer.span(route.pattern, route=route.pattern):
+                await route.handler(chat_id, user, **params)
+        except Exception:
+            route.errors += 1
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            callback_route_latency.observe(elapsed, route.pattern)
+            route.hits += 1
+            route.total_time += elapsed
+            route.max_time = max(route.max_time, elapsed)
+            if elapsed > CALLBACK_SLOW_THRESHOLD:
+                logging.warning(f"Slow callback route {route.pattern}: {elapsed:.3f}s")
+        return True
+
+    def stats(self) -> Dict[str, Any]:
+        """Per-route statistics, slowest routes first"""
+        routes = sorted(self.routes, key=lambda r: r.total_time, reverse=True)
+        return {
+            "routes": [route.stats() for route in routes],
+            "unmatched": self.unmatched
+        }
+
+@instrumented("callback_query")
 async def handle_callback_query(callback_query: Dict[str, Any]):
     """Handle callback queries from inline keyboard buttons"""
     chat_id = callback_query.get('message', {}).get('chat', {}).get('id')
@@ -540,89 +1549,59 @@ async def handle_callback_query(callback_query: Dict[str, Any]):
     data = callback_query.get('data')
     callback_query_id = callback_query.get('id')
     
-    # Answer callback query
-    try:
-        url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/answerCallbackQuery"
-        requests.post(url, json={"callback_query_id": callback_query_id}, timeout=5)
-    except:
-        pass
+    # Answer callback query in background, concurrently with user lookup and handler
+    answer = CallbackAnswer(callback_query_id)
+    answer.start()
+    answer_token = current_callback_answer.set(answer)
     
-    user, is_new_user = await get_or_create_user(
-        telegram_id=user_id,
-        username=callback_query.get('from', {}).get('username'),
-        first_name=callback_query.get('from', {}).get('first_name'),
-        last_name=callback_query.get('from', {}).get('last_name')
-    )
+    # Menu screens edit the message with the pressed button (only text messages can be edited)
+    message = callback_query.get('message', {})
+    navigation = NavigationTarget(chat_id, message['message_id']) if message.get('text') and message.get('message_id') else None
+    navigation_token = current_navigation.set(navigation)
     
-    # Handle different callback data
-    if data == "check_subscription":
-        await handle_subscription_check(chat_id, user_id)
-    elif data == "back_to_menu":
-        await show_main_menu(chat_id, user)
-    elif data == "menu_search":
-        await show_search_menu(chat_id, user)
-    elif data == "menu_profile":
-        await show_profile_menu(chat_id, user)
-    elif data == "menu_balance":
-        await show_balance_menu(chat_id, user)
-    elif data == "menu_pricing":
-        await show_pricing_menu(chat_id, user)
-    elif data == "menu_referral":
-        await show_referral_menu(chat_id, user)
-    elif data == "menu_help":
-        await show_help_menu(chat_id, user)
-    elif data == "menu_rules":
-        await show_rules_menu(chat_id, user)
-    elif data.startswith("admin_") and user.is_admin:
-        await handle_admin_callback(chat_id, user, data)
-    elif data.startswith("pay_"):
-        await handle_payment_callback(chat_id, user, data)
-    elif data.startswith("buy_"):
-        await handle_purchase_callback(chat_id, user, data)
-    elif data.startswith("crypto_"):
-        if "_btc" in data or "_eth" in data or "_usdt" in data or "_ltc" in data:
-            if data.count("_") >= 3:  # crypto_btc_100 format
-                parts = data.split("_")
-                crypto_type = parts[1]
-                amount = parts[2]
-                if amount == "custom":
-                    await handle_crypto_custom_amount(chat_id, user, crypto_type)
-                else:
-                    await handle_crypto_payment_amount(chat_id, user, crypto_type, amount)
-            else:  # crypto_btc format
-                crypto_type = data.split("_")[1]
-                await handle_crypto_payment(chat_id, user, crypto_type)
-    elif data.startswith("stars_"):
-        amount = data.split("_")[1]
-        if amount == "custom":
-            await handle_stars_custom_amount(chat_id, user)
-        else:
-            await handle_stars_payment(chat_id, user, amount)
+    try:
+        user, is_new_user = await get_or_create_user(
+            telegram_id=user_id,
+            username=callback_query.get('from', {}).get('username'),
+            first_name=callback_query.get('from', {}).get('first_name'),
+            last_name=callback_query.get('from', {}).get('last_name')
+        )
+        
+        if not await callback_router.dispatch(data, chat_id, user):
+            set_callback_toast("⚠️ Действие недоступно")
+    finally:
+        answer.finish()
+        current_callback_answer.reset(answer_token)
+        current_navigation.reset(navigation_token)
 
 async def handle_subscription_check(chat_id: int, user_id: int):
     """Handle subscription check"""
+    # Пользователь мог отписаться и подписаться снова - проверяем без кэша во всех процессах
+    await invalidation_bus.publish("membership", user_id)
     is_subscribed = await check_subscription(user_id)
     if is_subscribed:
-        await db.users.update_one(
-            {"telegram_id": user_id},
-            {"$set": {"is_subscribed": True}}
+        # Mark subscription and confirm referral if exists
+        await run_concurrently(
+            update_user_document(
+                {"telegram_id": user_id},
+                {"$set": {"is_subscribed": True}}
+            ),
+            confirm_referral(user_id)
         )
         
-        # Confirm referral if exists
-        await confirm_referral(user_id)
-        
-        await send_telegram_message(
-            chat_id,
-            "✅ *Подписка подтверждена!*\n\n🎉 Теперь вы можете пользоваться сервисом!"
+        # Send confirmation while loading user for main menu
+        _, user_data = await run_concurrently(
+            send_telegram_message(
+                chat_id,
+                "✅ *Подписка подтверждена!*\n\n🎉 Теперь вы можете пользоваться сервисом!"
+            ),
+            db.users.find_one({"telegram_id": user_id}, {"_id": 0})
         )
-        
-        # Get user and show main menu
-        user_data = await db.users.find_one({"telegram_id": user_id})
         if user_data:
             user = User(**user_data)
             await show_main_menu(chat_id, user)
     else:
-        await send_telegram_message(
+        await send_menu_screen(
             chat_id,
             "❌ *Подписка не найдена*\n\n📢 Подпишитесь на канал @uzrisebya и попробуйте снова",
             reply_markup=create_subscription_keyboard()
@@ -633,24 +1612,20 @@ async def confirm_referral(user_id: int):
     try:
         referral = await db.referrals.find_one({"referred_id": user_id, "confirmed": False})
         if referral:
-            # Mark referral as confirmed
-            await db.referrals.update_one(
-                {"_id": referral["_id"]},
-                {"$set": {"confirmed": True}}
+            # Mark referral as confirmed; the referrer is notified by notification_service
+            result = await db.referrals.update_one(
+                {"_id": referral["_id"], "confirmed": False},
+                {"$set": {"confirmed": True, "confirmed_at": datetime.utcnow()}}
             )
+            if not result.modified_count:
+                return
             
             # Give 1 search attempt (25₽ equivalent) to referrer
-            await db.users.update_one(
+            await update_user_document(
                 {"telegram_id": referral["referrer_id"]},
                 {"$inc": {"balance": 25.0}}
             )
             
-            # Notify referrer
-            await send_telegram_message(
-                referral["referrer_id"],
-                f"🎉 *Подтвержденный реферал!*\n\n🔍 На ваш счет зачислена 1 попытка поиска\n💰 (эквивалент 25₽)"
-            )
-            
             logging.info(f"Referral confirmed: referrer {referral['referrer_id']}, referred {user_id}")
     except Exception as e:
         logging.error(f"Error confirming referral: {e}")
@@ -753,14 +1728,14 @@ async def show_main_menu(chat_id: int, user: User):
             ]
         }
     
-    await send_telegram_message(chat_id, welcome_text, reply_markup=keyboard)
+    await send_menu_screen(chat_id, welcome_text, reply_markup=keyboard)
 
 async def show_search_menu(chat_id: int, user: User):
     """Show search menu"""
     if not user.is_admin:
         is_subscribed = await check_subscription(user.telegram_id)
         if not is_subscribed:
-            await send_telegram_message(
+            await send_menu_screen(
                 chat_id,
                 "🔒 *Для поиска нужна подписка!*\n\n📢 Подпишитесь на @uzrisebya",
                 reply_markup=create_subscription_keyboard()
@@ -780,7 +1755,7 @@ async def show_search_menu(chat_id: int, user: User):
             search_text += f"💎 Нужно: 25 ₽ за поиск\n\n"
             search_text += f"💡 Пополните баланс или оформите подписку"
         
-        await send_telegram_message(chat_id, search_text, reply_markup=create_back_keyboard())
+        await send_menu_screen(chat_id, search_text, reply_markup=create_back_keyboard())
         return
     
     search_text = f"🔍 *ПОИСК ПО БАЗАМ ДАННЫХ*\n\n"
@@ -812,12 +1787,18 @@ async def show_search_menu(chat_id: int, user: User):
     
     search_text += f"➡️ *Просто отправьте данные для поиска*"
     
-    await send_telegram_message(chat_id, search_text, reply_markup=create_back_keyboard())
+    await send_menu_screen(chat_id, search_text, reply_markup=create_back_keyboard())
 
 async def show_profile_menu(chat_id: int, user: User):
     """Show profile menu"""
-    total_searches = await db.searches.count_documents({"user_id": user.telegram_id})
-    successful_searches = await db.searches.count_documents({"user_id": user.telegram_id, "success": True})
+    is_subscription_active = await has_active_subscription(user)
+    reads = [
+        db.searches.count_documents({"user_id": user.telegram_id}),
+        db.searches.count_documents({"user_id": user.telegram_id, "success": True})
+    ]
+    if is_subscription_active:
+        reads.append(check_daily_limit_reset(user))
+    total_searches, successful_searches, *_ = await run_concurrently(*reads)
     
     profile_text = f"👤 *ВАШ ПРОФИЛЬ*\n\n"
     profile_text += f"🆔 *ID:* `{user.telegram_id}`\n"
@@ -827,12 +1808,11 @@ async def show_profile_menu(chat_id: int, user: User):
     profile_text += f"💰 *ФИНАНСЫ:*\n"
     profile_text += f"💳 Баланс: {user.balance:.2f} ₽\n"
     
-    if await has_active_subscription(user):
+    if is_subscription_active:
         sub_type_names = {"day": "1 день", "3days": "3 дня", "month": "1 месяц"}
         sub_name = sub_type_names.get(user.subscription_type, user.subscription_type)
         expires = user.subscription_expires.strftime('%d.%m.%Y %H:%M')
         profile_text += f"✅ Подписка: {sub_name} до {expires}\n"
-        user = await check_daily_limit_reset(user)
         profile_text += f"🔍 Поисков сегодня: {user.daily_searches_used}/12\n"
     else:
         profile_text += f"❌ Подписка: Нет\n"
@@ -846,7 +1826,7 @@ async def show_profile_menu(chat_id: int, user: User):
     if user.is_admin:
         profile_text += f"👑 *Статус:* АДМИНИСТРАТОР\n"
     
-    await send_telegram_message(chat_id, profile_text, reply_markup=create_back_keyboard())
+    await send_menu_screen(chat_id, profile_text, reply_markup=create_back_keyboard())
 
 async def show_balance_menu(chat_id: int, user: User):
     """Show balance menu"""
@@ -863,7 +1843,7 @@ async def show_balance_menu(chat_id: int, user: User):
     balance_text += f"🔍 *Один поиск:* 25 ₽\n\n"
     balance_text += f"💼 *Или оформите подписку для экономии!*"
     
-    await send_telegram_message(chat_id, balance_text, reply_markup=create_balance_menu())
+    await send_menu_screen(chat_id, balance_text, reply_markup=create_balance_menu())
 
 async def show_pricing_menu(chat_id: int, user: User):
     """Show pricing menu"""
@@ -896,7 +1876,7 @@ async def show_pricing_menu(chat_id: int, user: User):
     
     pricing_text += f"💡 *Чем больше тариф, тем больше экономия!*"
     
-    await send_telegram_message(chat_id, pricing_text, reply_markup=create_pricing_menu())
+    await send_menu_screen(chat_id, pricing_text, reply_markup=create_pricing_menu())
 
 async def show_referral_menu(chat_id: int, user: User):
     """Show referral menu"""
@@ -921,7 +1901,7 @@ async def show_referral_menu(chat_id: int, user: User):
     referral_text += f"3. Друг подписывается на @uzrisebya\n"
     referral_text += f"4. Вам начисляется 1 попытка поиска"
     
-    await send_telegram_message(chat_id, referral_text, reply_markup=create_back_keyboard())
+    await send_menu_screen(chat_id, referral_text, reply_markup=create_back_keyboard())
 
 async def show_help_menu(chat_id: int, user: User):
     """Show help menu"""
@@ -947,7 +1927,7 @@ async def show_help_menu(chat_id: int, user: User):
     help_text += f"⚖️ *ВАЖНО:*\n"
     help_text += f"Перед использованием изучите правила сервиса"
     
-    await send_telegram_message(chat_id, help_text, reply_markup=create_back_keyboard())
+    await send_menu_screen(chat_id, help_text, reply_markup=create_back_keyboard())
 
 async def show_rules_menu(chat_id: int, user: User):
     """Show rules menu"""
@@ -984,7 +1964,7 @@ async def show_rules_menu(chat_id: int, user: User):
     
     rules_text += f"⚖️ *Используя сервис, вы подтверждаете согласие с данными правилами.*"
     
-    await send_telegram_message(chat_id, rules_text, reply_markup=create_back_keyboard())
+    await send_menu_screen(chat_id, rules_text, reply_markup=create_back_keyboard())
 
 async def handle_admin_callback(chat_id: int, user: User, data: str):
     """Handle admin callbacks"""
@@ -996,22 +1976,24 @@ async def handle_admin_callback(chat_id: int, user: User, data: str):
         admin_text += f"👥 *Пользователи* - список активных пользователей\n"
         admin_text += f"💳 *Платежи* - история транзакций"
         
-        await send_telegram_message(chat_id, admin_text, reply_markup=create_admin_menu())
+        await send_menu_screen(chat_id, admin_text, reply_markup=create_admin_menu())
     
     elif data == "admin_add_balance":
-        await send_telegram_message(
+        await send_menu_screen(
             chat_id,
             "💎 *НАЧИСЛЕНИЕ БАЛАНСА*\n\nОтправьте сообщение в формате:\n`ID СУММА`\n\nПример: `123456789 100`",
             reply_markup=create_back_keyboard()
         )
     
     elif data == "admin_stats":
-        total_users = await db.users.count_documents({})
-        total_searches = await db.searches.count_documents({})
-        total_revenue = await db.searches.aggregate([
-            {"$group": {"_id": None, "total": {"$sum": "$cost"}}}
-        ]).to_list(1)
-        active_subs = await db.users.count_documents({"subscription_expires": {"$gt": datetime.utcnow()}})
+        total_users, total_searches, total_revenue, active_subs = await run_concurrently(
+            db.users.count_documents({}),
+            db.searches.count_documents({}),
+            db.searches.aggregate([
+                {"$group": {"_id": None, "total": {"$sum": "$cost"}}}
+            ]).to_list(1),
+            db.users.count_documents({"subscription_expires": {"$gt": datetime.utcnow()}})
+        )
         
         stats_text = f"📊 *СТАТИСТИКА СЕРВИСА*\n\n"
         stats_text += f"👥 Пользователей: {total_users}\n"
@@ -1020,7 +2002,7 @@ async def handle_admin_callback(chat_id: int, user: User, data: str):
         revenue = total_revenue[0]['total'] if total_revenue else 0
         stats_text += f"💰 Выручка: {revenue:.2f} ₽"
         
-        await send_telegram_message(chat_id, stats_text, reply_markup=create_admin_menu())
+        await send_menu_screen(chat_id, stats_text, reply_markup=create_admin_menu())
 
 async def handle_payment_callback(chat_id: int, user: User, data: str):
     """Handle payment callbacks"""
@@ -1057,7 +2039,7 @@ async def handle_payment_callback(chat_id: int, user: User, data: str):
             ]
         }
         
-        await send_telegram_message(chat_id, crypto_text, reply_markup=crypto_keyboard)
+        await send_menu_screen(chat_id, crypto_text, reply_markup=crypto_keyboard)
     
     elif data == "pay_stars":
         # Telegram Stars пополнение
@@ -1090,24 +2072,24 @@ async def handle_payment_callback(chat_id: int, user: User, data: str):
             ]
         }
         
-        await send_telegram_message(chat_id, stars_text, reply_markup=stars_keyboard)
+        await send_menu_screen(chat_id, stars_text, reply_markup=stars_keyboard)
     
     elif data == "buy_single_search":
         if user.balance >= 25.0:
-            await send_telegram_message(
+            await send_menu_screen(
                 chat_id,
                 "✅ *У вас уже есть средства для поиска*\n\n🔍 Перейдите в раздел 'Поиск'",
                 reply_markup=create_back_keyboard()
             )
         else:
             needed = 25.0 - user.balance
-            await send_telegram_message(
+            await send_menu_screen(
                 chat_id,
                 f"💳 *ПОКУПКА ПОИСКА*\n\n💎 Нужно доплатить: {needed:.2f} ₽\n\n💡 Пополните баланс на сумму от 100 ₽",
                 reply_markup=create_balance_menu()
             )
 
-async def handle_crypto_payment_amount(chat_id: int, user: User, crypto_type: str, amount: str):
+async def handle_crypto_payment_amount(chat_id: int, user: User, crypto_type: str, amount: float):
     """Handle crypto payment with specific amount"""
     crypto_names = {
         "btc": "Bitcoin (BTC)",
@@ -1116,58 +2098,51 @@ async def handle_crypto_payment_amount(chat_id: int, user: User, crypto_type: st
         "ltc": "Litecoin (LTC)"
     }
     
-    try:
-        amount_float = float(amount)
-        if amount_float < 100:
-            await send_telegram_message(
-                chat_id,
-                "❌ Минимальная сумма пополнения: 100 ₽",
-                reply_markup=create_back_keyboard()
-            )
-            return
-            
-        # Create CryptoBot invoice
-        invoice_result = await create_cryptobot_invoice(amount_float, user.telegram_id, currency="RUB")
+    # Счёт - новое сообщение, а не экран меню: он должен остаться в чате
+    amount_float = float(amount)
+    if amount_float < 100:
+        await send_telegram_message(
+            chat_id,
+            "❌ Минимальная сумма пополнения: 100 ₽",
+            reply_markup=create_back_keyboard()
+        )
+        return
+        
+    # Create CryptoBot invoice
+    invoice_result = await create_cryptobot_invoice(amount_float, user.telegram_id, currency="RUB")
+    
+    if invoice_result.get('ok'):
+        invoice_data = invoice_result.get('result', {})
+        invoice_url = invoice_data.get('bot_invoice_url')
+        invoice_id = invoice_data.get('invoice_id')
         
-        if invoice_result.get('ok'):
-            invoice_data = invoice_result.get('result', {})
-            invoice_url = invoice_data.get('bot_invoice_url')
-            invoice_id = invoice_data.get('invoice_id')
+        if invoice_url:
+            wallet_text = f"💰 *ПОПОЛНЕНИЕ ЧЕРЕЗ {crypto_names.get(crypto_type, crypto_type.upper())}*\n\n"
+            wallet_text += f"💎 Сумма: {amount_float} ₽\n"
+            wallet_text += f"📋 ID платежа: {invoice_id}\n\n"
+            wallet_text += f"⚡ *Зачисление:* 1-30 минут после оплаты\n"
+            wallet_text += f"📞 *Поддержка:* @Sigicara\n\n"
+            wallet_text += f"👆 *Нажмите кнопку ниже для оплаты*"
             
-            if invoice_url:
-                wallet_text = f"💰 *ПОПОЛНЕНИЕ ЧЕРЕЗ {crypto_names.get(crypto_type, crypto_type.upper())}*\n\n"
-                wallet_text += f"💎 Сумма: {amount_float} ₽\n"
-                wallet_text += f"📋 ID платежа: {invoice_id}\n\n"
-                wallet_text += f"⚡ *Зачисление:* 1-30 минут после оплаты\n"
-                wallet_text += f"📞 *Поддержка:* @Sigicara\n\n"
-                wallet_text += f"👆 *Нажмите кнопку ниже для оплаты*"
-                
-                keyboard = {
-                    "inline_keyboard": [
-                        [{"text": "💳 Оплатить", "url": invoice_url}],
-                        [{"text": "◀️ Назад", "callback_data": "menu_balance"}]
-                    ]
-                }
-                
-                await send_telegram_message(chat_id, wallet_text, reply_markup=keyboard)
-            else:
-                await send_telegram_message(
-                    chat_id,
-                    "❌ Ошибка создания платежа. Попробуйте позже.",
-                    reply_markup=create_back_keyboard()
-                )
+            keyboard = {
+                "inline_keyboard": [
+                    [{"text": "💳 Оплатить", "url": invoice_url}],
+                    [{"text": "◀️ Назад", "callback_data": "menu_balance"}]
+                ]
+            }
+            
+            await send_telegram_message(chat_id, wallet_text, reply_markup=keyboard)
         else:
-            error_msg = invoice_result.get('error', {}).get('message', 'Неизвестная ошибка')
             await send_telegram_message(
                 chat_id,
-                f"❌ Ошибка создания платежа: {error_msg}",
+                "❌ Ошибка создания платежа. Попробуйте позже.",
                 reply_markup=create_back_keyboard()
             )
-        
-    except ValueError:
+    else:
+        error_msg = invoice_result.get('error', {}).get('message', 'Неизвестная ошибка')
         await send_telegram_message(
             chat_id,
-            "❌ Неверная сумма",
+            f"❌ Ошибка создания платежа: {error_msg}",
             reply_markup=create_back_keyboard()
         )
 
@@ -1208,7 +2183,7 @@ async def handle_crypto_payment(chat_id: int, user: User, crypto_type: str):
         ]
     }
     
-    await send_telegram_message(chat_id, crypto_text, reply_markup=crypto_amounts_keyboard)
+    await send_menu_screen(chat_id, crypto_text, reply_markup=crypto_amounts_keyboard)
 
 async def handle_stars_custom_amount(chat_id: int, user: User):
     """Handle custom amount for Telegram Stars payment"""
@@ -1220,7 +2195,7 @@ async def handle_stars_custom_amount(chat_id: int, user: User):
     text += f"💡 Сумма должна быть кратна 50₽\n\n"
     text += f"❌ Для отмены нажмите кнопку"
     
-    await send_telegram_message(
+    await send_menu_screen(
         chat_id,
         text,
         reply_markup=create_back_keyboard()
@@ -1242,20 +2217,20 @@ async def handle_crypto_custom_amount(chat_id: int, user: User, crypto_type: str
     text += f"💡 Сумма должна быть кратна 50₽\n\n"
     text += f"❌ Для отмены нажмите кнопку"
     
-    await send_telegram_message(
+    await send_menu_screen(
         chat_id,
         text,
         reply_markup=create_back_keyboard()
     )
 
-async def handle_stars_payment(chat_id: int, user: User, amount: str):
+async def handle_stars_payment(chat_id: int, user: User, amount: int):
     """Handle Telegram Stars payment"""
     amounts = {
-        "100": (50, 100),
-        "250": (125, 250),
-        "500": (250, 500),
-        "1000": (500, 1000),
-        "2000": (1000, 2000)
+        100: (50, 100),
+        250: (125, 250),
+        500: (250, 500),
+        1000: (500, 1000),
+        2000: (1000, 2000)
     }
     
     if amount not in amounts:
@@ -1268,7 +2243,6 @@ async def handle_stars_payment(chat_id: int, user: User, amount: str):
         invoice_payload = f"stars_payment_{user.telegram_id}_{amount}"
         
         # Создаем инвойс для оплаты звездами
-        url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendInvoice"
         invoice_data = {
             "chat_id": chat_id,
             "title": f"Пополнение баланса на {rubles}₽",
@@ -1278,8 +2252,8 @@ async def handle_stars_payment(chat_id: int, user: User, amount: str):
             "prices": [{"label": f"Пополнение {rubles}₽", "amount": stars_needed}]
         }
         
-        response = requests.post(url, json=invoice_data)
-        if response.status_code == 200:
+        result = await telegram_api_request("sendInvoice", invoice_data)
+        if result.get('ok'):
             await send_telegram_message(
                 chat_id,
                 f"⭐ *ОПЛАТА ЗВЕЗДАМИ*\n\n💰 Сумма: {rubles}₽\n⭐ К оплате: {stars_needed} звезд\n\n👆 Нажмите кнопку выше для оплаты"
@@ -1312,7 +2286,7 @@ async def handle_purchase_callback(chat_id: int, user: User, data: str):
             # Purchase subscription
             expires = datetime.utcnow() + timedelta(days=days)
             
-            await db.users.update_one(
+            await update_user_document(
                 {"telegram_id": user.telegram_id},
                 {
                     "$set": {
@@ -1358,7 +2332,6 @@ async def handle_custom_stars_amount_input(chat_id: int, user: User, text: str):
     try:
         invoice_payload = f"stars_payment_{user.telegram_id}_{amount}"
         
-        url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendInvoice"
         invoice_data = {
             "chat_id": chat_id,
             "title": f"Пополнение баланса на {amount}₽",
@@ -1368,8 +2341,8 @@ async def handle_custom_stars_amount_input(chat_id: int, user: User, text: str):
             "prices": [{"label": f"Пополнение {amount}₽", "amount": stars_needed}]
         }
         
-        response = requests.post(url, json=invoice_data)
-        if response.status_code == 200:
+        result = await telegram_api_request("sendInvoice", invoice_data)
+        if result.get('ok'):
             await send_telegram_message(
                 chat_id,
                 f"⭐ *ОПЛАТА ЗВЕЗДАМИ*\n\n💰 Сумма: {amount}₽\n⭐ К оплате: {stars_needed} звезд\n\n👆 Нажмите кнопку выше для оплаты"
@@ -1400,14 +2373,13 @@ async def handle_custom_crypto_amount_input(chat_id: int, user: User, text: str,
         )
         return
     
-    await handle_crypto_payment_amount(chat_id, user, crypto_type, str(amount))
+    await handle_crypto_payment_amount(chat_id, user, crypto_type, amount)
 
 
 async def handle_pre_checkout_query(pre_checkout_query: Dict[str, Any]):
     """Handle pre-checkout query from Telegram Stars payments"""
     try:
         query_id = pre_checkout_query.get('id')
-        url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/answerPreCheckoutQuery"
         
         # Always approve the payment at this stage
         payload = {
@@ -1415,9 +2387,9 @@ async def handle_pre_checkout_query(pre_checkout_query: Dict[str, Any]):
             "ok": True
         }
         
-        response = requests.post(url, json=payload)
-        if response.status_code != 200:
-            logging.error(f"Failed to answer pre-checkout query: {response.text}")
+        result = await telegram_api_request("answerPreCheckoutQuery", payload)
+        if not result.get('ok'):
+            logging.error(f"Failed to answer pre-checkout query: {result.get('description')}")
             
     except Exception as e:
         logging.error(f"Error handling pre-checkout query: {e}")
@@ -1454,13 +2426,12 @@ async def handle_successful_payment(message: Dict[str, Any]):
             await db.payments.insert_one(payment.dict())
             
             # Update user balance
-            await db.users.update_one(
+            await update_user_document(
                 {"telegram_id": user_id},
                 {"$inc": {"balance": amount}}
             )
             
             # Send confirmation message
-            url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage"
             message_text = (
                 f"✅ *Оплата успешно проведена!*\n\n"
                 f"💰 Сумма: {amount} ₽\n"
@@ -1474,12 +2445,87 @@ async def handle_successful_payment(message: Dict[str, Any]):
                 "parse_mode": "Markdown"
             }
             
-            requests.post(url, json=payload)
+            await telegram_api_request("sendMessage", payload)
             
     except Exception as e:
         logging.error(f"Error handling successful payment: {e}")
+
+
+update_rate_limiters = {
+    "message": SlidingWindowLimiter(RATE_LIMIT_MESSAGES, RATE_LIMIT_WINDOW),
+    "callback_query": SlidingWindowLimiter(RATE_LIMIT_CALLBACKS, RATE_LIMIT_WINDOW)
+}
+global_rate_limiter = SlidingWindowLimiter(RATE_LIMIT_GLOBAL, RATE_LIMIT_WINDOW)
+
+rate_limit_stats = {
+    "allowed": 0,
+    "shed_user": 0,
+    "shed_global": 0,
+    "soft_replies": 0
+}
+
+def throttle_update(update_data: Dict[str, Any]) -> bool:
+    """Check update against rate limits; shed updates get a soft reply. Returns True if shed"""
+    if 'callback_query' in update_data:
+        update_type = "callback_query"
+        callback_query = update_data['callback_query']
+        user_id = callback_query.get('from', {}).get('id')
+    elif 'message' in update_data and not update_data['message'].get('successful_payment'):
+        update_type = "message"
+        message = update_data['message']
+        user_id = message.get('from', {}).get('id') or message.get('chat', {}).get('id')
+    else:
+        return False
+    
+    if not update_rate_limiters[update_type].hit(user_id):
+        rate_limit_stats["shed_user"] += 1
+        reason = "user"
+    elif not global_rate_limiter.hit("global"):
+        rate_limit_stats["shed_global"] += 1
+        reason = "global"
+    else:
+        rate_limit_stats["allowed"] += 1
+        return False
+    
+    # Колбэк отвечаем всегда, иначе кнопка зависнет; на сообщения - один раз за окно
+    if update_type == "callback_query":
+        rate_limit_stats["soft_replies"] += 1
+        spawn_background_task(telegram_api_request("answerCallbackQuery", {
+            "callback_query_id": callback_query.get('id'),
+            "text": "⏳ Слишком много нажатий, подождите немного"
+        }))
+    elif reason == "user" and update_rate_limiters[update_type].notify_once(user_id):
+        rate_limit_stats["soft_replies"] += 1
+        spawn_background_task(telegram_api_request("sendMessage", {
+            "chat_id": message.get('chat', {}).get('id', user_id),
+            "text": "⏳ Слишком много сообщений. Подождите несколько секунд и повторите"
+        }))
+    return True
+
+@timed(handler_latency, handler_errors, "update")
 async def handle_telegram_update(update_data: Dict[str, Any]):
-    """Process incoming Telegram update"""
+    """Process incoming Telegram update, counting its database round-trips"""
+    update_type = next((key for key in ("message", "callback_query", "pre_checkout_query") if key in update_data), "other")
+    roundtrips = [0]
+    token = update_db_roundtrips.set(roundtrips)
+    try:
+        with tracer.trace(
+            "telegram.update",
+            update_id=update_data.get("update_id"),
+            update_type=update_type,
+            user_id=update_data.get(update_type, {}).get("from", {}).get("id")
+        ) as span:
+            await route_telegram_update(update_data)
+            span.attributes["db_roundtrips"] = roundtrips[0]
+    finally:
+        update_db_roundtrips.reset(token)
+        db_roundtrips_per_update.observe(roundtrips[0], update_type)
+
+async def route_telegram_update(update_data: Dict[str, Any]):
+    """Pass update to the handler for its type"""
+    if throttle_update(update_data):
+        return
+    
     # Handle pre_checkout_query for Telegram Stars payments
     pre_checkout_query = update_data.get('pre_checkout_query')
     if pre_checkout_query:
@@ -1555,30 +2601,41 @@ async def handle_telegram_update(update_data: Dict[str, Any]):
                 target_id = int(parts[0])
                 amount = float(parts[1])
                 
-                result = await db.users.update_one(
+                result = await update_user_document(
                     {"telegram_id": target_id},
                     {"$inc": {"balance": amount}}
                 )
                 
                 if result.modified_count > 0:
+                    # Пользователя уведомит notification_service
+                    await db.payments.insert_one(Payment(
+                        user_id=target_id,
+                        amount=amount,
+                        payment_type="admin",
+                        status="completed",
+                        details={"admin_id": user.telegram_id}
+                    ).dict())
+                    
                     await send_telegram_message(
                         chat_id,
                         f"✅ *Баланс начислен*\n\n👤 ID: {target_id}\n💰 Сумма: {amount} ₽"
                     )
-                    
-                    await send_telegram_message(
-                        target_id,
-                        f"🎁 *Начисление баланса*\n\n💰 На ваш счет зачислено: {amount} ₽\n\n💡 Теперь вы можете пользоваться сервисом!"
-                    )
                 else:
                     await send_telegram_message(chat_id, "❌ Пользователь не найден")
             except:
                 await send_telegram_message(chat_id, "❌ Неверный формат команды")
     
+    # Handle batch search: uploaded list or several queries, one per line
+    elif message.get('document'):
+        await handle_batch_document(chat_id, user, message['document'])
+    elif '\n' in text.strip():
+        await handle_batch_search(chat_id, user, text.splitlines())
+    
     # Handle search queries
     else:
         await handle_search_query(chat_id, text, user)
 
+@instrumented("search")
 async def handle_search_query(chat_id: int, query: str, user: User):
     """Handle search query"""
     if not user.is_admin:
@@ -1608,76 +2665,308 @@ async def handle_search_query(chat_id: int, query: str, user: User):
             )
         return
     
-    search_type = detect_search_type(query)
+    classification = classify_query(query)
+    search_type = classification.search_type
     
-    await send_telegram_message(
-        chat_id,
-        f"🔍 *Выполняю поиск...*\n{search_type}\n⏱️ Подождите..."
-    )
+    reservation, payment_method = await reserve_searches(user)
+    if reservation is None:
+        await send_telegram_message(
+            chat_id,
+            f"💰 *Поиск недоступен*\n\n{payment_method}",
+            reply_markup=create_balance_menu()
+        )
+        return
     
     try:
-        results = await usersbox_request("/search", {"q": query})
+        await send_telegram_message(
+            chat_id,
+            f"🔍 *Выполняю поиск...*\n{search_type}\n⏱️ Подождите..."
+        )
         
-        formatted_results = format_search_results(results, query, search_type)
-        await send_telegram_message(chat_id, formatted_results, reply_markup=create_main_menu())
+        results = await search_usersbox(query, classification, user.telegram_id, reservation.payment_method)
+        success = results.get('status') == 'success'
         
-        # Process payment and save search
-        cost = 0.0
-        if not user.is_admin:
-            if await has_active_subscription(user):
-                await db.users.update_one(
-                    {"telegram_id": user.telegram_id},
-                    {"$inc": {"daily_searches_used": 1}}
-                )
-                payment_method = "subscription"
-            else:
-                cost = 25.0
-                await db.users.update_one(
-                    {"telegram_id": user.telegram_id},
-                    {"$inc": {"balance": -25.0}}
-                )
-                payment_method = "balance"
+        # Списываем только за успешный ответ, ошибки и таймауты возвращаем
+        if success:
+            await settle_reservation(user.telegram_id, reservation)
+        else:
+            await release_reservation(user.telegram_id, reservation)
         
         search = Search(
             user_id=user.telegram_id,
             query=query,
+            normalized_query=classification.normalized,
             search_type=search_type,
             results=results,
-            success=results.get('status') == 'success',
-            cost=cost,
-            payment_method=payment_method
+            success=success,
+            cost=reservation.amount if success else 0.0,
+            payment_method=payment_method,
+            reservation_id=reservation.reservation_id,
+            charge_status="committed" if success else "released"
         )
         await db.searches.insert_one(search.dict())
+        
+        if results_fit_inline(results):
+            formatted_results = format_search_results(results, query, search_type)
+            await send_telegram_message(chat_id, formatted_results, reply_markup=create_main_menu())
+        else:
+            await send_results_archive(
+                chat_id,
+                [(query, search_type, results)],
+                format_search_summary(results, query, search_type),
+                reply_markup=create_main_menu()
+            )
     
     except Exception as e:
+        logging.error(f"Search failed for user {user.telegram_id}: {e}")
+        await release_reservation(user.telegram_id, reservation)
         await send_telegram_message(
             chat_id,
             "❌ Ошибка при выполнении поиска. Попробуйте позже.",
             reply_markup=create_main_menu()
         )
 
+def parse_batch_queries(lines: List[str]) -> List[tuple[str, QueryClassification]]:
+    """Classify batch lines, skipping empty lines and duplicates of the same normalized query"""
+    seen = set()
+    queries = []
+    for line in lines:
+        query = line.strip()
+        if not query:
+            continue
+        classification = classify_query(query)
+        cache_key = search_cache_key(classification)
+        if cache_key in seen:
+            continue
+        seen.add(cache_key)
+        queries.append((query, classification))
+    return queries
+
+def read_batch_document(file_name: str, content: bytes) -> List[str]:
+    """Extract query lines from uploaded .txt or .csv (first non-empty cell of each row)"""
+    try:
+        text = content.decode('utf-8-sig')
+    except UnicodeDecodeError:
+        text = content.decode('cp1251', errors='replace')
+    
+    if not file_name.lower().endswith('.csv'):
+        return text.splitlines()
+    
+    first_line = text.split('\n', 1)[0]
+    delimiter = ';' if first_line.count(';') > first_line.count(',') else ','
+    return [
+        next((cell for cell in row if cell.strip()), '')
+        for row in csv.reader(io.StringIO(text), delimiter=delimiter)
+    ]
+
+async def download_telegram_file(file_id: str) -> bytes:
+    """Download file sent to the bot"""
+    file_info = await telegram_api_request("getFile", {"file_id": file_id})
+    if not file_info.get('ok'):
+        raise RuntimeError(file_info.get('description', 'getFile failed'))
+    
+    url = f"https://api.telegram.org/file/bot{TELEGRAM_TOKEN}/{file_info['result']['file_path']}"
+    response = await telegram_breaker.call(http_session.get, url, timeout=30)
+    response.raise_for_status()
+    return response.content
+
+async def send_telegram_document(chat_id: int, file_name: str, content, caption: str = None, parse_mode: str = "Markdown", reply_markup: dict = None) -> bool:
+    """Send file (bytes or file object) to Telegram user"""
+    url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendDocument"
+    data = {"chat_id": chat_id}
+    if caption:
+        data["caption"] = caption
+        data["parse_mode"] = parse_mode
+    if reply_markup:
+        data["reply_markup"] = json.dumps(reply_markup)
+    
+    try:
+        response = await telegram_breaker.call(
+            http_session.post, url, data=data, files={"document": (file_name, content)}, timeout=60
+        )
+        return response.status_code == 200
+    except Exception as e:
+        logging.error(f"Failed to send Telegram document: {e}")
+        return False
+
+async def resolve_batch_queries(queries: List[tuple[str, QueryClassification]], user_id: int, tier: str) -> List[Dict[str, Any]]:
+    """Run batch searches with bounded concurrency, results in query order"""
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+    
+    async def resolve(query: str, classification: QueryClassification) -> Dict[str, Any]:
+        async with semaphore:
+            return await search_usersbox(query, classification, user_id, tier)
+    
+    return await asyncio.gather(*(resolve(query, classification) for query, classification in queries))
+
+@instrumented("batch_search")
+async def handle_batch_search(chat_id: int, user: User, lines: List[str]):
+    """Handle list of search queries: one reservation, concurrent lookups, one result document"""
+    queries = parse_batch_queries(lines)
+    
+    if not queries:
+        await send_telegram_message(chat_id, "❌ Список запросов пуст", reply_markup=create_main_menu())
+        return
+    
+    if len(queries) == 1:
+        await handle_search_query(chat_id, queries[0][0], user)
+        return
+    
+    if len(queries) > BATCH_MAX_QUERIES:
+        await send_telegram_message(
+            chat_id,
+            f"❌ *Слишком много запросов*\n\nВ списке {len(queries)} уникальных запросов, максимум: {BATCH_MAX_QUERIES}",
+            reply_markup=create_main_menu()
+        )
+        return
+    
+    if not user.is_admin:
+        is_subscribed = await check_subscription(user.telegram_id)
+        if not is_subscribed:
+            await send_telegram_message(
+                chat_id,
+                "🔒 Для поиска нужна подписка на @uzrisebya",
+                reply_markup=create_subscription_keyboard()
+            )
+            return
+    
+    reservation, payment_method = await reserve_searches(user, len(queries))
+    if reservation is None:
+        await send_telegram_message(
+            chat_id,
+            f"💰 *Пакетный поиск недоступен*\n\n{payment_method}",
+            reply_markup=create_balance_menu()
+        )
+        return
+    
+    await send_telegram_message(
+        chat_id,
+        f"📦 *Выполняю пакетный поиск...*\n🔍 Запросов: {len(queries)}\n⏱️ Подождите..."
+    )
+    
+    try:
+        heartbeat = spawn_background_task(keep_reservation_alive(user.telegram_id, reservation))
+        try:
+            results = await resolve_batch_queries(queries, user.telegram_id, reservation.payment_method)
+        finally:
+            heartbeat.cancel()
+        
+        # Списываем только успешные запросы, остальное возвращаем одним обновлением
+        succeeded = sum(1 for r in results if r.get('status') == 'success')
+        await settle_reservation(user.telegram_id, reservation, used_units=succeeded)
+        
+        batch_id = str(uuid.uuid4())
+        unit_cost = reservation.amount / reservation.units
+        await db.searches.insert_many([
+            Search(
+                user_id=user.telegram_id,
+                query=query,
+                normalized_query=classification.normalized,
+                search_type=classification.search_type,
+                results=query_results,
+                success=query_results.get('status') == 'success',
+                cost=unit_cost if query_results.get('status') == 'success' else 0.0,
+                payment_method=payment_method,
+                batch_id=batch_id,
+                reservation_id=reservation.reservation_id,
+                charge_status="committed" if query_results.get('status') == 'success' else "released"
+            ).dict()
+            for (query, classification), query_results in zip(queries, results)
+        ])
+        
+        found = sum(1 for r in results if r.get('status') == 'success' and r.get('data', {}).get('count', 0) > 0)
+        failed = len(results) - succeeded
+        summary = f"📦 *ПАКЕТНЫЙ ПОИСК ЗАВЕРШЕН*\n\n"
+        summary += f"🔍 Запросов: {len(queries)}\n"
+        summary += f"✅ С результатами: {found}\n"
+        summary += f"❌ Ошибок: {failed}\n"
+        if failed and payment_method != "admin":
+            summary += f"↩️ За ошибочные запросы списание отменено\n"
+        summary += f"\n📄 Результаты в файле"
+        
+        entries = [
+            (query, classification.search_type, query_results)
+            for (query, classification), query_results in zip(queries, results)
+        ]
+        await send_results_archive(chat_id, entries, summary, reply_markup=create_main_menu())
+    
+    except Exception as e:
+        logging.error(f"Batch search failed for user {user.telegram_id}: {e}")
+        await release_reservation(user.telegram_id, reservation)
+        await send_telegram_message(
+            chat_id,
+            "❌ Ошибка при выполнении пакетного поиска. Обратитесь в поддержку @Sigicara",
+            reply_markup=create_main_menu()
+        )
+
+@instrumented("batch_document")
+async def handle_batch_document(chat_id: int, user: User, document: Dict[str, Any]):
+    """Handle .txt/.csv document with search queries"""
+    file_name = document.get('file_name') or ''
+    if not file_name.lower().endswith(BATCH_FILE_EXTENSIONS):
+        await send_telegram_message(
+            chat_id,
+            "❌ Для пакетного поиска отправьте файл .txt или .csv (один запрос в строке)",
+            reply_markup=create_main_menu()
+        )
+        return
+    
+    if document.get('file_size', 0) > BATCH_MAX_FILE_SIZE:
+        await send_telegram_message(
+            chat_id,
+            f"❌ Файл слишком большой. Максимум: {BATCH_MAX_FILE_SIZE // 1024} КБ",
+            reply_markup=create_main_menu()
+        )
+        return
+    
+    try:
+        content = await download_telegram_file(document['file_id'])
+    except Exception as e:
+        logging.error(f"Failed to download batch document: {e}")
+        await send_telegram_message(
+            chat_id,
+            "❌ Не удалось загрузить файл. Попробуйте позже.",
+            reply_markup=create_main_menu()
+        )
+        return
+    
+    await handle_batch_search(chat_id, user, read_batch_document(file_name, content))
+
+def get_user_state_timeout(state: str) -> int:
+    """Get expiry timeout in seconds for a user state type"""
+    return USER_STATE_TIMEOUTS.get(state, USER_STATE_DEFAULT_TIMEOUT)
+
 async def set_user_state(user_id: int, state: str, data: Dict[str, Any] = None):
     """Set user state for custom input"""
+    now = datetime.utcnow()
     user_state = UserState(
         user_id=user_id,
         state=state,
-        data=data or {}
+        data=data or {},
+        created_at=now,
+        expires_at=now + timedelta(seconds=get_user_state_timeout(state))
+    )
+    # Одна атомарная запись: заменяем текущее состояние или создаем новое
+    await db.user_states.replace_one(
+        {"user_id": user_id},
+        user_state.dict(),
+        upsert=True
     )
-    # Удаляем старое состояние если есть
-    await db.user_states.delete_many({"user_id": user_id})
-    # Добавляем новое состояние
-    await db.user_states.insert_one(user_state.dict())
 
 async def get_user_state(user_id: int) -> Optional[UserState]:
     """Get user state"""
-    state_data = await db.user_states.find_one({"user_id": user_id})
+    # TTL-монитор MongoDB работает раз в минуту, поэтому просроченные состояния отсекаем в запросе
+    state_data = await db.user_states.find_one(
+        {"user_id": user_id, "expires_at": {"$gt": datetime.utcnow()}},
+        {"_id": 0}
+    )
     if state_data:
         return UserState(**state_data)
     return None
 
 async def clear_user_state(user_id: int):
     """Clear user state"""
-    await db.user_states.delete_many({"user_id": user_id})
+    await db.user_states.delete_one({"user_id": user_id})
 
 def validate_custom_amount(amount_str: str) -> tuple[bool, str, float]:
     """Validate custom amount input"""
@@ -1717,13 +3006,14 @@ async def create_cryptobot_invoice(amount: float, user_id: int, currency: str =
             "payload": f"crypto_payment_{user_id}_{amount}"
         }
         
-        response = requests.post(url, headers=headers, json=payload, timeout=30)
+        response = await cryptobot_breaker.call(http_session.post, url, headers=headers, json=payload)
         return response.json()
         
     except Exception as e:
         logging.error(f"CryptoBot API error: {e}")
         return {"ok": False, "error": {"message": str(e)}}
 
+@instrumented("pre_checkout_query")
 async def handle_pre_checkout_query(pre_checkout_query: Dict[str, Any]):
     """Handle pre-checkout query for Telegram Stars payments"""
     query_id = pre_checkout_query.get('id')
@@ -1733,26 +3023,25 @@ async def handle_pre_checkout_query(pre_checkout_query: Dict[str, Any]):
     try:
         # Always approve the pre-checkout query for valid Stars payments
         if invoice_payload.startswith('stars_payment_'):
-            url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/answerPreCheckoutQuery"
             data = {
                 "pre_checkout_query_id": query_id,
                 "ok": True
             }
-            requests.post(url, json=data, timeout=10)
+            await telegram_api_request("answerPreCheckoutQuery", data)
             logging.info(f"Pre-checkout approved for user {user_id}")
         else:
             # Reject invalid payments
-            url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/answerPreCheckoutQuery"
             data = {
                 "pre_checkout_query_id": query_id,
                 "ok": False,
                 "error_message": "Неверный платеж"
             }
-            requests.post(url, json=data, timeout=10)
+            await telegram_api_request("answerPreCheckoutQuery", data)
             logging.warning(f"Pre-checkout rejected for user {user_id}: invalid payload")
     except Exception as e:
         logging.error(f"Error handling pre-checkout query: {e}")
 
+@instrumented("successful_payment")
 async def handle_successful_payment(message: Dict[str, Any]):
     """Handle successful payment notification"""
     payment_info = message.get('successful_payment', {})
@@ -1775,7 +3064,7 @@ async def handle_successful_payment(message: Dict[str, Any]):
                 ruble_amount = total_amount * 2  # 1 star = 2 rubles
             
             # Update user balance
-            result = await db.users.update_one(
+            result = await update_user_document(
                 {"telegram_id": user_id},
                 {"$inc": {"balance": ruble_amount}}
             )
@@ -1787,24 +3076,12 @@ async def handle_successful_payment(message: Dict[str, Any]):
                     amount=ruble_amount,
                     payment_type="stars",
                     payment_id=payment_info.get('telegram_payment_charge_id'),
-                    status="completed"
+                    status="completed",
+                    details={"stars": total_amount}
                 )
+                # Уведомление отправит notification_service
                 await db.payments.insert_one(payment.dict())
                 
-                # Send notification to user
-                notification_text = f"🎉 *ПОПОЛНЕНИЕ УСПЕШНО!*\n\n"
-                notification_text += f"⭐ *Способ:* Telegram Stars\n"
-                notification_text += f"💰 *Сумма:* {ruble_amount}₽\n"
-                notification_text += f"⭐ *Звезд потрачено:* {total_amount}\n\n"
-                notification_text += f"✅ *Средства зачислены на баланс*\n"
-                notification_text += f"🔍 *Теперь вы можете пользоваться сервисом!*"
-                
-                await send_telegram_message(
-                    chat_id,
-                    notification_text,
-                    reply_markup=create_main_menu()
-                )
-                
                 logging.info(f"Stars payment processed: {ruble_amount}₽ for user {user_id}")
             else:
                 logging.error(f"Failed to update balance for user {user_id}")
@@ -1842,21 +3119,211 @@ async def process_referral(referred_user_id: int, referral_code: str) -> bool:
         )
         await db.referrals.insert_one(referral.dict())
 
-        await db.users.update_one(
+        await update_user_document(
             {"telegram_id": referrer['telegram_id']},
             {"$inc": {"total_referrals": 1}}
         )
 
-        await send_telegram_message(
-            referrer['telegram_id'],
-            f"👥 *Новый реферал!*\n\nПользователь перешел по вашей ссылке\n🔍 1 попытка поиска будет начислена после подписки на канал"
-        )
-
         return True
     except Exception as e:
         logging.error(f"Referral processing error: {e}")
         return False
 
+# Notifications
+def payment_notification(payment: Dict[str, Any]) -> Optional[Notification]:
+    """Message about a completed balance top-up"""
+    amount = payment["amount"]
+    details = payment.get("details") or {}
+    payment_type = payment["payment_type"]
+    
+    if payment_type == "admin":
+        text = f"🎁 *Начисление баланса*\n\n💰 На ваш счет зачислено: {amount} ₽\n\n💡 Теперь вы можете пользоваться сервисом!"
+        return Notification(f"payment:{payment['_id']}", payment["user_id"], text)
+    
+    text = f"🎉 *ПОПОЛНЕНИЕ УСПЕШНО!*\n\n"
+    if payment_type == "stars":
+        text += f"⭐ *Способ:* Telegram Stars\n"
+        text += f"💰 *Сумма:* {amount}₽\n"
+        text += f"⭐ *Звезд потрачено:* {details.get('stars')}\n\n"
+    elif payment_type == "crypto":
+        text += f"🤖 *Способ:* Криптовалюта\n"
+        text += f"💰 *Сумма:* {amount}₽\n"
+        text += f"📋 *ID платежа:* {payment.get('payment_id')}\n\n"
+    else:
+        return None
+    text += f"✅ *Средства зачислены на баланс*\n"
+    text += f"🔍 *Теперь вы можете пользоваться сервисом!*"
+    return Notification(f"payment:{payment['_id']}", payment["user_id"], text, create_main_menu())
+
+def new_referral_notification(referral: Dict[str, Any]) -> Optional[Notification]:
+    return Notification(
+        f"referral_new:{referral['_id']}",
+        referral["referrer_id"],
+        f"👥 *Новый реферал!*\n\nПользователь перешел по вашей ссылке\n🔍 1 попытка поиска будет начислена после подписки на канал"
+    )
+
+def confirmed_referral_notification(referral: Dict[str, Any]) -> Optional[Notification]:
+    return Notification(
+        f"referral_confirmed:{referral['_id']}",
+        referral["referrer_id"],
+        f"🎉 *Подтвержденный реферал!*\n\n🔍 На ваш счет зачислена 1 попытка поиска\n💰 (эквивалент 25₽)"
+    )
+
+notification_service = NotificationService(
+    db,
+    lambda chat_id, text, reply_markup=None: send_telegram_message(chat_id, text, reply_markup=reply_markup),
+    [
+        NotificationSource("payments", "payments", "insert", "created_at", payment_notification, {"status": "completed"}),
+        NotificationSource("referrals_new", "referrals", "insert", "timestamp", new_referral_notification),
+        NotificationSource("referrals_confirmed", "referrals", "update", "confirmed_at", confirmed_referral_notification, {"confirmed": True})
+    ],
+    rate=NOTIFICATION_RATE,
+    per_chat_interval=NOTIFICATION_CHAT_INTERVAL
+)
+
+# Long polling
+def update_user_key(update: Dict[str, Any]) -> Any:
+    """User the update belongs to: its updates are processed in order and by one worker"""
+    if 'callback_query' in update:
+        return update['callback_query'].get('from', {}).get('id')
+    if 'message' in update:
+        message = update['message']
+        return message.get('from', {}).get('id') or message.get('chat', {}).get('id')
+    if 'pre_checkout_query' in update:
+        return update['pre_checkout_query'].get('from', {}).get('id')
+    return update.get('update_id')
+
+async def fetch_updates(offset: Optional[int]) -> List[Dict[str, Any]]:
+    """Long-poll getUpdates; confirms all updates before offset"""
+    # Мимо circuit breaker: ожидание long polling исказило бы адаптивный таймаут
+    url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/getUpdates"
+    payload = {
+        "offset": offset,
+        "limit": POLLING_BATCH_SIZE,
+        "timeout": POLLING_TIMEOUT,
+        "allowed_updates": ["message", "callback_query", "pre_checkout_query"]
+    }
+    response = await asyncio.get_running_loop().run_in_executor(
+        polling_executor, partial(http_session.post, url, json=payload, timeout=POLLING_TIMEOUT + 10)
+    )
+    data = response.json()
+    if not data.get('ok'):
+        raise RuntimeError(data.get('description', 'getUpdates failed'))
+    return data['result']
+
+update_broker = UpdateBroker(db, UPDATE_PARTITIONS)
+
+# Last update of each chat being handled: the next one of the chat waits for it
+update_chains: Dict[Any, asyncio.Task] = {}
+polled_updates_in_flight = asyncio.Semaphore(POLLING_MAX_IN_FLIGHT)
+# update_id of polled updates being handled, the offset is not confirmed past the lowest of them
+polled_update_ids: set = set()
+polled_update_done = asyncio.Event()
+# Recently accepted update_ids: Telegram delivers unconfirmed updates again
+seen_update_ids: "OrderedDict[int, None]" = OrderedDict()
+
+async def process_chained_update(update: Dict[str, Any], previous: Optional[asyncio.Task]):
+    try:
+        if previous is not None:
+            await asyncio.gather(previous, return_exceptions=True)
+        await handle_telegram_update(update)
+    except Exception as e:
+        logging.error(f"Update {update.get('update_id')} processing failed: {e}")
+    finally:
+        polled_updates_in_flight.release()
+        polled_update_ids.discard(update.get('update_id'))
+        polled_update_done.set()
+
+async def dispatch_update(update: Dict[str, Any]):
+    """Start handling update after the previous update of its chat, without waiting for it"""
+    await polled_updates_in_flight.acquire()
+    polled_update_ids.add(update.get('update_id'))
+    key = update_user_key(update)
+    task = spawn_background_task(process_chained_update(update, update_chains.get(key)))
+    update_chains[key] = task
+    task.add_done_callback(lambda done: update_chains.pop(key) if update_chains.get(key) is done else None)
+
+async def dispatch_updates(updates: List[Dict[str, Any]]):
+    """Start handling updates here or hand them to the sharded workers"""
+    if UPDATE_PROCESSING_MODE == "sharded":
+        await update_broker.publish(updates, update_user_key)
+        return
+    for update in updates:
+        await dispatch_update(update)
+
+def accept_new_updates(updates: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Updates not seen before; remembers their update_id"""
+    fresh = []
+    for update in updates:
+        update_id = update['update_id']
+        if update_id in seen_update_ids:
+            continue
+        seen_update_ids[update_id] = None
+        if len(seen_update_ids) > POLLING_SEEN_UPDATES:
+            seen_update_ids.popitem(last=False)
+        fresh.append(update)
+    return fresh
+
+async def run_update_poller():
+    """Receive updates with getUpdates instead of the webhook
+
+    An update is confirmed to Telegram (the offset moves past it) once it has
+    been handled, or once it is in the update queue in sharded mode; until
+    then getUpdates returns it again and the copy is skipped, so a crash
+    mid-handler redelivers it. Updates are handled without waiting for the
+    offset: one slow update only delays later updates of its own chat, and
+    while it holds the offset back the poller waits for a handler to finish
+    instead of fetching the same updates again. Up to POLLING_MAX_IN_FLIGHT
+    updates are handled at once.
+    """
+    await telegram_api_request("deleteWebhook", {"drop_pending_updates": False})
+    offset = None
+    next_offset = None
+    while True:
+        try:
+            updates = await fetch_updates(offset)
+        except Exception as e:
+            logging.error(f"getUpdates failed: {e}")
+            await asyncio.sleep(5)
+            continue
+        
+        fresh = accept_new_updates(updates)
+        if fresh:
+            await dispatch_updates(fresh)
+        if updates:
+            next_offset = max(next_offset or 0, updates[-1]['update_id'] + 1)
+        polled_update_done.clear()
+        requested, offset = offset, min(polled_update_ids) if polled_update_ids else next_offset
+        if updates and not fresh and offset == requested:
+            # Telegram вернул только уже принятые обновления: ждём, пока раннее будет обработано
+            try:
+                await asyncio.wait_for(polled_update_done.wait(), POLLING_TIMEOUT)
+            except asyncio.TimeoutError:
+                pass
+
+# Callback routes
+callback_router = CallbackRouter()
+callback_router.add("check_subscription", lambda chat_id, user: handle_subscription_check(chat_id, user.telegram_id))
+callback_router.add("back_to_menu", show_main_menu)
+callback_router.add("menu_search", show_search_menu)
+callback_router.add("menu_profile", show_profile_menu)
+callback_router.add("menu_balance", show_balance_menu)
+callback_router.add("menu_pricing", show_pricing_menu)
+callback_router.add("menu_referral", show_referral_menu)
+callback_router.add("menu_help", show_help_menu)
+callback_router.add("menu_rules", show_rules_menu)
+for admin_data in ("admin_panel", "admin_add_balance", "admin_stats", "admin_users", "admin_payments"):
+    callback_router.add(admin_data, partial(handle_admin_callback, data=admin_data), admin_only=True)
+for payment_data in ("pay_crypto", "pay_stars", "buy_single_search"):
+    callback_router.add(payment_data, partial(handle_payment_callback, data=payment_data))
+for purchase_data in ("buy_day_sub", "buy_3days_sub", "buy_month_sub"):
+    callback_router.add(purchase_data, partial(handle_purchase_callback, data=purchase_data))
+callback_router.add("crypto_{crypto_type:crypto}", handle_crypto_payment)
+callback_router.add("crypto_{crypto_type:crypto}_custom", handle_crypto_custom_amount)
+callback_router.add("crypto_{crypto_type:crypto}_{amount:int}", handle_crypto_payment_amount)
+callback_router.add("stars_custom", handle_stars_custom_amount)
+callback_router.add("stars_{amount:int}", handle_stars_payment)
+
 # API endpoints
 @api_router.get("/users")
 async def get_users():
@@ -1869,10 +3336,12 @@ async def get_users():
 @api_router.get("/stats")
 async def get_stats():
     """Get bot statistics"""
-    total_users = await db.users.count_documents({})
-    total_searches = await db.searches.count_documents({})
-    total_referrals = await db.referrals.count_documents({})
-    active_subs = await db.users.count_documents({"subscription_expires": {"$gt": datetime.utcnow()}})
+    total_users, total_searches, total_referrals, active_subs = await run_concurrently(
+        db.users.count_documents({}),
+        db.searches.count_documents({}),
+        db.referrals.count_documents({}),
+        db.users.count_documents({"subscription_expires": {"$gt": datetime.utcnow()}})
+    )
 
     return {
         "total_users": total_users,
@@ -1881,6 +3350,207 @@ async def get_stats():
         "active_subscriptions": active_subs
     }
 
+@api_router.get("/stats/callbacks")
+async def get_callback_stats():
+    """Get callback route hit counters and latency"""
+    stats = callback_router.stats()
+    stats["acknowledgements"] = dict(callback_ack_stats)
+    stats["navigation"] = dict(navigation_stats)
+    return stats
+
+@api_router.get("/stats/rate-limits")
+async def get_rate_limit_stats():
+    """Get inbound update throttling counters"""
+    return {
+        **rate_limit_stats,
+        "tracked_keys": {name: len(limiter.entries) for name, limiter in update_rate_limiters.items()}
+    }
+
+@api_router.get("/stats/workers")
+async def get_worker_stats():
+    """Get sharded worker processes, their partitions and update queue depth"""
+    workers = await update_broker.live_workers()
+    leases = await update_broker.leases.find({"expires_at": {"$gt": datetime.utcnow()}}).to_list(UPDATE_PARTITIONS)
+    partitions = {worker: 0 for worker in workers}
+    for lease in leases:
+        partitions[lease["owner"]] = partitions.get(lease["owner"], 0) + 1
+    return {
+        "mode": UPDATE_PROCESSING_MODE,
+        "partitions": UPDATE_PARTITIONS,
+        "queued_updates": await update_broker.queue.count_documents({}),
+        "workers": partitions
+    }
+
+class CacheInvalidationRequest(BaseModel):
+    scope: str  # "users", "membership", "search", "all"
+    key: Optional[str] = None  # telegram_id or search query; all entries of the scope if empty
+
+@api_router.post("/cache/invalidate")
+async def invalidate_cache(http_request: Request, request: CacheInvalidationRequest):
+    """Drop cache entries in every process"""
+    check_admin_token(http_request)
+    if request.scope == "all":
+        await invalidation_bus.publish(FLUSH_ALL)
+        return {"status": "ok"}
+    if request.scope not in invalidation_bus.handlers:
+        raise HTTPException(status_code=400, detail=f"Unknown cache scope: {request.scope}")
+    
+    key = request.key
+    if key is not None and request.scope == "search":
+        key = search_cache_key(classify_query(key))
+    elif key is not None:
+        try:
+            key = int(key)
+        except ValueError:
+            raise HTTPException(status_code=400, detail=f"Invalid telegram_id: {key}")
+    await invalidation_bus.publish(request.scope, key)
+    return {"status": "ok", "key": key}
+
+@api_router.get("/stats/caches")
+async def get_cache_stats():
+    """Get cache sizes, hit rates and invalidation bus lag"""
+    caches = {"users": user_cache, "membership": membership_cache, "search": search_result_cache}
+    return {
+        **{name: {"size": len(cache.entries), "hits": cache.hits, "misses": cache.misses} for name, cache in caches.items()},
+        "invalidation_bus": invalidation_bus.snapshot()
+    }
+
+@api_router.get("/stats/notifications")
+async def get_notification_stats():
+    """Get notification delivery counters"""
+    return dict(notification_service.stats)
+
+@api_router.get("/stats/upstreams")
+async def get_upstream_stats():
+    """Get circuit breaker state, error rate and adaptive timeout of upstream APIs"""
+    stats = {breaker.name: breaker.stats() for breaker in upstream_breakers}
+    stats["usersbox_hedging"] = {
+        "enabled": USERSBOX_HEDGING,
+        "delay": usersbox_hedge_delay(),
+        "budget_tokens": round(usersbox_hedge_budget.tokens, 2),
+        **usersbox_hedge_stats
+    }
+    stats["search_scheduler"] = search_scheduler.stats()
+    stats["search_cache"] = {
+        "size": len(search_result_cache.entries),
+        "hits": search_result_cache.hits,
+        "misses": search_result_cache.misses,
+        "stale_hits": search_result_cache.stale_hits
+    }
+    return stats
+
+named_caches = {"users": user_cache, "membership": membership_cache, "search": search_result_cache}
+
+def cache_counters(field: str) -> Dict[tuple, float]:
+    return {(name,): getattr(cache, field) for name, cache in named_caches.items()}
+
+# Значения, которые читаются из MongoDB при каждом scrape
+scraped_queue_depths = {}
+
+metrics_registry.callback_counter(
+    "bot_cache_hits_total", "Cache lookups served from cache", ("cache",), lambda: cache_counters("hits")
+)
+metrics_registry.callback_counter(
+    "bot_cache_misses_total", "Cache lookups that missed", ("cache",), lambda: cache_counters("misses")
+)
+metrics_registry.callback_counter(
+    "bot_cache_stale_hits_total", "Expired entries served while upstream is unavailable", ("cache",), lambda: cache_counters("stale_hits")
+)
+metrics_registry.gauge(
+    "bot_cache_entries", "Entries held by cache", ("cache",),
+    lambda: {(name,): len(cache.entries) for name, cache in named_caches.items()}
+)
+metrics_registry.gauge(
+    "bot_upstream_circuit_state", "Circuit breaker state (0 closed, 1 half-open, 2 open)", ("upstream",),
+    lambda: {(breaker.name,): STATE_CODES[breaker.state] for breaker in upstream_breakers}
+)
+metrics_registry.gauge(
+    "bot_upstream_error_rate", "Error rate in the circuit breaker window", ("upstream",),
+    lambda: {(breaker.name,): breaker.error_rate() for breaker in upstream_breakers}
+)
+metrics_registry.gauge(
+    "bot_upstream_timeout_seconds", "Current adaptive timeout", ("upstream",),
+    lambda: {(breaker.name,): breaker.timeout() for breaker in upstream_breakers}
+)
+metrics_registry.callback_counter(
+    "bot_upstream_rejected_total", "Calls rejected by an open circuit", ("upstream",),
+    lambda: {(breaker.name,): breaker.counters["rejected"] for breaker in upstream_breakers}
+)
+metrics_registry.gauge(
+    "bot_queue_depth", "Items waiting or running in internal queues", ("queue",),
+    lambda: {
+        ("search_running",): search_scheduler.running,
+        ("search_queued",): search_scheduler.stats()["queued"],
+        ("background_tasks",): len(background_tasks),
+        **{(name,): depth for name, depth in scraped_queue_depths.items()}
+    }
+)
+metrics_registry.callback_counter(
+    "bot_rate_limited_updates_total", "Inbound update throttling decisions", ("decision",),
+    lambda: {(decision,): count for decision, count in rate_limit_stats.items()}
+)
+metrics_registry.callback_counter(
+    "bot_notifications_total", "Notification delivery outcomes", ("outcome",),
+    lambda: {(outcome,): notification_service.stats[outcome] for outcome in ("delivered", "duplicates", "failed")}
+)
+
+metrics_registry.callback_counter(
+    "bot_traces_total", "Finished update traces", ("result",),
+    lambda: {(result,): count for result, count in tracer.stats.items()}
+)
+metrics_registry.callback_counter(
+    "bot_trace_spans_total", "Spans handed to the trace exporter", ("result",),
+    lambda: {(result,): count for result, count in tracer.exporter.stats.items()}
+)
+
+metrics_registry.callback_counter(
+    "bot_event_loop_stalls_total", "Event loop wake-ups later than LOOP_LAG_THRESHOLD", (),
+    lambda: {(): loop_lag_monitor.stats["stalls"]}
+)
+
+metrics_registry.callback_counter(
+    "bot_recorded_updates_total", "Updates captured for replay", ("result",),
+    lambda: {(result,): count for result, count in update_recorder.stats.items()}
+)
+
+@api_router.get("/metrics")
+async def get_metrics():
+    """Metrics in the Prometheus text exposition format"""
+    if UPDATE_PROCESSING_MODE == "sharded":
+        try:
+            scraped_queue_depths["update_queue"] = await update_broker.queue.estimated_document_count()
+        except Exception as e:
+            logging.error(f"Failed to read update queue depth: {e}")
+    return PlainTextResponse(metrics_registry.render(), media_type="text/plain; version=0.0.4")
+
+def check_admin_token(request: Request):
+    token = request.headers.get("X-Admin-Token", "")
+    if not ADMIN_API_TOKEN or not secrets.compare_digest(token, ADMIN_API_TOKEN):
+        raise HTTPException(status_code=403, detail="Invalid admin token")
+
+profiling_lock = asyncio.Lock()
+
+@api_router.get("/admin/profile")
+async def get_profile(request: Request, seconds: float = Query(10.0, gt=0), interval: float = Query(0.005, ge=0.001)):
+    """Sample stacks of all threads for up to PROFILE_MAX_DURATION seconds, folded for flamegraphs"""
+    check_admin_token(request)
+    if profiling_lock.locked():
+        raise HTTPException(status_code=409, detail="Profiling is already running")
+    async with profiling_lock:
+        folded = await asyncio.to_thread(sample_stacks, min(seconds, PROFILE_MAX_DURATION), interval)
+    return PlainTextResponse(folded)
+
+@api_router.get("/admin/loop-lag")
+async def get_loop_lag(request: Request):
+    """Get event loop lag and recent stalls with the stack that blocked the loop"""
+    check_admin_token(request)
+    return {
+        "interval": loop_lag_monitor.interval,
+        "threshold": loop_lag_monitor.threshold,
+        **loop_lag_monitor.stats,
+        "stalls": list(loop_lag_monitor.stalls)
+    }
+
 # Include the router in the main app
 app.include_router(api_router)
 
@@ -1898,6 +3568,65 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+@app.on_event("startup")
+async def ensure_indexes():
+    """Create indexes required by the bot"""
+    try:
+        # Состояния старого формата без expires_at никогда не истекут и могут дублироваться
+        await db.user_states.delete_many({"expires_at": {"$exists": False}})
+        await db.user_states.create_index("user_id", unique=True)
+        await db.user_states.create_index("expires_at", expireAfterSeconds=0)
+        await db.users.create_index("search_reservations.created_at", sparse=True)
+        if UPDATE_PROCESSING_MODE == "sharded":
+            await update_broker.ensure_indexes()
+    except Exception as e:
+        logging.error(f"Failed to create indexes: {e}")
+
+@app.on_event("startup")
+async def start_reservation_sweeper():
+    """Release reservations left behind by a previous process"""
+    spawn_background_task(run_reservation_sweeper())
+
+@app.on_event("startup")
+async def start_invalidation_bus():
+    """Receive cache invalidations from other processes"""
+    spawn_background_task(invalidation_bus.run())
+
+@app.on_event("startup")
+async def start_notification_service():
+    """Send notifications derived from payment and referral records"""
+    spawn_background_task(notification_service.run())
+
+@app.on_event("startup")
+async def start_trace_exporter():
+    """Export sampled traces to a file and/or OTLP collector"""
+    if tracer.exporter.enabled:
+        spawn_background_task(tracer.exporter.run())
+
+@app.on_event("startup")
+async def start_loop_lag_monitor():
+    """Measure event loop lag and capture stacks of blocking code"""
+    spawn_background_task(loop_lag_monitor.run())
+
+@app.on_event("startup")
+async def start_update_recorder():
+    """Write captured webhook updates to UPDATE_RECORD_PATH"""
+    if update_recorder.enabled:
+        logging.info(f"Recording anonymized updates to {UPDATE_RECORD_PATH}")
+        spawn_background_task(update_recorder.run())
+
+@app.on_event("startup")
+async def start_update_poller():
+    """Start getUpdates loop when updates are received by long polling"""
+    if TELEGRAM_UPDATE_MODE == "polling":
+        logging.info("Receiving Telegram updates by long polling")
+        spawn_background_task(run_update_poller())
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
-    client.close()
\ No newline at end of file
+    client.close()
+
+@app.on_event("shutdown")
+async def shutdown_upstream_executors():
+    for executor in upstream_executors:
+        executor.shutdown(wait=False, cancel_futures=True)
\ No newline at end of file
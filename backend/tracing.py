@@ -0,0 +1,237 @@
+"""Lightweight per-update tracing.
+
+Every update gets a root span; database round-trips and upstream HTTP calls
+made while it is handled are recorded as child spans (they are reported after
+the fact by the observers of InstrumentedDatabase and CircuitBreaker, so a
+child span is a finished interval under whatever span is current).
+
+Spans of every trace are kept in memory until the root span ends. Then:
+
+* the trace is exported if it was sampled (sample_rate), failed, or was slow;
+* a trace slower than slow_threshold is logged as an indented span tree.
+
+Export is OTLP/JSON (ExportTraceServiceRequest): one request per line
+appended to a file, and/or POSTed to a collector's /v1/traces endpoint.
+"""
+import asyncio
+import json
+import logging
+import os
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, List, Optional
+
+SPAN_KIND_INTERNAL = 1
+SPAN_KIND_CLIENT = 3
+STATUS_OK = 1
+STATUS_ERROR = 2
+
+class Span:
+    __slots__ = ("trace", "span_id", "parent_id", "name", "kind", "start", "end", "attributes", "error")
+
+    def __init__(self, trace: "Trace", name: str, parent_id: Optional[str], kind: int, start: float, attributes: Dict[str, Any]):
+        self.trace = trace
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.name = name
+        self.kind = kind
+        self.start = start
+        self.end: Optional[float] = None
+        self.attributes = attributes
+        self.error: Optional[str] = None
+
+    @property
+    def duration(self) -> float:
+        return (self.end or time.time()) - self.start
+
+    def to_otlp(self) -> Dict[str, Any]:
+        span = {
+            "traceId": self.trace.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": self.kind,
+            "startTimeUnixNano": str(int(self.start * 1e9)),
+            "endTimeUnixNano": str(int((self.end or self.start) * 1e9)),
+            "attributes": otlp_attributes(self.attributes),
+            "status": {"code": STATUS_ERROR, "message": self.error} if self.error else {"code": STATUS_OK},
+        }
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        return span
+
+class Trace:
+    __slots__ = ("trace_id", "spans", "finished")
+
+    def __init__(self):
+        self.trace_id = os.urandom(16).hex()
+        self.spans: List[Span] = []
+        self.finished = False
+
+def otlp_value(value: Any) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+def otlp_attributes(attributes: Dict[str, Any]) -> List[Dict[str, Any]]:
+    return [{"key": key, "value": otlp_value(value)} for key, value in attributes.items() if value is not None]
+
+def format_span_tree(spans: List[Span]) -> str:
+    """Indented tree: one line per span with its offset from the root and duration"""
+    children: Dict[Optional[str], List[Span]] = {}
+    for span in spans:
+        children.setdefault(span.parent_id, []).append(span)
+    root_start = min(span.start for span in spans)
+    lines = []
+
+    def walk(parent_id: Optional[str], depth: int):
+        for span in sorted(children.get(parent_id, []), key=lambda s: s.start):
+            attributes = " ".join(f"{key}={value}" for key, value in span.attributes.items() if value is not None)
+            error = f" ERROR: {span.error}" if span.error else ""
+            lines.append(
+                f"{'  ' * depth}{span.name} +{(span.start - root_start) * 1000:.1f}ms {span.duration * 1000:.1f}ms {attributes}{error}".rstrip()
+            )
+            walk(span.span_id, depth + 1)
+
+    walk(None, 0)
+    return "\n".join(lines)
+
+class OTLPJsonExporter:
+    """Buffers finished traces and writes them as OTLP/JSON every flush_interval"""
+
+    def __init__(
+        self,
+        service_name: str,
+        path: str = "",
+        endpoint: str = "",
+        session=None,
+        flush_interval: float = 5.0,
+        max_queue: int = 10000,
+    ):
+        self.service_name = service_name
+        self.path = path
+        self.endpoint = endpoint
+        self.session = session
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+        self.queue: List[Span] = []
+        self.stats = {"exported": 0, "dropped": 0, "failed": 0}
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.path or self.endpoint)
+
+    def add(self, spans: List[Span]):
+        if len(self.queue) + len(spans) > self.max_queue:
+            self.stats["dropped"] += len(spans)
+            return
+        self.queue.extend(spans)
+
+    def request(self, spans: List[Span]) -> Dict[str, Any]:
+        return {"resourceSpans": [{
+            "resource": {"attributes": otlp_attributes({"service.name": self.service_name})},
+            "scopeSpans": [{"scope": {"name": "tracing"}, "spans": [span.to_otlp() for span in spans]}],
+        }]}
+
+    def write(self, payload: str):
+        if self.path:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(payload + "\n")
+        if self.endpoint:
+            response = self.session.post(
+                self.endpoint, data=payload, headers={"Content-Type": "application/json"}, timeout=10
+            )
+            response.raise_for_status()
+
+    async def flush(self):
+        if not self.queue:
+            return
+        spans, self.queue = self.queue, []
+        try:
+            await asyncio.to_thread(self.write, json.dumps(self.request(spans), ensure_ascii=False))
+            self.stats["exported"] += len(spans)
+        except Exception as e:
+            self.stats["failed"] += len(spans)
+            logging.error(f"Failed to export {len(spans)} spans: {e}")
+
+    async def run(self):
+        try:
+            while True:
+                await asyncio.sleep(self.flush_interval)
+                await self.flush()
+        finally:
+            await self.flush()
+
+class Tracer:
+    def __init__(self, exporter: OTLPJsonExporter, sample_rate: float = 0.01, slow_threshold: float = 2.0):
+        self.exporter = exporter
+        self.sample_rate = sample_rate
+        self.slow_threshold = slow_threshold
+        self.current: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+        self.stats = {"traces": 0, "sampled": 0, "slow": 0}
+
+    @contextmanager
+    def trace(self, name: str, **attributes):
+        """Root span; finished traces are sampled, exported and checked for slowness"""
+        trace = Trace()
+        span = Span(trace, name, None, SPAN_KIND_INTERNAL, time.time(), attributes)
+        trace.spans.append(span)
+        token = self.current.set(span)
+        try:
+            yield span
+        except Exception as e:
+            span.error = repr(e)
+            raise
+        finally:
+            self.current.reset(token)
+            span.end = time.time()
+            trace.finished = True
+            self.finish(trace, span)
+
+    @contextmanager
+    def span(self, name: str, **attributes):
+        """Child span of the current span; no-op outside a trace"""
+        parent = self.current.get()
+        if parent is None or parent.trace.finished:
+            yield None
+            return
+        span = Span(parent.trace, name, parent.span_id, SPAN_KIND_INTERNAL, time.time(), attributes)
+        parent.trace.spans.append(span)
+        token = self.current.set(span)
+        try:
+            yield span
+        except Exception as e:
+            span.error = repr(e)
+            raise
+        finally:
+            self.current.reset(token)
+            span.end = time.time()
+
+    def record(self, name: str, started: float, duration: float, error: Optional[str] = None, kind: int = SPAN_KIND_CLIENT, **attributes):
+        """Add an already finished child span to the current trace"""
+        parent = self.current.get()
+        # Фоновые задачи наследуют контекст и могут пережить корневой span
+        if parent is None or parent.trace.finished:
+            return
+        span = Span(parent.trace, name, parent.span_id, kind, started, attributes)
+        span.end = started + duration
+        span.error = error
+        parent.trace.spans.append(span)
+
+    def finish(self, trace: Trace, root: Span):
+        self.stats["traces"] += 1
+        slow = self.slow_threshold > 0 and root.duration >= self.slow_threshold
+        if slow:
+            self.stats["slow"] += 1
+            logging.warning(
+                f"Slow update {root.duration:.3f}s, trace {trace.trace_id}:\n{format_span_tree(trace.spans)}"
+            )
+        failed = any(span.error for span in trace.spans)
+        if self.exporter.enabled and (slow or failed or random.random() < self.sample_rate):
+            self.stats["sampled"] += 1
+            self.exporter.add(trace.spans)
@@ -0,0 +1,258 @@
+"""Mongo-backed update queue for sharded worker processes.
+
+Updates are published to the update_queue collection with a partition derived
+from the telegram_id they belong to. Worker processes register in
+update_workers with a heartbeat; every worker computes the same
+partition -> worker assignment from the list of live workers with rendezvous
+hashing, so a join or leave only moves the partitions of that worker.
+
+A partition is consumed only by the worker holding its lease in
+partition_leases. Leases are taken when a partition is assigned and released
+when it is not and none of its updates are being handled, so during a
+rebalance the old owner finishes them before the new owner starts. A worker
+whose heartbeat does not renew a lease stops fetching from that partition.
+
+Updates are handled concurrently across chats and in order within a chat,
+each after the previous update of its chat, so a slow update only delays its
+own chat. An update is deleted from the queue after its handler returns
+(at-least-once delivery).
+"""
+import asyncio
+import hashlib
+import logging
+import os
+import socket
+import uuid
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Set
+
+from pymongo.errors import DuplicateKeyError
+
+def stable_hash(value: str) -> int:
+    """Hash that is the same in every process, unlike hash()"""
+    return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), "big")
+
+def partition_for(key: Any, partitions: int) -> int:
+    return stable_hash(str(key)) % partitions
+
+def rendezvous_owner(partition: int, workers: Iterable[str]) -> str:
+    """Worker with the highest weight for partition (highest random weight hashing)"""
+    return max(workers, key=lambda worker: stable_hash(f"{worker}:{partition}"))
+
+def assign_partitions(worker_id: str, workers: List[str], partitions: int) -> Set[int]:
+    if not workers:
+        return set()
+    return {p for p in range(partitions) if rendezvous_owner(p, workers) == worker_id}
+
+class UpdateBroker:
+    def __init__(self, db, partitions: int = 256, lease_ttl: float = 30.0):
+        self.db = db
+        self.partitions = partitions
+        self.lease_ttl = lease_ttl
+        self.queue = db.update_queue
+        self.workers = db.update_workers
+        self.leases = db.partition_leases
+
+    async def ensure_indexes(self):
+        await self.queue.create_index([("partition", 1), ("_id", 1)])
+        await self.workers.create_index("expires_at", expireAfterSeconds=0)
+
+    async def publish(self, updates: List[Dict[str, Any]], key_func: Callable[[Dict[str, Any]], Any]):
+        """Enqueue updates, partitioned by key_func(update)"""
+        if not updates:
+            return
+        now = datetime.utcnow()
+        await self.queue.insert_many([
+            {"partition": partition_for(key_func(update), self.partitions), "update": update, "enqueued_at": now}
+            for update in updates
+        ], ordered=True)
+
+    async def live_workers(self) -> List[str]:
+        cursor = self.workers.find({"expires_at": {"$gt": datetime.utcnow()}}, {"_id": 1})
+        return sorted([doc["_id"] async for doc in cursor])
+
+    async def heartbeat(self, worker_id: str, partitions: Set[int]) -> Set[int]:
+        """Register worker as alive and extend the leases it holds. Returns the partitions still leased"""
+        expires_at = datetime.utcnow() + timedelta(seconds=self.lease_ttl)
+        await self.workers.update_one({"_id": worker_id}, {"$set": {"expires_at": expires_at}}, upsert=True)
+        if not partitions:
+            return set()
+        await self.leases.update_many(
+            {"_id": {"$in": list(partitions)}, "owner": worker_id},
+            {"$set": {"expires_at": expires_at}}
+        )
+        cursor = self.leases.find({"_id": {"$in": list(partitions)}, "owner": worker_id}, {"_id": 1})
+        return {doc["_id"] async for doc in cursor}
+
+    async def acquire_lease(self, worker_id: str, partition: int) -> bool:
+        now = datetime.utcnow()
+        try:
+            await self.leases.update_one(
+                {"_id": partition, "$or": [{"owner": worker_id}, {"expires_at": {"$lt": now}}]},
+                {"$set": {"owner": worker_id, "expires_at": now + timedelta(seconds=self.lease_ttl)}},
+                upsert=True
+            )
+            return True
+        except DuplicateKeyError:
+            return False
+
+    async def release_lease(self, worker_id: str, partition: int):
+        await self.leases.delete_one({"_id": partition, "owner": worker_id})
+
+    async def unregister(self, worker_id: str, partitions: Set[int]):
+        await self.leases.delete_many({"_id": {"$in": list(partitions)}, "owner": worker_id})
+        await self.workers.delete_one({"_id": worker_id})
+
+    async def fetch(self, partitions: Set[int], limit: int, after: Optional[Any] = None) -> List[Dict[str, Any]]:
+        query: Dict[str, Any] = {"partition": {"$in": list(partitions)}}
+        if after is not None:
+            query["_id"] = {"$gt": after}
+        cursor = self.queue.find(query).sort("_id", 1).limit(limit)
+        return await cursor.to_list(limit)
+
+    async def ack(self, ids: Iterable[Any]):
+        await self.queue.delete_many({"_id": {"$in": list(ids)}})
+
+class ShardWorker:
+    def __init__(
+        self,
+        broker: UpdateBroker,
+        handler: Callable[[Dict[str, Any]], Awaitable[None]],
+        key_func: Callable[[Dict[str, Any]], Any],
+        batch_size: int = 100,
+        max_in_flight: int = 1000,
+        poll_interval: float = 0.2,
+        heartbeat_interval: float = 5.0,
+    ):
+        self.broker = broker
+        self.handler = handler
+        self.key_func = key_func
+        self.batch_size = batch_size
+        self.max_in_flight = max_in_flight
+        self.poll_interval = poll_interval
+        self.heartbeat_interval = heartbeat_interval
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        self.owned: Set[int] = set()  # leases held
+        self.assigned: Set[int] = set()  # partitions to fetch from, owned ones among them
+        self.in_flight: Dict[Any, int] = {}  # queue _id -> partition of updates being handled
+        self.completed: Set[Any] = set()  # handled, not yet deleted from the queue
+        self.chains: Dict[Any, asyncio.Task] = {}  # last update of each chat being handled
+        self.tasks: Set[asyncio.Task] = set()
+        self.fetched_until: Optional[Any] = None
+        self.slot_freed = asyncio.Event()
+        self.processed = 0
+
+    async def rebalance(self):
+        """Take leases of assigned partitions and give up the rest"""
+        workers = await self.broker.live_workers()
+        if self.worker_id not in workers:
+            workers.append(self.worker_id)
+        assigned = assign_partitions(self.worker_id, workers, self.broker.partitions)
+
+        # Партицию отдаём только после того, как её обновления обработаны
+        busy = set(self.in_flight.values())
+        released = {partition for partition in self.owned - assigned if partition not in busy}
+        for partition in released:
+            await self.broker.release_lease(self.worker_id, partition)
+        # Удерживаемые аренды продлевает heartbeat, запрашиваем только новые
+        acquired = set()
+        for partition in assigned - self.owned:
+            if await self.broker.acquire_lease(self.worker_id, partition):
+                acquired.add(partition)
+        # self.owned перечитывается: heartbeat мог потерять аренды за время запросов
+        owned = (self.owned - released) | acquired
+        if owned != self.owned:
+            logging.info(f"Worker {self.worker_id} owns {len(owned & assigned)} of {self.broker.partitions} partitions ({len(workers)} workers)")
+        self.owned = owned
+        self.assigned = assigned
+        # С начала очереди: обновления новых партиций и вставленные позже с меньшим _id
+        self.fetched_until = None
+
+    async def run_heartbeat(self):
+        loop = asyncio.get_running_loop()
+        renewed_at = loop.time()
+        while True:
+            partitions = set(self.owned)
+            try:
+                held = await self.broker.heartbeat(self.worker_id, partitions)
+                renewed_at = loop.time()
+            except Exception as e:
+                logging.error(f"Worker heartbeat failed: {e}")
+                # Аренды истекут до следующей попытки, и партиции заберут другие воркеры
+                expiring = loop.time() - renewed_at + self.heartbeat_interval >= self.broker.lease_ttl
+                held = set() if expiring else partitions
+            lost = partitions - held
+            if lost:
+                logging.warning(f"Worker {self.worker_id} lost leases of {len(lost)} partitions")
+                self.owned -= lost
+            await asyncio.sleep(self.heartbeat_interval)
+
+    def dispatch(self, doc: Dict[str, Any]):
+        """Start handling the update after the previous update of its chat, without waiting for it"""
+        key = self.key_func(doc["update"])
+        self.in_flight[doc["_id"]] = doc["partition"]
+        task = asyncio.create_task(self.process(doc, self.chains.get(key)))
+        self.chains[key] = task
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        task.add_done_callback(lambda done: self.chains.pop(key) if self.chains.get(key) is done else None)
+
+    async def process(self, doc: Dict[str, Any], previous: Optional[asyncio.Task]):
+        try:
+            if previous is not None:
+                await asyncio.gather(previous, return_exceptions=True)
+            await self.handler(doc["update"])
+        except asyncio.CancelledError:
+            # Прерванное обновление остаётся в очереди
+            self.in_flight.pop(doc["_id"], None)
+            raise
+        except Exception as e:
+            logging.error(f"Update {doc['update'].get('update_id')} processing failed: {e}")
+        self.in_flight.pop(doc["_id"], None)
+        self.completed.add(doc["_id"])
+        self.processed += 1
+        self.slot_freed.set()
+
+    async def ack_completed(self):
+        if self.completed:
+            ids, self.completed = self.completed, set()
+            await self.broker.ack(ids)
+
+    async def run(self):
+        await self.broker.ensure_indexes()
+        await self.broker.heartbeat(self.worker_id, set())
+        heartbeat = asyncio.create_task(self.run_heartbeat())
+        loop = asyncio.get_running_loop()
+        next_rebalance = 0.0
+        try:
+            while True:
+                if loop.time() >= next_rebalance:
+                    await self.rebalance()
+                    next_rebalance = loop.time() + self.heartbeat_interval
+                await self.ack_completed()
+
+                room = min(self.batch_size, self.max_in_flight - len(self.in_flight))
+                if room <= 0:
+                    self.slot_freed.clear()
+                    try:
+                        await asyncio.wait_for(self.slot_freed.wait(), self.poll_interval)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+
+                partitions = self.owned & self.assigned
+                docs = await self.broker.fetch(partitions, room, self.fetched_until) if partitions else []
+                if docs:
+                    self.fetched_until = docs[-1]["_id"]
+                for doc in docs:
+                    # После сброса fetched_until выборка повторяет ещё не удалённые обновления
+                    if doc["_id"] not in self.in_flight and doc["_id"] not in self.completed:
+                        self.dispatch(doc)
+                if len(docs) < room:
+                    await asyncio.sleep(self.poll_interval)
+        finally:
+            heartbeat.cancel()
+            for task in self.tasks:
+                task.cancel()
+            await self.ack_completed()
+            await self.broker.unregister(self.worker_id, self.owned)
@@ -0,0 +1,247 @@
+"""Opt-in capture of incoming updates for replay in performance tests.
+
+record() only appends the raw update with its timing to a buffer; every
+flush_interval the buffer is anonymized and appended to a gzip file as one
+gzip member (the file is a valid multi-member gzip stream, a crash can only
+truncate the last member). Each line is
+
+    {"t": received unix time, "source": "telegram" | "cryptobot",
+     "duration": handling seconds, "status": HTTP status, "update": {...}}
+
+Anonymization keeps what matters for performance and drops identities. Only
+fields listed in FIELDS are written, anything else (contacts, locations,
+invoice comments, pay URLs, fields Telegram adds later) is dropped:
+
+* user and chat ids become keyed pseudonyms (stable for one key, so a user's
+  updates stay together; ids inside invoice payloads and CryptoBot invoice
+  descriptions are mapped the same way, so replayed payments find the user);
+* names, usernames, file ids and charge ids are replaced by keyed tokens, so
+  uploaded files cannot be downloaded again with the bot token;
+* texts keep their shape: every letter and digit is replaced by a keyed
+  pseudorandom one of the same kind (Cyrillic, Latin, case, plate letters),
+  punctuation, address keywords and bot commands are kept, so the query type,
+  length and repetition of queries survive but their content does not.
+
+Users are sampled as a whole (sample_rate of pseudonymous ids).
+"""
+import asyncio
+import gzip
+import hashlib
+import hmac
+import json
+import logging
+import os
+import random
+import re
+from typing import Any, Dict, List, Optional, Tuple
+
+from query_classifier import ADDRESS_KEYWORDS
+
+ID_PARENTS = {"from", "chat", "user", "sender_chat", "forward_from", "forward_from_chat"}
+
+# Fields written to the log and how their values are anonymized; other fields are dropped.
+# Containers ("nested") are anonymized field by field
+FIELDS = {
+    **dict.fromkeys((
+        "message", "edited_message", "callback_query", "pre_checkout_query", "from", "chat",
+        "document", "successful_payment", "entities", "reply_to_message",
+    ), "nested"),
+    **dict.fromkeys((
+        "update_id", "message_id", "date", "edit_date", "type", "is_bot", "language_code", "offset", "length",
+        "data", "mime_type", "file_size", "currency", "total_amount",
+        # CryptoBot
+        "update_type", "request_date", "invoice_id", "status", "asset", "amount", "fiat", "currency_type",
+        "paid_asset", "paid_amount", "paid_fiat_rate", "paid_usd_rate", "fee_asset", "fee_amount",
+        "created_at", "paid_at", "paid_anonymously", "allow_comments", "allow_anonymous",
+    ), "keep"),
+    **dict.fromkeys(("user_id", "chat_id"), "user_id"),
+    **dict.fromkeys((
+        "first_name", "last_name", "username", "title", "file_id", "file_unique_id", "chat_instance",
+        "telegram_payment_charge_id", "provider_payment_charge_id", "hash",
+    ), "name"),
+    **dict.fromkeys(("text", "caption"), "text"),
+    "description": "description",
+    "invoice_payload": "payload",
+    "payload": "payload",
+    "file_name": "file_name",
+    "id": "id",
+}
+PAYLOAD_ID_RE = re.compile(r'^((?:stars|crypto)_payment_)(\d+)(_.*)$')
+# Описание счёта CryptoBot, по которому handle_cryptobot_payment находит пользователя
+DESCRIPTION_ID_RE = re.compile(r'(для пользователя )(\d+)')
+WORD_RE = re.compile(r'(\w+)')
+
+LATIN_LOWER = "abcdefghijklmnopqrstuvwxyz"
+CYRILLIC_LOWER = "абвгдежзийклмнопрстуфхцчшщъыьэюя"
+PLATE_LETTERS = "АВЕКМНОРСТУХ"
+
+class Anonymizer:
+    def __init__(self, key: bytes):
+        self.key = key
+
+    def digest(self, value: str) -> bytes:
+        return hmac.new(self.key, value.encode(), hashlib.sha256).digest()
+
+    def user_id(self, value: int) -> int:
+        """Pseudonymous id with the sign of value (group chats are negative)"""
+        pseudonym = 10**9 + int.from_bytes(self.digest(f"id:{abs(value)}")[:8], "big") % (9 * 10**9)
+        return -pseudonym if value < 0 else pseudonym
+
+    def name(self, value: str) -> str:
+        return f"u{self.digest(f'name:{value}').hex()[:10]}"
+
+    def file_name(self, value: str) -> str:
+        """Pseudonym with the original extension, which decides whether the file is accepted"""
+        return self.name(value) + os.path.splitext(value)[1].lower()
+
+    def payload(self, value: str) -> str:
+        match = PAYLOAD_ID_RE.match(value)
+        if not match:
+            return value
+        return f"{match.group(1)}{self.user_id(int(match.group(2)))}{match.group(3)}"
+
+    def description(self, value: str) -> str:
+        """Invoice description written by the bot: only the user id in it is personal"""
+        if not DESCRIPTION_ID_RE.search(value):
+            return self.text(value)
+        return DESCRIPTION_ID_RE.sub(lambda match: f"{match.group(1)}{self.user_id(int(match.group(2)))}", value)
+
+    def char(self, ch: str, rng: random.Random, keep_digit: bool) -> str:
+        if ch.isdigit():
+            return ch if keep_digit else str(rng.randrange(10))
+        lower = ch.lower()
+        if lower in CYRILLIC_LOWER or lower == "ё":
+            # Буквы номеров автомобилей заменяются только такими же
+            replacement = rng.choice(PLATE_LETTERS).lower() if ch.upper() in PLATE_LETTERS else rng.choice(CYRILLIC_LOWER)
+            return replacement.upper() if ch.isupper() else replacement
+        if lower in LATIN_LOWER:
+            replacement = rng.choice(LATIN_LOWER)
+            return replacement.upper() if ch.isupper() else replacement
+        return ch
+
+    def text(self, value: str) -> str:
+        """Same text gives the same result; commands and address keywords are kept"""
+        if value.startswith("/"):
+            command, _, argument = value.partition(" ")
+            return f"{command} {self.name(argument)}" if argument else command
+        rng = random.Random(self.digest(f"text:{value}"))
+        first_digit_kept = False
+        parts = []
+        for token in WORD_RE.split(value):
+            if token.lower() in ADDRESS_KEYWORDS:
+                parts.append(token)
+                continue
+            chars = []
+            for ch in token:
+                # Первая цифра определяет формат телефона (+7, 8, 9)
+                chars.append(self.char(ch, rng, keep_digit=ch.isdigit() and not first_digit_kept))
+                first_digit_kept = first_digit_kept or ch.isdigit()
+            parts.append("".join(chars))
+        return "".join(parts)
+
+    def anonymize(self, value: Dict[str, Any]) -> Dict[str, Any]:
+        """Copy of an update with only the fields in FIELDS, anonymized"""
+        return self.fields(value, None)
+
+    def fields(self, value: Dict[str, Any], parent: Optional[str]) -> Dict[str, Any]:
+        result = {}
+        for key, child in value.items():
+            kind = FIELDS.get(key)
+            # Объект payload у CryptoBot - контейнер, строка payload - данные счёта
+            if kind == "payload" and isinstance(child, dict):
+                kind = "nested"
+            if kind is not None:
+                result[key] = self.value(kind, key, child, parent)
+        return result
+
+    def value(self, kind: str, key: str, value: Any, parent: Optional[str]) -> Any:
+        if isinstance(value, list):
+            return [self.value(kind, key, item, parent) for item in value]
+        if value is None or isinstance(value, bool) or kind == "keep":
+            return value
+        if kind == "nested":
+            return self.fields(value, key) if isinstance(value, dict) else None
+        if isinstance(value, int) and (kind == "user_id" or kind == "id" and parent in ID_PARENTS):
+            return self.user_id(value)
+        if not isinstance(value, str) or not value:
+            return None if kind in ("user_id", "id") else value
+        if kind == "text":
+            return self.text(value)
+        if kind == "payload":
+            return self.payload(value)
+        if kind == "description":
+            return self.description(value)
+        if kind == "file_name":
+            return self.file_name(value)
+        return self.name(value)
+
+class UpdateRecorder:
+    def __init__(self, path: str, key: bytes, sample_rate: float = 1.0, flush_interval: float = 1.0, max_buffer: int = 10000):
+        self.path = path
+        self.anonymizer = Anonymizer(key)
+        self.sample_rate = sample_rate
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self.buffer: List[Tuple[str, Dict[str, Any], float, float, int]] = []
+        self.stats = {"recorded": 0, "dropped": 0, "failed": 0}
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.path)
+
+    def sampled(self, user_id: Optional[int]) -> bool:
+        if self.sample_rate >= 1.0:
+            return True
+        digest = self.anonymizer.digest(f"sample:{user_id}")
+        return int.from_bytes(digest[:4], "big") / 2**32 < self.sample_rate
+
+    def record(self, source: str, update: Dict[str, Any], received_at: float, duration: float, status: int, user_id: Optional[int] = None):
+        if not self.enabled or not self.sampled(user_id):
+            return
+        if len(self.buffer) >= self.max_buffer:
+            self.stats["dropped"] += 1
+            return
+        self.buffer.append((source, update, received_at, duration, status))
+
+    def write(self, records: List[Tuple[str, Dict[str, Any], float, float, int]]):
+        lines = [
+            json.dumps({
+                "t": round(received_at, 6),
+                "source": source,
+                "duration": round(duration, 6),
+                "status": status,
+                "update": self.anonymizer.anonymize(update),
+            }, ensure_ascii=False)
+            for source, update, received_at, duration, status in records
+        ]
+        with open(self.path, "ab") as f:
+            f.write(gzip.compress(("\n".join(lines) + "\n").encode()))
+
+    async def flush(self):
+        if not self.buffer:
+            return
+        records, self.buffer = self.buffer, []
+        try:
+            await asyncio.to_thread(self.write, records)
+            self.stats["recorded"] += len(records)
+        except Exception as e:
+            self.stats["failed"] += len(records)
+            logging.error(f"Failed to write {len(records)} recorded updates: {e}")
+
+    async def run(self):
+        try:
+            while True:
+                await asyncio.sleep(self.flush_interval)
+                await self.flush()
+        finally:
+            await self.flush()
+
+def read_records(path: str):
+    """Records of a log written by UpdateRecorder; a truncated last member is skipped"""
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        try:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        except (EOFError, gzip.BadGzipFile, json.JSONDecodeError) as e:
+            logging.warning(f"Update log {path} ends with a truncated record: {e}")
@@ -0,0 +1,57 @@
+"""Sharded update worker.
+
+Run with UPDATE_PROCESSING_MODE=sharded on the API server, which then only
+enqueues updates. Each worker process owns a share of the update partitions
+and handles the updates of its users with the same code as the inline mode:
+
+    python worker.py --processes 4
+"""
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import os
+
+async def run_services(server, worker):
+    """Background services of the API process the worker depends on, then the worker itself"""
+    # Без шины инвалидаций кэш пользователей воркера не узнает о пополнениях и списаниях в API
+    server.spawn_background_task(server.invalidation_bus.run())
+    if server.tracer.exporter.enabled:
+        server.spawn_background_task(server.tracer.exporter.run())
+    server.spawn_background_task(server.loop_lag_monitor.run())
+    await worker.run()
+
+def run_worker():
+    import server
+    from update_broker import ShardWorker
+
+    worker = ShardWorker(server.update_broker, server.handle_telegram_update, server.update_user_key)
+    logging.info(f"Worker {worker.worker_id} started")
+    try:
+        asyncio.run(run_services(server, worker))
+    except KeyboardInterrupt:
+        pass
+
+def main():
+    parser = argparse.ArgumentParser(description="Process Telegram updates from the sharded update queue")
+    parser.add_argument("--processes", type=int, default=os.cpu_count() or 1, help="number of worker processes")
+    args = parser.parse_args()
+
+    if args.processes == 1:
+        run_worker()
+        return
+
+    # spawn: every process creates its own Mongo client instead of inheriting one
+    context = multiprocessing.get_context("spawn")
+    processes = [context.Process(target=run_worker, name=f"worker-{i}") for i in range(args.processes)]
+    for process in processes:
+        process.start()
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        for process in processes:
+            process.join()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+"""
+Microbenchmarks for pure functions on the request hot path.
+
+Every case runs a function over a recorded corpus (tests/corpora: real-world
+query strings, captured usersbox responses, typed custom amounts). Time per
+call is measured in calibrated rounds (min and median of --repeat rounds),
+allocations with tracemalloc (peak bytes and blocks still held per call, in a
+separate pass so tracing does not distort the timings).
+
+Like pytest-benchmark, --save stores results in .benchmarks/NNNN_<commit>.json
+and --compare prints the change against a saved run (the latest by default).
+
+Usage: python tests/bench_hot_paths.py [-k PATTERN] [--repeat N] [--save]
+       [--compare [NNNN|commit]] [--fail-slower PERCENT]
+"""
+
+import argparse
+import json
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Callable, Dict, List, NamedTuple, Optional
+
+from bench_query_classifier import load_corpus as load_query_corpus
+from bench_result_formatter import load_corpus as load_usersbox_corpus
+from upstream_stubs import CORPUS_DIR, ROOT_DIR, import_server
+
+HISTORY_DIR = ROOT_DIR / '.benchmarks'
+
+class Case(NamedTuple):
+    name: str
+    func: Callable[[Any], Any]
+    inputs: List[Any]
+
+def load_amounts() -> List[str]:
+    return [
+        line for line in (CORPUS_DIR / 'custom_amounts.txt').read_text(encoding='utf-8').splitlines()
+        if line and not line.startswith('#')
+    ]
+
+def build_cases(server) -> List[Case]:
+    from query_classifier import classify_query
+    from result_formatter import format_search_results, format_search_summary
+
+    queries = [query for query, _ in load_query_corpus()]
+    responses = {name: response for name, response in load_usersbox_corpus().items() if name != 'error'}
+    # По одному запросу каждого типа
+    typed = list({classify_query(query).search_type: (query, classify_query(query).search_type) for query in queries}.values())
+    long_text = format_search_results(responses['large'], "79123456789", "📱 Телефон") * 4
+    keyboards = {
+        "main_menu": server.create_main_menu,
+        "admin_menu": server.create_admin_menu,
+        "balance_menu": server.create_balance_menu,
+        "pricing_menu": server.create_pricing_menu,
+        "back_keyboard": server.create_back_keyboard,
+        "subscription_keyboard": server.create_subscription_keyboard,
+    }
+
+    cases = [
+        Case("classify_query", classify_query, queries),
+        Case("detect_search_type", server.detect_search_type, queries),
+        Case("parse_batch_queries", server.parse_batch_queries, [queries[i:i + 20] for i in range(0, len(queries), 20)]),
+        Case("validate_custom_amount", server.validate_custom_amount, load_amounts()),
+        Case("generate_referral_code", server.generate_referral_code, list(range(100000000, 100000100))),
+        Case("split_message", server.split_message, [long_text]),
+        Case("menu_content_hash", lambda keyboard: server.menu_content_hash("🏠 *ГЛАВНОЕ МЕНЮ*", keyboard()), list(keyboards.values())),
+    ]
+    for name, response in responses.items():
+        cases.append(Case(
+            f"format_search_results[{name}]",
+            lambda query_type, response=response: format_search_results(response, *query_type),
+            typed
+        ))
+        cases.append(Case(
+            f"format_search_summary[{name}]",
+            lambda query_type, response=response: format_search_summary(response, *query_type),
+            typed
+        ))
+    for name, builder in keyboards.items():
+        cases.append(Case(f"keyboard[{name}]", lambda _, builder=builder: builder(), [None]))
+    return cases
+
+def run_round(case: Case, loops: int) -> float:
+    """Seconds for loops passes over the inputs"""
+    func, inputs = case.func, case.inputs
+    started = time.perf_counter()
+    for _ in range(loops):
+        for value in inputs:
+            func(value)
+    return time.perf_counter() - started
+
+def calibrate(case: Case, min_time: float) -> int:
+    loops = 1
+    while run_round(case, loops) < min_time:
+        loops *= 2
+    return loops
+
+def measure_allocations(case: Case) -> Dict[str, float]:
+    """Mean peak bytes and blocks still held after each call"""
+    peaks, blocks = [], []
+    tracemalloc.start()
+    try:
+        for value in case.inputs:
+            before = tracemalloc.take_snapshot()
+            tracemalloc.reset_peak()
+            baseline = tracemalloc.get_traced_memory()[0]
+            case.func(value)
+            peaks.append(tracemalloc.get_traced_memory()[1] - baseline)
+            after = tracemalloc.take_snapshot()
+            blocks.append(sum(max(0, stat.count_diff) for stat in after.compare_to(before, 'lineno')))
+    finally:
+        tracemalloc.stop()
+    return {"alloc_peak_bytes": round(statistics.mean(peaks)), "retained_blocks": round(statistics.mean(blocks), 1)}
+
+def benchmark(case: Case, repeat: int, min_time: float) -> Dict[str, Any]:
+    case.func(case.inputs[0])  # прогрев
+    loops = calibrate(case, min_time)
+    calls = loops * len(case.inputs)
+    timings = [run_round(case, loops) / calls for _ in range(repeat)]
+    return {
+        "calls_per_round": calls,
+        "min_us": round(min(timings) * 1e6, 3),
+        "median_us": round(statistics.median(timings) * 1e6, 3),
+        "stddev_us": round(statistics.pstdev(timings) * 1e6, 3),
+        **measure_allocations(case),
+    }
+
+def git_commit() -> Dict[str, Any]:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT_DIR, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=ROOT_DIR, capture_output=True, text=True).stdout.strip())
+    except (OSError, subprocess.CalledProcessError):
+        return {"id": "unknown", "dirty": True}
+    return {"id": commit, "dirty": dirty}
+
+def saved_runs() -> List[Path]:
+    return sorted(HISTORY_DIR.glob('[0-9][0-9][0-9][0-9]_*.json'))
+
+def save_run(results: Dict[str, Dict[str, Any]]) -> Path:
+    runs = saved_runs()
+    number = int(runs[-1].name[:4]) + 1 if runs else 1
+    commit = git_commit()
+    path = HISTORY_DIR / f"{number:04d}_{commit['id']}{'_dirty' if commit['dirty'] else ''}.json"
+    HISTORY_DIR.mkdir(exist_ok=True)
+    path.write_text(json.dumps({
+        "commit": commit,
+        "datetime": datetime.utcnow().isoformat(),
+        "machine": {"python": platform.python_version(), "platform": platform.platform(), "processor": platform.processor()},
+        "benchmarks": results,
+    }, indent=2, ensure_ascii=False) + "\n", encoding='utf-8')
+    return path
+
+def find_run(reference: Optional[str]) -> Optional[Path]:
+    """Saved run by number or commit prefix, the latest when reference is empty"""
+    runs = saved_runs()
+    if not reference:
+        return runs[-1] if runs else None
+    for path in reversed(runs):
+        number, commit = path.stem.split('_', 1)
+        if reference in (number, number.lstrip('0')) or commit.startswith(reference):
+            return path
+    return None
+
+def compare(results: Dict[str, Dict[str, Any]], path: Path) -> Dict[str, float]:
+    """Print median time and allocation changes, return median change in percent by case"""
+    saved = json.loads(path.read_text(encoding='utf-8'))["benchmarks"]
+    print(f"\nCompared with {path.name}:")
+    print(f"{'case':<40} {'median':>10} {'alloc peak':>11} {'blocks':>8}")
+    changes = {}
+    for name, result in results.items():
+        before = saved.get(name)
+        if before is None:
+            continue
+        changes[name] = (result["median_us"] / before["median_us"] - 1) * 100 if before["median_us"] else 0.0
+        alloc = (result["alloc_peak_bytes"] / before["alloc_peak_bytes"] - 1) * 100 if before["alloc_peak_bytes"] else 0.0
+        print(f"{name:<40} {changes[name]:>+9.1f}% {alloc:>+10.1f}% {result['retained_blocks'] - before['retained_blocks']:>+8.1f}")
+    return changes
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('-k', dest='pattern', help='run cases whose name contains PATTERN')
+    parser.add_argument('--repeat', type=int, default=7)
+    parser.add_argument('--min-time', type=float, default=0.05, help='minimal seconds per round')
+    parser.add_argument('--save', action='store_true', help='store results in .benchmarks/')
+    parser.add_argument('--compare', nargs='?', const='', help='saved run to compare with (latest if empty)')
+    parser.add_argument('--fail-slower', type=float, help='exit with 1 if a median got slower by more than PERCENT')
+    args = parser.parse_args()
+
+    server = import_server()
+    cases = [case for case in build_cases(server) if not args.pattern or args.pattern in case.name]
+    # Сравнение берётся до сохранения, иначе --save --compare сравнит прогон сам с собой
+    reference = find_run(args.compare) if args.compare is not None else None
+    if args.compare is not None and reference is None:
+        print(f"No saved run {args.compare!r} in {HISTORY_DIR}")
+        return 1
+
+    print(f"{'case':<40} {'min µs':>10} {'median µs':>10} {'± µs':>8} {'alloc B':>9} {'blocks':>7}")
+    results = {}
+    for case in cases:
+        result = benchmark(case, args.repeat, args.min_time)
+        results[case.name] = result
+        print(f"{case.name:<40} {result['min_us']:>10.2f} {result['median_us']:>10.2f} {result['stddev_us']:>8.2f} {result['alloc_peak_bytes']:>9} {result['retained_blocks']:>7}")
+
+    if args.save:
+        print(f"\nSaved {save_run(results)}")
+    if reference is None:
+        return 0
+    slower = {name: change for name, change in compare(results, reference).items()
+              if args.fail_slower is not None and change > args.fail_slower}
+    for name, change in slower.items():
+        print(f"❌ {name}: {change:+.1f}% slower")
+    return 1 if slower else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
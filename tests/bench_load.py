@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+"""
+Load test driving the webhook with synthetic Telegram traffic.
+
+Runs the FastAPI app in-process against local stand-ins for Telegram,
+usersbox and CryptoBot (tests/upstream_stubs.py) and mongomock or a scratch
+database on a local MongoDB. Synthetic users go through realistic sessions:
+/start (some with a referral link), Stars top-ups, menus, single and batch
+searches, CryptoBot invoices. Each user's updates are sent in order, like
+Telegram does; different users run concurrently.
+
+Reports throughput, p50/p95/p99 webhook latency and DB round-trips per update
+by update kind, and compares them with tests/load_baseline.json; a run with
+settings other than those of the baseline fails the comparison.
+
+Usage: python tests/bench_load.py [--users N] [--updates N] [--concurrency N]
+       [--mongo-url URL] [--usersbox-latency S] [--usersbox-errors RATE] ...
+       [--update-baseline]
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import random
+import sys
+import time
+from contextvars import ContextVar
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from upstream_stubs import CORPUS_DIR, BotClient, add_stub_arguments, create_stubs, import_server, install_stubs, use_database
+
+BASELINE = Path(__file__).parent / 'load_baseline.json'
+
+MENU_CALLBACKS = ("back_to_menu", "menu_profile", "menu_balance", "menu_pricing", "menu_referral", "menu_help", "menu_search")
+
+def load_queries() -> List[str]:
+    return [
+        line.rsplit('\t', 1)[0]
+        for line in (CORPUS_DIR / 'search_queries.tsv').read_text(encoding='utf-8').splitlines()
+        if line and not line.startswith('#')
+    ]
+
+class SyntheticTraffic:
+    """Builds per-user sessions of (kind, update) steps"""
+
+    def __init__(self, seed: int, first_user_id: int = 100000000):
+        self.random = random.Random(seed)
+        self.queries = load_queries()
+        self.first_user_id = first_user_id
+        self.update_id = 0
+        self.message_id = 0
+
+    def next_ids(self):
+        self.update_id += 1
+        self.message_id += 1
+        return self.update_id, self.message_id
+
+    def sender(self, user_id: int) -> Dict[str, Any]:
+        return {"id": user_id, "is_bot": False, "first_name": f"User{user_id}", "username": f"user{user_id}", "language_code": "ru"}
+
+    def message(self, user_id: int, **fields) -> Dict[str, Any]:
+        update_id, message_id = self.next_ids()
+        return {"update_id": update_id, "message": {
+            "message_id": message_id,
+            "from": self.sender(user_id),
+            "chat": {"id": user_id, "type": "private"},
+            "date": int(time.time()),
+            **fields
+        }}
+
+    def callback(self, user_id: int, data: str) -> Dict[str, Any]:
+        update_id, message_id = self.next_ids()
+        return {"update_id": update_id, "callback_query": {
+            "id": str(update_id),
+            "from": self.sender(user_id),
+            "message": {"message_id": message_id, "chat": {"id": user_id, "type": "private"}, "date": int(time.time()), "text": "menu"},
+            "chat_instance": str(user_id),
+            "data": data
+        }}
+
+    def stars_top_up(self, user_id: int, amount: int) -> List[tuple]:
+        payload = f"stars_payment_{user_id}_{amount}"
+        update_id, _ = self.next_ids()
+        pre_checkout = {"update_id": update_id, "pre_checkout_query": {
+            "id": str(update_id), "from": self.sender(user_id), "currency": "XTR",
+            "total_amount": amount // 2, "invoice_payload": payload
+        }}
+        paid = self.message(user_id, successful_payment={
+            "currency": "XTR", "total_amount": amount // 2, "invoice_payload": payload,
+            "telegram_payment_charge_id": f"charge_{update_id}", "provider_payment_charge_id": ""
+        })
+        return [("payment", self.callback(user_id, f"stars_{amount}")), ("payment", pre_checkout), ("payment", paid)]
+
+    def session(self, user_id: int, steps: int, referrer_id: Optional[int]) -> List[tuple]:
+        """First /start, then a mix of menus, searches and payments"""
+        if referrer_id is not None:
+            # Код реферера известен только после его /start, подставляется при отправке
+            session = [("referral", ("start_ref", referrer_id, self.message(user_id, text="/start")))]
+        else:
+            session = [("start", self.message(user_id, text="/start"))]
+        if self.random.random() < 0.6:
+            session.extend(self.stars_top_up(user_id, self.random.choice((100, 200, 500))))
+
+        while len(session) < steps:
+            roll = self.random.random()
+            if roll < 0.40:
+                session.append(("menu", self.callback(user_id, self.random.choice(MENU_CALLBACKS))))
+            elif roll < 0.75:
+                session.append(("search", self.message(user_id, text=self.random.choice(self.queries))))
+            elif roll < 0.80:
+                lines = "\n".join(self.random.sample(self.queries, 3))
+                session.append(("batch_search", self.message(user_id, text=lines)))
+            elif roll < 0.86:
+                session.append(("crypto_invoice", self.callback(user_id, f"crypto_usdt_{self.random.choice((100, 300, 1000))}")))
+            elif roll < 0.91:
+                session.append(("subscription_check", self.callback(user_id, "check_subscription")))
+            elif roll < 0.95:
+                session.extend(self.stars_top_up(user_id, self.random.choice((100, 200, 500))))
+            else:
+                session.append(("start", self.message(user_id, text="/start")))
+        return session
+
+    def sessions(self, users: int, updates: int) -> List[List[tuple]]:
+        steps = max(1, updates // users)
+        result = []
+        for index in range(users):
+            referrer_id = self.first_user_id + self.random.randrange(index) if index and self.random.random() < 0.3 else None
+            result.append(self.session(self.first_user_id + index, steps, referrer_id))
+        return result
+
+def percentile(ordered: List[float], q: float) -> float:
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+class LoadStats:
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = {}
+        self.db_ops: Dict[str, int] = {}
+        self.failures = 0
+
+    def record(self, kind: str, status: int, seconds: float, db_ops: int):
+        self.latencies.setdefault(kind, []).append(seconds)
+        self.db_ops[kind] = self.db_ops.get(kind, 0) + db_ops
+        if status != 200:
+            self.failures += 1
+
+    def summary(self, elapsed: float) -> Dict[str, Any]:
+        kinds = {}
+        everything = []
+        for kind, latencies in sorted(self.latencies.items()):
+            ordered = sorted(latencies)
+            everything.extend(ordered)
+            kinds[kind] = self.describe(ordered, self.db_ops[kind])
+        everything.sort()
+        return {
+            "updates": len(everything),
+            "failures": self.failures,
+            "elapsed": round(elapsed, 3),
+            "throughput": round(len(everything) / elapsed, 1) if elapsed else 0.0,
+            "total": self.describe(everything, sum(self.db_ops.values())),
+            "kinds": kinds,
+        }
+
+    @staticmethod
+    def describe(ordered: List[float], db_ops: int) -> Dict[str, Any]:
+        return {
+            "count": len(ordered),
+            "p50_ms": round(percentile(ordered, 0.50) * 1000, 2),
+            "p95_ms": round(percentile(ordered, 0.95) * 1000, 2),
+            "p99_ms": round(percentile(ordered, 0.99) * 1000, 2),
+            "db_ops_per_update": round(db_ops / len(ordered), 2) if ordered else 0.0,
+        }
+
+# Round-trips of the update being sent: [count]
+current_update_ops: ContextVar[Optional[list]] = ContextVar("current_update_ops", default=None)
+
+def count_db_operation(collection, operation, started, duration, error):
+    ops = current_update_ops.get()
+    if ops is not None:
+        ops[0] += 1
+
+async def referral_start(server, step: tuple) -> Dict[str, Any]:
+    _, referrer_id, update = step
+    referrer = await server.db.users.find_one({"telegram_id": referrer_id}, {"referral_code": 1})
+    if referrer:
+        update["message"]["text"] = f"/start {referrer['referral_code']}"
+    return update
+
+async def run_load(server, bot: BotClient, sessions: List[List[tuple]], concurrency: int) -> LoadStats:
+    stats = LoadStats()
+    queue: asyncio.Queue = asyncio.Queue()
+    for session in sessions:
+        queue.put_nowait(session)
+
+    async def run_user():
+        while not queue.empty():
+            for kind, update in queue.get_nowait():
+                if kind == "referral":
+                    update = await referral_start(server, update)
+                ops = [0]
+                token = current_update_ops.set(ops)
+                try:
+                    status, seconds = await bot.post(update)
+                finally:
+                    current_update_ops.reset(token)
+                stats.record(kind, status, seconds, ops[0])
+
+    await asyncio.gather(*(run_user() for _ in range(concurrency)))
+    return stats
+
+def print_table(summary: Dict[str, Any], db_ops: bool = True):
+    width = max(20, *(len(kind) for kind in summary["kinds"]))
+    print(f"{'kind':<{width}} {'count':>7} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}" + (f" {'db ops':>7}" if db_ops else ""))
+    for kind, row in [*summary["kinds"].items(), ("total", summary["total"])]:
+        print(f"{kind:<{width}} {row['count']:>7} {row['p50_ms']:>9.1f} {row['p95_ms']:>9.1f} {row['p99_ms']:>9.1f}" + (f" {row['db_ops_per_update']:>7.2f}" if db_ops else ""))
+
+def print_summary(summary: Dict[str, Any], stubs: Dict[str, Any], loop_lag_max: float):
+    print_table(summary)
+    print(f"\n{summary['updates']} updates in {summary['elapsed']:.2f}s: {summary['throughput']:,.1f} updates/s, {summary['failures']} failed")
+    for name, stub in stubs.items():
+        print(f"{name}: {sum(stub.calls.values())} calls, {stub.errors} injected errors")
+    print(f"Max event loop lag: {loop_lag_max * 1000:.1f} ms")
+
+def compare_with_baseline(summary: Dict[str, Any], baseline: Dict[str, Any], tolerance: float) -> List[str]:
+    """Regressions against baseline: more DB round-trips, slower p95, lower throughput.
+    Results of a run with other settings are not comparable and are reported as a mismatch"""
+    settings = sorted(set(baseline["config"]) | set(summary["config"]))
+    mismatched = [name for name in settings if baseline["config"].get(name) != summary["config"].get(name)]
+    if mismatched:
+        return [
+            "settings differ from the baseline, results are not comparable: "
+            + ", ".join(f"{name} {summary['config'].get(name)} (baseline {baseline['config'].get(name)})" for name in mismatched)
+        ]
+    regressions = []
+    for kind, expected in baseline["kinds"].items():
+        actual = summary["kinds"].get(kind)
+        if actual is None:
+            continue
+        if actual["db_ops_per_update"] > expected["db_ops_per_update"] + 0.05:
+            regressions.append(f"{kind}: {actual['db_ops_per_update']} DB round-trips per update, baseline {expected['db_ops_per_update']}")
+        # Мелкие абсолютные колебания не считаются регрессией
+        if actual["p95_ms"] > expected["p95_ms"] * (1 + tolerance) and actual["p95_ms"] - expected["p95_ms"] > 5:
+            regressions.append(f"{kind}: p95 {actual['p95_ms']} ms, baseline {expected['p95_ms']} ms")
+    if summary["throughput"] < baseline["throughput"] * (1 - tolerance):
+        regressions.append(f"throughput {summary['throughput']} updates/s, baseline {baseline['throughput']}")
+    return regressions
+
+async def run(args) -> Dict[str, Any]:
+    server = import_server()
+    logging.getLogger().setLevel(args.log_level)
+    stubs = create_stubs(args, seed=args.seed)
+    install_stubs(server, stubs["telegram"], stubs["usersbox"], stubs["cryptobot"])
+    use_database(server, args.mongo_url)
+    server.db_observers.append(count_db_operation)
+
+    sessions = SyntheticTraffic(args.seed).sessions(args.users, args.updates)
+    bot = BotClient(server)
+    lag_monitor = asyncio.create_task(server.loop_lag_monitor.run())
+    started = time.perf_counter()
+    try:
+        stats = await run_load(server, bot, sessions, args.concurrency)
+    finally:
+        elapsed = time.perf_counter() - started
+        lag_monitor.cancel()
+        await bot.close()
+
+    summary = stats.summary(elapsed)
+    summary["config"] = {
+        name: getattr(args, name)
+        for name in ("users", "updates", "concurrency", "seed", "telegram_latency", "usersbox_latency", "cryptobot_latency",
+                     "telegram_errors", "usersbox_errors", "cryptobot_errors")
+    }
+    summary["config"]["database"] = "mongo" if args.mongo_url else "mongomock"
+    print_summary(summary, stubs, server.loop_lag_monitor.stats["lag_max"])
+    return summary
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--updates', type=int, default=20000)
+    parser.add_argument('--concurrency', type=int, default=50, help='users sending updates at the same time')
+    parser.add_argument('--seed', type=int, default=1)
+    add_stub_arguments(parser)
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed latency/throughput regression')
+    parser.add_argument('--update-baseline', action='store_true', help=f'write results to {BASELINE.name}')
+    parser.add_argument('--log-level', default='ERROR')
+    args = parser.parse_args()
+
+    summary = asyncio.run(run(args))
+    if args.update_baseline:
+        BASELINE.write_text(json.dumps(summary, indent=2, ensure_ascii=False) + "\n", encoding='utf-8')
+        print(f"Baseline written to {BASELINE}")
+        return 0
+    if not BASELINE.exists():
+        print(f"No baseline, run with --update-baseline to record {BASELINE.name}")
+        return 0
+
+    regressions = compare_with_baseline(summary, json.loads(BASELINE.read_text(encoding='utf-8')), args.tolerance)
+    for regression in regressions:
+        print(f"❌ {regression}")
+    if not regressions:
+        print("✅ No regressions against baseline")
+    return 1 if regressions else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
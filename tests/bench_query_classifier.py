@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+"""
+Throughput benchmark for the search query classifier.
+
+Checks every query of tests/corpora/search_queries.tsv against its expected
+type, then classifies the corpus repeatedly and reports queries per second.
+
+Usage: python tests/bench_query_classifier.py [--rounds N]
+"""
+
+import argparse
+import sys
+import time
+from pathlib import Path
+
+ROOT_DIR = Path(__file__).parent.parent
+sys.path.insert(0, str(ROOT_DIR / 'backend'))
+
+import query_classifier
+from query_classifier import classify_query
+
+CORPUS = Path(__file__).parent / 'corpora' / 'search_queries.tsv'
+
+def load_corpus():
+    """Load (query, expected search type) pairs"""
+    corpus = []
+    for line in CORPUS.read_text(encoding='utf-8').splitlines():
+        if not line or line.startswith('#'):
+            continue
+        query, expected = line.rsplit('\t', 1)
+        corpus.append((query, getattr(query_classifier, expected)))
+    return corpus
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rounds', type=int, default=2000)
+    args = parser.parse_args()
+
+    corpus = load_corpus()
+    mismatches = [
+        (query, expected, classify_query(query).search_type)
+        for query, expected in corpus
+        if classify_query(query).search_type != expected
+    ]
+    for query, expected, actual in mismatches:
+        print(f"❌ {query!r}: expected {expected}, got {actual}")
+
+    queries = [query for query, _ in corpus]
+    started = time.perf_counter()
+    for _ in range(args.rounds):
+        for query in queries:
+            classify_query(query)
+    elapsed = time.perf_counter() - started
+
+    total = len(queries) * args.rounds
+    print(f"Corpus: {len(queries)} queries, {len(mismatches)} mismatches")
+    print(f"Classified {total} queries in {elapsed:.3f}s: {total / elapsed:,.0f} queries/s, {elapsed / total * 1e6:.2f} µs/query")
+    return 1 if mismatches else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""
+Benchmark for usersbox result formatting.
+
+Formats every recorded response of tests/corpora/usersbox for the inline
+message and as a TXT result file, then checks that inline formatting cost
+stays flat as items gain more fields and responses gain more sources.
+
+Usage: python tests/bench_result_formatter.py [--rounds N]
+"""
+
+import argparse
+import json
+import sys
+import time
+from pathlib import Path
+
+ROOT_DIR = Path(__file__).parent.parent
+sys.path.insert(0, str(ROOT_DIR / 'backend'))
+
+from result_formatter import format_search_results, iter_results_txt
+
+CORPUS_DIR = Path(__file__).parent / 'corpora' / 'usersbox'
+
+def load_corpus():
+    """Load recorded usersbox responses by name"""
+    return {path.stem: json.loads(path.read_text(encoding='utf-8')) for path in sorted(CORPUS_DIR.glob('*.json'))}
+
+def measure(func, rounds: int) -> float:
+    """Average seconds per call"""
+    started = time.perf_counter()
+    for _ in range(rounds):
+        func()
+    return (time.perf_counter() - started) / rounds
+
+def widen(response, extra_fields: int, sources: int):
+    """Copy of response with more fields per item and more sources"""
+    items = response['data']['items']
+    widened = []
+    for i in range(sources):
+        source_data = json.loads(json.dumps(items[i % len(items)]))
+        for item in source_data['hits']['items']:
+            item.update({f"field_{n}": n for n in range(extra_fields)})
+        widened.append(source_data)
+    return {"status": "success", "data": {"count": len(widened), "items": widened}}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rounds', type=int, default=500)
+    args = parser.parse_args()
+
+    corpus = load_corpus()
+    print(f"{'response':<10} {'inline µs':>10} {'file µs':>10}")
+    for name, response in corpus.items():
+        inline = measure(lambda: format_search_results(response, "79123456789", "📱 Телефон"), args.rounds)
+        file = measure(lambda: sum(1 for _ in iter_results_txt([("79123456789", "📱 Телефон", response)])), max(1, args.rounds // 10))
+        print(f"{name:<10} {inline * 1e6:>10.1f} {file * 1e6:>10.1f}")
+
+    print(f"\n{'extra fields':>12} {'sources':>8} {'inline µs':>10}")
+    timings = []
+    for extra_fields, sources in ((0, 5), (50, 5), (500, 5), (0, 50), (0, 500)):
+        response = widen(corpus['medium'], extra_fields, sources)
+        inline = measure(lambda: format_search_results(response, "79123456789", "📱 Телефон"), args.rounds)
+        timings.append(inline)
+        print(f"{extra_fields:>12} {sources:>8} {inline * 1e6:>10.1f}")
+
+    # Sources beyond the inline limit must not add formatting cost
+    growth = timings[-1] / timings[0]
+    print(f"\nInline cost growth 5 -> 500 sources: x{growth:.2f}")
+    return 0 if growth < 2 else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,7 @@
+import sys
+from pathlib import Path
+
+# Модули backend импортируются так же, как их импортирует server.py,
+# вспомогательные модули тестов - так же, как их импортируют скрипты бенчмарков
+sys.path.insert(0, str(Path(__file__).parent.parent / 'backend'))
+sys.path.insert(0, str(Path(__file__).parent))
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+"""
+Replay of recorded production updates against the in-process bot.
+
+Reads a log written by the update recorder (UPDATE_RECORD_PATH, gzip JSON
+lines of anonymized webhook updates) and posts the updates to the Telegram
+and CryptoBot webhooks of the in-process app with stubbed upstreams
+(tests/upstream_stubs.py), at the recorded pace divided by --speed or, with
+--speed 0, as fast as --concurrency allows. Updates of one user are sent in
+order, each after the previous one was answered.
+
+Reports latency and DB round-trips per update kind next to the latency
+recorded in production, plus CPU time and peak memory. --save keeps the
+summary as JSON, --compare checks it against a summary saved by another build
+with the same log and settings.
+
+Usage: python tests/replay_updates.py LOG [--speed X] [--concurrency N]
+       [--limit N] [--balance RUB | --no-seed-users] [--save FILE] [--compare FILE]
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import re
+import resource
+import sys
+import time
+from pathlib import Path
+from typing import Any, Dict, List
+
+from bench_load import LoadStats, compare_with_baseline, count_db_operation, current_update_ops, print_summary, print_table
+from upstream_stubs import BotClient, add_stub_arguments, create_stubs, import_server, install_stubs, use_database
+
+def update_kind(source: str, update: Dict[str, Any]) -> str:
+    """Kind of update for the report: callback route, command, search, payment..."""
+    if source != "telegram":
+        return source
+    if 'callback_query' in update:
+        return "callback " + re.sub(r'\d+', 'N', update['callback_query'].get('data') or '')
+    if 'pre_checkout_query' in update:
+        return "pre_checkout_query"
+    message = update.get('message')
+    if not message:
+        return "other"
+    if message.get('successful_payment'):
+        return "successful_payment"
+    if message.get('document'):
+        return "batch_document"
+    text = message.get('text') or ''
+    if text.startswith('/'):
+        return "command " + text.split()[0]
+    if '\n' in text.strip():
+        return "batch_search"
+    return "search" if text else "other"
+
+def load_records(path: str, limit: int) -> List[Dict[str, Any]]:
+    import_server()
+    from update_recorder import read_records
+
+    records = []
+    for record in read_records(path):
+        records.append(record)
+        if limit and len(records) >= limit:
+            break
+    records.sort(key=lambda record: record["t"])
+    return records
+
+async def seed_users(server, records: List[Dict[str, Any]], balance: float) -> int:
+    """Create recorded users up front so that their searches are paid from the balance"""
+    user_ids = {server.update_user_key(record["update"]) for record in records if record["source"] == "telegram"}
+    users = [
+        server.User(telegram_id=user_id, referral_code=server.generate_referral_code(user_id), balance=balance).dict()
+        for user_id in user_ids if isinstance(user_id, int)
+    ]
+    if users:
+        await server.db.users.insert_many(users)
+    return len(users)
+
+async def replay(server, bot: BotClient, records: List[Dict[str, Any]], speed: float, concurrency: int) -> LoadStats:
+    stats = LoadStats()
+    in_flight = asyncio.Semaphore(concurrency)
+    chains: Dict[Any, asyncio.Task] = {}
+
+    async def send(record: Dict[str, Any], previous: asyncio.Task):
+        if previous is not None:
+            await asyncio.gather(previous, return_exceptions=True)
+        async with in_flight:
+            ops = [0]
+            token = current_update_ops.set(ops)
+            try:
+                status, seconds = await bot.post(record["update"], record["source"])
+            finally:
+                current_update_ops.reset(token)
+        stats.record(update_kind(record["source"], record["update"]), status, seconds, ops[0])
+
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    first = records[0]["t"]
+    for record in records:
+        if speed > 0:
+            delay = (record["t"] - first) / speed - (loop.time() - started)
+            if delay > 0:
+                await asyncio.sleep(delay)
+        key = (record["source"], server.update_user_key(record["update"]) if record["source"] == "telegram" else None)
+        chains[key] = asyncio.create_task(send(record, chains.get(key)))
+    await asyncio.gather(*chains.values())
+    return stats
+
+def recorded_summary(records: List[Dict[str, Any]]) -> Dict[str, Any]:
+    stats = LoadStats()
+    for record in records:
+        stats.record(update_kind(record["source"], record["update"]), record.get("status", 200), record["duration"], 0)
+    return stats.summary(records[-1]["t"] - records[0]["t"])
+
+async def run(args) -> Dict[str, Any]:
+    server = import_server()
+    records = load_records(args.log, args.limit)
+    if not records:
+        raise SystemExit(f"No records in {args.log}")
+
+    logging.getLogger().setLevel(args.log_level)
+    stubs = create_stubs(args)
+    install_stubs(server, stubs["telegram"], stubs["usersbox"], stubs["cryptobot"])
+    use_database(server, args.mongo_url)
+    if args.balance is not None:
+        print(f"Seeded {await seed_users(server, records, args.balance)} users with {args.balance} ₽")
+    server.db_observers.append(count_db_operation)
+
+    bot = BotClient(server)
+    lag_monitor = asyncio.create_task(server.loop_lag_monitor.run())
+    usage_before = resource.getrusage(resource.RUSAGE_SELF)
+    started = time.perf_counter()
+    try:
+        stats = await replay(server, bot, records, args.speed, args.concurrency)
+    finally:
+        elapsed = time.perf_counter() - started
+        lag_monitor.cancel()
+        await bot.close()
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+
+    print("Recorded in production:")
+    print_table(recorded_summary(records), db_ops=False)
+    print("\nReplayed:")
+    summary = stats.summary(elapsed)
+    summary["cpu_seconds"] = round(usage.ru_utime + usage.ru_stime - usage_before.ru_utime - usage_before.ru_stime, 3)
+    summary["max_rss_mb"] = round(usage.ru_maxrss / 1024, 1)
+    summary["config"] = {
+        "log": Path(args.log).name,
+        "records": len(records),
+        "speed": args.speed,
+        "concurrency": args.concurrency,
+        "balance": args.balance,
+        "database": "mongo" if args.mongo_url else "mongomock",
+        **{name: getattr(args, name) for name in ("telegram_latency", "usersbox_latency", "cryptobot_latency",
+                                                  "telegram_errors", "usersbox_errors", "cryptobot_errors")},
+    }
+    print_summary(summary, stubs, server.loop_lag_monitor.stats["lag_max"])
+    print(f"CPU time: {summary['cpu_seconds']:.2f}s, peak RSS: {summary['max_rss_mb']:.1f} MB")
+    return summary
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('log', help='update log written by UPDATE_RECORD_PATH')
+    parser.add_argument('--speed', type=float, default=1.0, help='pace multiplier, 0 sends as fast as possible')
+    parser.add_argument('--concurrency', type=int, default=200, help='updates in flight at most')
+    parser.add_argument('--limit', type=int, default=0, help='replay only the first N records')
+    parser.add_argument('--balance', type=float, default=1000.0, help='balance of pre-created users')
+    parser.add_argument('--no-seed-users', dest='balance', action='store_const', const=None, help='let the bot create users itself')
+    add_stub_arguments(parser)
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed latency/throughput regression')
+    parser.add_argument('--save', help='write the summary to FILE')
+    parser.add_argument('--compare', help='summary of another build to compare with')
+    parser.add_argument('--log-level', default='ERROR')
+    args = parser.parse_args()
+
+    summary = asyncio.run(run(args))
+    if args.save:
+        Path(args.save).write_text(json.dumps(summary, indent=2, ensure_ascii=False) + "\n", encoding='utf-8')
+        print(f"Summary written to {args.save}")
+    if not args.compare:
+        return 0
+
+    regressions = compare_with_baseline(summary, json.loads(Path(args.compare).read_text(encoding='utf-8')), args.tolerance)
+    for regression in regressions:
+        print(f"❌ {regression}")
+    if not regressions:
+        print(f"✅ No regressions against {args.compare}")
+    return 1 if regressions else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,148 @@
+import asyncio
+import threading
+
+import pytest
+
+import circuit_breaker
+from circuit_breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, CircuitOpenError, UpstreamStatusError
+
+class Clock:
+    """Stand-in for the time module of circuit_breaker; the event loop keeps the real clock"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def time(self) -> float:
+        return self.now
+
+class Response:
+    def __init__(self, status_code: int = 200):
+        self.status_code = status_code
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(circuit_breaker, "time", clock)
+    return clock
+
+def make_breaker(**kwargs) -> CircuitBreaker:
+    options = dict(max_timeout=10.0, min_timeout=1.0, window=60.0, min_calls=4, error_rate_threshold=0.5, open_duration=30.0)
+    options.update(kwargs)
+    return CircuitBreaker("test", **options)
+
+def open_breaker(breaker: CircuitBreaker):
+    for _ in range(breaker.min_calls):
+        breaker.before_call()
+        breaker.record_failure()
+    assert breaker.state == OPEN
+
+def test_opens_when_error_rate_reaches_threshold(clock):
+    breaker = make_breaker()
+    for ok in (True, False, True):
+        breaker.before_call()
+        breaker.record_success(0.1) if ok else breaker.record_failure()
+    assert breaker.state == CLOSED  # меньше min_calls
+
+    breaker.before_call()
+    breaker.record_failure()
+    assert breaker.state == OPEN
+    with pytest.raises(CircuitOpenError) as error:
+        breaker.before_call()
+    assert error.value.retry_after == pytest.approx(30.0)
+    assert breaker.counters["rejected"] == 1
+
+def test_outcomes_leave_the_window(clock):
+    breaker = make_breaker()
+    for _ in range(3):
+        breaker.before_call()
+        breaker.record_failure()
+    clock.now += 61
+    assert breaker.error_rate() == 0.0
+
+    breaker.before_call()
+    breaker.record_failure()
+    assert breaker.state == CLOSED
+
+def test_half_open_probe_success_closes(clock):
+    breaker = make_breaker()
+    open_breaker(breaker)
+    clock.now += 30
+
+    breaker.before_call()
+    assert breaker.state == HALF_OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()  # только half_open_max_calls проб
+
+    breaker.record_success(0.2)
+    assert breaker.state == CLOSED
+    assert breaker.error_rate() == 0.0
+
+def test_half_open_probe_failure_reopens(clock):
+    breaker = make_breaker()
+    open_breaker(breaker)
+    clock.now += 30
+    breaker.before_call()
+
+    breaker.record_failure()
+    assert breaker.state == OPEN
+    assert breaker.opened_at == clock.now
+    assert breaker.counters["opened"] == 2
+
+def test_cancelled_half_open_probe_frees_its_slot(clock):
+    breaker = make_breaker()
+    open_breaker(breaker)
+    clock.now += 30
+    release = threading.Event()
+
+    def blocking_call(url, timeout):
+        release.wait(5)
+        return Response()
+
+    async def scenario():
+        probe = asyncio.ensure_future(breaker.call(blocking_call, "https://upstream/x"))
+        await asyncio.sleep(0.01)
+        assert breaker.state == HALF_OPEN and breaker.half_open_calls == 1
+        probe.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await probe
+        release.set()
+
+    asyncio.run(scenario())
+    assert breaker.state == HALF_OPEN
+    assert breaker.half_open_calls == 0
+    breaker.before_call()  # отменённая проба не заняла слот навсегда
+
+def test_status_errors_count_as_failures(clock):
+    breaker = make_breaker(min_calls=1)
+    with pytest.raises(UpstreamStatusError) as error:
+        asyncio.run(breaker.call(lambda url, timeout: Response(503), "https://upstream/x"))
+    assert error.value.status_code == 503
+    assert breaker.state == OPEN
+
+def test_custom_failure_status(clock):
+    breaker = make_breaker(min_calls=1, failure_status=lambda status: status >= 500)
+    response = asyncio.run(breaker.call(lambda url, timeout: Response(429), "https://upstream/x"))
+    assert response.status_code == 429
+    assert breaker.state == CLOSED
+
+def test_observers_get_outcome_and_target(clock):
+    breaker = make_breaker()
+    seen = []
+    breaker.observers.append(lambda name, outcome, started, duration, target: seen.append((name, outcome, target)))
+    asyncio.run(breaker.call(lambda url, timeout: Response(), "https://upstream/ok"))
+    with pytest.raises(UpstreamStatusError):
+        asyncio.run(breaker.call(lambda url, timeout: Response(500), "https://upstream/fail"))
+    assert seen == [("test", "success", "https://upstream/ok"), ("test", "status_error", "https://upstream/fail")]
+
+def test_adaptive_timeout(clock):
+    breaker = make_breaker(min_latency_samples=3, timeout_multiplier=2.0)
+    assert breaker.timeout() == 10.0  # пока мало замеров
+    for latency in (0.1, 0.2, 0.3):
+        breaker.record_success(latency)
+    assert breaker.timeout() == pytest.approx(1.0)  # 0.3 * 2 ниже min_timeout
+    for _ in range(3):
+        breaker.record_success(8.0)
+    assert breaker.timeout() == 10.0  # ограничен max_timeout
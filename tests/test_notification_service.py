@@ -0,0 +1,43 @@
+import asyncio
+import time
+
+import pytest
+from mongomock_motor import AsyncMongoMockClient
+
+from notification_service import Notification, NotificationService
+
+def make_service(send=None, **kwargs) -> NotificationService:
+    async def sent(chat_id, text, reply_markup=None):
+        return True
+    return NotificationService(AsyncMongoMockClient()["test"], send or sent, [], **kwargs)
+
+def test_reserve_keeps_global_gap_and_fills_free_slots():
+    service = make_service(rate=10.0)
+    assert service.reserve(100.0, 101.0) == 101.0  # чат ждёт своего интервала
+    # Другой чат занимает свободное время раньше, а не после него
+    assert service.reserve(100.0, 100.0) == 100.0
+    assert service.reserve(100.0, 100.05) == pytest.approx(100.1)
+    assert service.reserve(100.0, 100.95) == pytest.approx(101.1)
+    assert service.send_slots == pytest.approx([100.0, 100.1, 101.0, 101.1])
+
+def test_waiting_chat_does_not_delay_other_chats():
+    sent = []
+    started = time.monotonic()
+
+    async def send(chat_id, text, reply_markup=None):
+        sent.append((chat_id, text, time.monotonic() - started))
+        return True
+
+    service = make_service(send, rate=20.0, per_chat_interval=0.5)
+
+    async def scenario():
+        await service.deliver(Notification("1", 1, "first"))
+        await asyncio.gather(
+            service.deliver(Notification("2", 1, "second")),
+            service.deliver(Notification("3", 2, "other chat")),
+        )
+
+    asyncio.run(scenario())
+    times = {text: at for _, text, at in sent}
+    assert times["other chat"] < 0.2
+    assert times["second"] - times["first"] >= 0.5 - 0.01
@@ -0,0 +1,53 @@
+from rate_limiter import SlidingWindowLimiter
+
+def hits(limiter: SlidingWindowLimiter, key, now: float, count: int) -> int:
+    return sum(limiter.hit(key, now) for _ in range(count))
+
+def test_limit_within_window():
+    limiter = SlidingWindowLimiter(3, 10.0)
+    assert hits(limiter, "a", 100.0, 5) == 3
+    assert not limiter.hit("a", 109.9)
+    assert limiter.hit("b", 109.9)  # ключи считаются отдельно
+
+def test_previous_window_is_weighted_by_overlap():
+    limiter = SlidingWindowLimiter(4, 10.0)
+    assert hits(limiter, "a", 100.0, 4) == 4
+    # Прошло 25% нового окна: предыдущее весит 3 из 4
+    assert hits(limiter, "a", 112.5, 4) == 1
+    # 75% окна: предыдущее весит 1, текущее уже 1
+    assert hits(limiter, "a", 117.5, 4) == 2
+
+def test_window_rollover_at_boundary():
+    limiter = SlidingWindowLimiter(2, 10.0)
+    assert hits(limiter, "a", 109.0, 2) == 2
+    assert not limiter.hit("a", 110.0)  # в начале окна предыдущее считается целиком
+    entry = limiter.entries["a"]
+    assert entry[0] == 11 and entry[1] == 0 and entry[2] == 2
+
+def test_skipped_windows_reset_previous():
+    limiter = SlidingWindowLimiter(2, 10.0)
+    assert hits(limiter, "a", 100.0, 2) == 2
+    # Между запросами прошло больше окна - старые события не учитываются
+    assert hits(limiter, "a", 120.0, 3) == 2
+    assert limiter.entries["a"][2] == 0
+
+def test_least_recently_used_keys_are_evicted():
+    limiter = SlidingWindowLimiter(1, 10.0, max_keys=2)
+    limiter.hit("a", 100.0)
+    limiter.hit("b", 100.0)
+    limiter.hit("a", 101.0)  # "a" снова свежий
+    limiter.hit("c", 102.0)
+    assert list(limiter.entries) == ["a", "c"]
+    assert limiter.hit("b", 103.0)  # вытесненный ключ начинает с нуля
+
+def test_notify_once_per_window():
+    limiter = SlidingWindowLimiter(1, 10.0)
+    assert not limiter.notify_once("a")  # ключ ещё не встречался
+    limiter.hit("a", 100.0)
+    assert not limiter.hit("a", 101.0)
+    assert limiter.notify_once("a")
+    assert not limiter.notify_once("a")
+
+    assert not limiter.hit("a", 110.0)
+    assert limiter.notify_once("a")  # новое окно - снова одно уведомление
+    assert not limiter.notify_once("a")
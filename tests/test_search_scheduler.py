@@ -0,0 +1,149 @@
+import asyncio
+
+import pytest
+
+from search_scheduler import SearchScheduler, parse_tier_weights
+
+class Searches:
+    """Runs searches that hold their slot until released, recording the start order"""
+
+    def __init__(self, scheduler: SearchScheduler):
+        self.scheduler = scheduler
+        self.started = []
+        self.releases = {}
+
+    def submit(self, name: str, user_id: int, tier: str = "balance") -> asyncio.Task:
+        release = self.releases[name] = asyncio.Event()
+
+        async def search():
+            async with self.scheduler.slot(user_id, tier):
+                self.started.append(name)
+                await release.wait()
+        return asyncio.ensure_future(search())
+
+    async def finish(self, name: str):
+        self.releases[name].set()
+        await asyncio.sleep(0)
+        await asyncio.sleep(0)
+
+async def settle():
+    for _ in range(3):
+        await asyncio.sleep(0)
+
+def test_parse_tier_weights():
+    assert parse_tier_weights("subscription:3, balance:2,admin:1,broken") == {"subscription": 3.0, "balance": 2.0, "admin": 1.0}
+
+def test_global_concurrency_cap():
+    async def scenario():
+        scheduler = SearchScheduler(2, 10, {})
+        searches = Searches(scheduler)
+        for i, user_id in enumerate((1, 2, 3)):
+            searches.submit(f"s{i}", user_id)
+        await settle()
+        assert searches.started == ["s0", "s1"]
+        assert scheduler.stats()["queued"] == 1
+
+        await searches.finish("s0")
+        assert searches.started == ["s0", "s1", "s2"]
+        assert scheduler.running == 2
+
+    asyncio.run(scenario())
+
+def test_per_user_limit_does_not_block_other_users():
+    async def scenario():
+        scheduler = SearchScheduler(10, 2, {})
+        searches = Searches(scheduler)
+        for name in ("a1", "a2", "a3"):
+            searches.submit(name, 1)
+        searches.submit("b1", 2)
+        await settle()
+        # Третий поиск пользователя 1 ждёт при свободных слотах, поиск пользователя 2 - нет
+        assert searches.started == ["a1", "a2", "b1"]
+        assert scheduler.in_flight[1] == 2
+
+        await searches.finish("a1")
+        assert searches.started[-1] == "a3"
+        assert scheduler.in_flight[1] == 2
+
+    asyncio.run(scenario())
+
+def test_user_with_many_searches_cannot_push_ahead():
+    async def scenario():
+        scheduler = SearchScheduler(1, 10, {})
+        searches = Searches(scheduler)
+        searches.submit("a0", 1)
+        await settle()
+        for i in range(1, 5):
+            searches.submit(f"a{i}", 1)
+        searches.submit("b0", 2)
+        await settle()
+
+        # Очередь пользователя 1 не задерживает первый поиск пользователя 2
+        await searches.finish("a0")
+        assert searches.started == ["a0", "b0"]
+        for _ in range(5):
+            await searches.finish(searches.started[-1])
+        assert searches.started[2:] == ["a1", "a2", "a3", "a4"]
+
+    asyncio.run(scenario())
+
+def test_tier_weights_share_slots():
+    async def scenario():
+        scheduler = SearchScheduler(1, 100, {"subscription": 3, "balance": 1})
+        searches = Searches(scheduler)
+        searches.submit("warmup", 0)
+        await settle()
+        for i in range(8):
+            searches.submit(f"sub{i}", 1, "subscription")
+            searches.submit(f"bal{i}", 2, "balance")
+        await settle()
+
+        await searches.finish("warmup")
+        for _ in range(8):
+            await searches.finish(searches.started[-1])
+        first = searches.started[1:9]
+        assert sum(name.startswith("sub") for name in first) == 6
+        assert scheduler.stats()["tiers"]["subscription"]["dispatched"] >= 6
+
+    asyncio.run(scenario())
+
+def test_cancelled_waiter_leaves_no_state():
+    async def scenario():
+        scheduler = SearchScheduler(1, 10, {})
+        searches = Searches(scheduler)
+        searches.submit("a", 1)
+        waiting = searches.submit("b", 2)
+        await settle()
+        waiting.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiting
+        assert scheduler.stats()["queued"] == 0
+
+        await searches.finish("a")
+        assert scheduler.running == 0
+        assert not scheduler.in_flight and not scheduler.waiting and not scheduler.user_finish
+
+    asyncio.run(scenario())
+
+def test_cancel_after_dispatch_releases_slot():
+    async def scenario():
+        scheduler = SearchScheduler(1, 10, {})
+        searches = Searches(scheduler)
+        searches.submit("a", 1)
+        waiting = searches.submit("b", 2)
+        await settle()
+        # Слот выдан, но задача отменена до того, как начала поиск
+        searches.releases["a"].set()
+        await asyncio.sleep(0)
+        waiting.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiting
+        await settle()
+
+        assert scheduler.running == 0
+        searches.submit("c", 3)
+        await settle()
+        assert searches.started[-1] == "c"
+        await searches.finish("c")
+
+    asyncio.run(scenario())
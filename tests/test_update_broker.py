@@ -0,0 +1,107 @@
+import asyncio
+
+import pytest
+from mongomock_motor import AsyncMongoMockClient
+
+from update_broker import ShardWorker, UpdateBroker
+
+def make_worker(handler, **kwargs) -> ShardWorker:
+    broker = UpdateBroker(AsyncMongoMockClient()["test"], partitions=4, lease_ttl=30.0)
+    return ShardWorker(broker, handler, lambda update: update["chat"], poll_interval=0.01, **kwargs)
+
+async def stop(task: asyncio.Task):
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+
+def test_slow_update_delays_only_its_chat():
+    async def scenario():
+        handled = []
+        release = asyncio.Event()
+
+        async def handler(update):
+            if update["slow"]:
+                await release.wait()
+            handled.append(update["id"])
+
+        worker = make_worker(handler)
+        await worker.broker.publish([
+            {"id": 1, "chat": "a", "slow": True},
+            {"id": 2, "chat": "a", "slow": False},
+            {"id": 3, "chat": "b", "slow": False},
+        ], lambda update: update["chat"])
+        running = asyncio.create_task(worker.run())
+        for _ in range(100):
+            await asyncio.sleep(0.01)
+            if handled:
+                break
+        # Обновление чата b не ждёт медленного обновления чата a
+        assert handled == [3]
+        assert len(worker.in_flight) == 2
+
+        release.set()
+        for _ in range(100):
+            await asyncio.sleep(0.01)
+            if not await worker.broker.queue.count_documents({}):
+                break
+        assert handled == [3, 1, 2]
+        await stop(running)
+
+    asyncio.run(scenario())
+
+def test_unfinished_updates_stay_in_queue():
+    async def scenario():
+        release = asyncio.Event()
+
+        async def handler(update):
+            if update["slow"]:
+                await release.wait()
+
+        worker = make_worker(handler)
+        await worker.broker.publish([
+            {"id": 1, "chat": "a", "slow": True},
+            {"id": 2, "chat": "b", "slow": False},
+        ], lambda update: update["chat"])
+        running = asyncio.create_task(worker.run())
+        for _ in range(100):
+            await asyncio.sleep(0.01)
+            if worker.processed:
+                break
+        await asyncio.sleep(0.05)
+        await stop(running)
+        remaining = await worker.broker.queue.find({}).to_list(None)
+        assert [doc["update"]["id"] for doc in remaining] == [1]
+
+    asyncio.run(scenario())
+
+def test_lost_lease_is_dropped_by_heartbeat():
+    async def scenario():
+        worker = make_worker(lambda update: asyncio.sleep(0), heartbeat_interval=0.01)
+        await worker.rebalance()
+        assert worker.owned == {0, 1, 2, 3}
+        # Аренду партиции 2 забрал другой воркер
+        await worker.broker.leases.update_one({"_id": 2}, {"$set": {"owner": "other"}})
+        heartbeat = asyncio.create_task(worker.run_heartbeat())
+        await asyncio.sleep(0.03)
+        assert worker.owned == {0, 1, 3}
+        await stop(heartbeat)
+
+    asyncio.run(scenario())
+
+def test_failing_heartbeat_drops_leases_before_they_expire():
+    async def scenario():
+        worker = make_worker(lambda update: asyncio.sleep(0), heartbeat_interval=0.01)
+        worker.broker.lease_ttl = 0.05
+        await worker.rebalance()
+
+        async def unavailable(worker_id, partitions):
+            raise ConnectionError("mongo is down")
+        worker.broker.heartbeat = unavailable
+        heartbeat = asyncio.create_task(worker.run_heartbeat())
+        await asyncio.sleep(0.02)
+        assert worker.owned == {0, 1, 2, 3}  # аренды ещё действуют
+        await asyncio.sleep(0.06)
+        assert worker.owned == set()
+        await stop(heartbeat)
+
+    asyncio.run(scenario())
@@ -0,0 +1,55 @@
+import asyncio
+
+from upstream_stubs import CryptoBotStub, TelegramStub, UsersboxStub, import_server, install_stubs
+
+class FakeUpdates:
+    """getUpdates semantics: offset confirms every earlier update, the rest are returned again"""
+
+    def __init__(self, updates):
+        self.pending = list(updates)
+        self.calls = 0
+
+    async def fetch(self, offset):
+        self.calls += 1
+        if offset is not None:
+            self.pending = [update for update in self.pending if update['update_id'] >= offset]
+        if not self.pending:
+            await asyncio.sleep(0.01)  # long poll без новых обновлений
+        return list(self.pending)
+
+def message(update_id: int, chat_id: int) -> dict:
+    chat = {"id": chat_id, "type": "private"}
+    return {"update_id": update_id, "message": {"message_id": update_id, "date": 0, "from": chat, "chat": chat, "text": "hi"}}
+
+def test_offset_is_confirmed_only_after_handling(monkeypatch):
+    server = import_server()
+    install_stubs(server, TelegramStub(), UsersboxStub(), CryptoBotStub())
+    telegram = FakeUpdates([message(1001, 1), message(1002, 2), message(1003, 1)])
+    release = asyncio.Event()
+    handled = []
+
+    async def handle(update):
+        if update['update_id'] == 1001:
+            await release.wait()
+        handled.append(update['update_id'])
+
+    monkeypatch.setattr(server, "fetch_updates", telegram.fetch)
+    monkeypatch.setattr(server, "handle_telegram_update", handle)
+
+    async def scenario():
+        monkeypatch.setattr(server, "polled_update_done", asyncio.Event())
+        poller = asyncio.create_task(server.run_update_poller())
+        await asyncio.sleep(0.1)
+        # Другой чат не ждёт медленного обновления, а оно само не подтверждено
+        assert handled == [1002]
+        assert [update['update_id'] for update in telegram.pending] == [1001, 1002, 1003]
+        assert telegram.calls <= 3  # повторы уже принятых обновлений не крутят цикл
+
+        release.set()
+        await asyncio.sleep(0.1)
+        assert handled == [1002, 1001, 1003]
+        assert telegram.pending == []
+        poller.cancel()
+        await asyncio.gather(poller, return_exceptions=True)
+
+    asyncio.run(scenario())
@@ -0,0 +1,54 @@
+import asyncio
+import time
+
+from replay_updates import load_records, replay, seed_users
+from update_recorder import Anonymizer, UpdateRecorder
+from upstream_stubs import BotClient, CryptoBotStub, TelegramStub, UsersboxStub, import_server, install_stubs, use_database
+
+USER_ID = 123456789
+
+def start_update() -> dict:
+    user = {"id": USER_ID, "is_bot": False, "first_name": "Иван", "username": "ivan"}
+    return {"update_id": 1, "message": {
+        "message_id": 1, "date": 1700000000, "from": user, "chat": {**user, "type": "private"}, "text": "/start",
+    }}
+
+def invoice_paid() -> dict:
+    return {"update_id": 2, "update_type": "invoice_paid", "request_date": "2024-01-01T00:00:00Z", "payload": {
+        "invoice_id": 42, "status": "paid", "amount": "150", "currency_type": "fiat", "fiat": "RUB",
+        "description": f"Пополнение баланса УЗРИ для пользователя {USER_ID} на 150₽",
+        "comment": "для Ивана", "pay_url": "https://t.me/CryptoBot?start=IV42",
+    }}
+
+def test_description_id_uses_the_user_pseudonym():
+    anonymizer = Anonymizer(b"key")
+    description = anonymizer.anonymize(invoice_paid())["payload"]["description"]
+    assert description == f"Пополнение баланса УЗРИ для пользователя {anonymizer.user_id(USER_ID)} на 150₽"
+    assert str(USER_ID) not in description
+    assert anonymizer.anonymize({"description": "Счёт 123"})["description"] != "Счёт 123"
+
+def test_recorded_crypto_payment_is_replayed_to_the_same_user(tmp_path):
+    server = import_server()
+    install_stubs(server, TelegramStub(), UsersboxStub(), CryptoBotStub())
+    log = tmp_path / "updates.jsonl.gz"
+    recorder = UpdateRecorder(str(log), b"key")
+    now = time.time()
+    recorder.record("telegram", start_update(), now, 0.01, 200, USER_ID)
+    recorder.record("cryptobot", invoice_paid(), now + 1, 0.01, 200)
+
+    async def scenario():
+        await recorder.flush()
+        records = load_records(str(log), 0)
+        database = use_database(server)
+        assert await seed_users(server, records, 0.0) == 1
+        bot = BotClient(server)
+        try:
+            stats = await replay(server, bot, records, 0, 10)
+        finally:
+            await bot.close()
+        pseudonym = recorder.anonymizer.user_id(USER_ID)
+        return stats, await database.users.find_one({"telegram_id": pseudonym})
+
+    stats, user = asyncio.run(scenario())
+    assert stats.failures == 0
+    assert user["balance"] == 150.0
@@ -0,0 +1,28 @@
+import asyncio
+import time
+
+from upstream_stubs import CryptoBotStub, TelegramStub, UsersboxStub, import_server, install_stubs
+
+def test_telegram_call_is_not_delayed_by_blocked_usersbox_calls():
+    server = import_server()
+    install_stubs(server, TelegramStub(), UsersboxStub(latency=2.0), CryptoBotStub())
+
+    async def scenario() -> float:
+        # Больше вызовов, чем потоков у usersbox и у executor по умолчанию
+        searches = [
+            asyncio.ensure_future(server.usersbox_breaker.call(
+                server.http_session.get, f"{server.USERSBOX_BASE_URL}/search", params={"q": str(i)}
+            ))
+            for i in range(server.USERSBOX_HTTP_THREADS + 32)
+        ]
+        await asyncio.sleep(0.1)
+        started = time.monotonic()
+        result = await server.telegram_api_request("sendMessage", {"chat_id": 1, "text": "ok"})
+        elapsed = time.monotonic() - started
+        assert result["ok"]
+        for search in searches:
+            search.cancel()
+        await asyncio.gather(*searches, return_exceptions=True)
+        return elapsed
+
+    assert asyncio.run(scenario()) < 0.5
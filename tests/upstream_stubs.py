@@ -0,0 +1,228 @@
+"""
+In-process bot with local stand-ins for Telegram, usersbox and CryptoBot.
+
+Used by the load benchmark and update replay. import_server() imports the backend
+with settings suited to benchmarking, install_stubs() routes every request of
+the shared HTTP session to the stand-ins (with configurable latency and
+injected errors), use_database() swaps MongoDB for mongomock or a scratch
+database on a local server, and BotClient posts updates to the webhook
+through the ASGI app without opening sockets.
+"""
+
+import json
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Any, Dict, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+import requests
+from requests.adapters import BaseAdapter
+
+ROOT_DIR = Path(__file__).parent.parent
+CORPUS_DIR = Path(__file__).parent / 'corpora'
+
+# Rate limits would shed synthetic traffic, polling and sharding need other processes
+SERVER_ENV = {
+    'RATE_LIMIT_MESSAGES': '1000000',
+    'RATE_LIMIT_CALLBACKS': '1000000',
+    'RATE_LIMIT_GLOBAL': '1000000',
+    'TELEGRAM_UPDATE_MODE': 'webhook',
+    'UPDATE_PROCESSING_MODE': 'inline',
+    'CACHE_INVALIDATION_TRANSPORT': 'local',
+    'TRACE_EXPORT_FILE': '',
+    'TRACE_EXPORT_ENDPOINT': '',
+    'UPDATE_RECORD_PATH': '',
+}
+
+def import_server():
+    """Import backend/server.py; explicitly set environment variables win"""
+    for name, value in SERVER_ENV.items():
+        os.environ.setdefault(name, value)
+    sys.path.insert(0, str(ROOT_DIR / 'backend'))
+    import server
+    return server
+
+class UpstreamStub:
+    """Stand-in API: latency is drawn uniformly from [latency/2, latency*3/2]"""
+
+    def __init__(self, latency: float = 0.0, error_rate: float = 0.0, seed: int = 0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls: Dict[str, int] = {}
+        self.errors = 0
+
+    def delay(self) -> float:
+        with self.lock:
+            return self.latency * self.random.uniform(0.5, 1.5)
+
+    def fail(self) -> Optional[str]:
+        """None, "status" or "connection" for an injected error"""
+        with self.lock:
+            if self.random.random() >= self.error_rate:
+                return None
+            self.errors += 1
+            return self.random.choice(("status", "connection"))
+
+    def count(self, route: str):
+        with self.lock:
+            self.calls[route] = self.calls.get(route, 0) + 1
+
+    def handle(self, request: requests.PreparedRequest) -> Tuple[int, Any]:
+        raise NotImplementedError
+
+class TelegramStub(UpstreamStub):
+    def __init__(self, *args, non_member_rate: float = 0.0, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.non_member_rate = non_member_rate
+        self.message_id = 1000
+
+    def handle(self, request):
+        path = urlparse(request.url).path
+        if path.startswith('/file/'):
+            self.count('file')
+            return 200, "+79123456789\nivan@example.com\n".encode()
+
+        method = path.rsplit('/', 1)[-1]
+        self.count(method)
+        if method == 'getChatMember':
+            member = self.random.random() >= self.non_member_rate
+            return 200, {"ok": True, "result": {"status": "member" if member else "left"}}
+        if method == 'getFile':
+            return 200, {"ok": True, "result": {"file_id": "stub", "file_path": "documents/queries.txt"}}
+        if method in ('sendMessage', 'editMessageText', 'sendDocument', 'sendInvoice'):
+            with self.lock:
+                self.message_id += 1
+                return 200, {"ok": True, "result": {"message_id": self.message_id}}
+        return 200, {"ok": True, "result": True}
+
+class UsersboxStub(UpstreamStub):
+    """Answers /search with recorded responses from tests/corpora/usersbox"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.responses = [
+            json.loads((CORPUS_DIR / 'usersbox' / f"{name}.json").read_text(encoding='utf-8'))
+            for name in ('empty', 'small', 'medium', 'medium', 'nested', 'large')
+        ]
+
+    def handle(self, request):
+        self.count(urlparse(request.url).path.rsplit('/', 1)[-1])
+        query = parse_qs(urlparse(request.url).query).get('q', [''])[0]
+        # Один и тот же запрос всегда даёт один и тот же ответ
+        return 200, self.responses[sum(query.encode()) % len(self.responses)]
+
+class CryptoBotStub(UpstreamStub):
+    def handle(self, request):
+        self.count(urlparse(request.url).path.rsplit('/', 1)[-1])
+        invoice_id = uuid.uuid4().int % 10**9
+        return 200, {"ok": True, "result": {
+            "invoice_id": invoice_id,
+            "status": "active",
+            "bot_invoice_url": f"https://t.me/CryptoBot?start=IV{invoice_id}",
+        }}
+
+class StubAdapter(BaseAdapter):
+    """requests transport that answers from the stand-in registered for the host"""
+
+    def __init__(self, stubs: Dict[str, UpstreamStub]):
+        super().__init__()
+        self.stubs = stubs
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        host = urlparse(request.url).hostname
+        stub = self.stubs.get(host)
+        if stub is None:
+            raise requests.exceptions.ConnectionError(f"No stand-in for {host}")
+
+        read_timeout = timeout[1] if isinstance(timeout, tuple) else timeout
+        delay = stub.delay()
+        if read_timeout is not None and delay > read_timeout:
+            time.sleep(read_timeout)
+            raise requests.exceptions.ReadTimeout(f"{host} did not answer in {read_timeout}s", request=request)
+        time.sleep(delay)
+
+        failure = stub.fail()
+        if failure == "connection":
+            raise requests.exceptions.ConnectionError(f"Injected connection error for {host}", request=request)
+        status, body = (500, {"ok": False, "description": "Injected error"}) if failure else stub.handle(request)
+
+        response = requests.Response()
+        response.status_code = status
+        response._content = body if isinstance(body, bytes) else json.dumps(body, ensure_ascii=False).encode()
+        response.headers['Content-Type'] = 'application/octet-stream' if isinstance(body, bytes) else 'application/json'
+        response.encoding = 'utf-8'
+        response.url = request.url
+        response.request = request
+        return response
+
+    def close(self):
+        pass
+
+def add_stub_arguments(parser):
+    """Command line options for stand-in latency and injected errors"""
+    parser.add_argument('--mongo-url', help='local MongoDB for a scratch database instead of mongomock')
+    parser.add_argument('--telegram-latency', type=float, default=0.03)
+    parser.add_argument('--usersbox-latency', type=float, default=0.2)
+    parser.add_argument('--cryptobot-latency', type=float, default=0.1)
+    parser.add_argument('--telegram-errors', type=float, default=0.0, help='share of failed calls')
+    parser.add_argument('--usersbox-errors', type=float, default=0.0)
+    parser.add_argument('--cryptobot-errors', type=float, default=0.0)
+
+def create_stubs(args, seed: int = 0) -> Dict[str, UpstreamStub]:
+    return {
+        "telegram": TelegramStub(args.telegram_latency, args.telegram_errors, seed=seed),
+        "usersbox": UsersboxStub(args.usersbox_latency, args.usersbox_errors, seed=seed),
+        "cryptobot": CryptoBotStub(args.cryptobot_latency, args.cryptobot_errors, seed=seed),
+    }
+
+def install_stubs(server, telegram: UpstreamStub, usersbox: UpstreamStub, cryptobot: UpstreamStub) -> StubAdapter:
+    """Route all requests of server.http_session to the stand-ins"""
+    adapter = StubAdapter({
+        'api.telegram.org': telegram,
+        urlparse(server.USERSBOX_BASE_URL).hostname: usersbox,
+        urlparse(server.CRYPTOBOT_BASE_URL).hostname: cryptobot,
+    })
+    server.http_session.mount('https://', adapter)
+    server.http_session.mount('http://', adapter)
+    return adapter
+
+def use_database(server, mongo_url: Optional[str] = None):
+    """Point the bot at mongomock, or at a new scratch database on mongo_url"""
+    from instrumented_db import InstrumentedDatabase
+
+    if mongo_url:
+        from motor.motor_asyncio import AsyncIOMotorClient
+        database = AsyncIOMotorClient(mongo_url)[f"load_test_{uuid.uuid4().hex[:8]}"]
+    else:
+        from mongomock_motor import AsyncMongoMockClient
+        database = AsyncMongoMockClient()['load_test']
+    server.db = InstrumentedDatabase(database, server.db_observers)
+    return server.db
+
+class BotClient:
+    """Posts updates to the webhooks of the in-process app"""
+
+    def __init__(self, server):
+        import httpx
+
+        self.paths = {
+            "telegram": f"/api/webhook/{server.WEBHOOK_SECRET}",
+            "cryptobot": "/api/cryptobot/webhook",
+        }
+        self.client = httpx.AsyncClient(transport=httpx.ASGITransport(app=server.app), base_url="http://bot")
+
+    async def post(self, update: Dict[str, Any], source: str = "telegram") -> Tuple[int, float]:
+        """(HTTP status, seconds)"""
+        started = time.perf_counter()
+        response = await self.client.post(self.paths[source], json=update)
+        return response.status_code, time.perf_counter() - started
+
+    async def close(self):
+        await self.client.aclose()